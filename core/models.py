@@ -68,6 +68,8 @@ class Dataset(TimeStampedModel):
     es_type_name = models.CharField(max_length=255)
     es_host = models.CharField(max_length=255)
     es_port = models.CharField(max_length=255)
+    # field the documents are routed to shards by, empty if the index uses the default routing
+    es_routing_field = models.CharField(max_length=255, blank=True, default='')
     is_public = models.BooleanField(default=False)
     allowed_groups = models.ManyToManyField(Group, blank=True)
 
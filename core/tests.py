@@ -1,3 +1,70 @@
-from django.test import TestCase
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from core.utils import get_es_document, get_routing
+
+
+def routed_dataset(field='CHROM'):
+    return SimpleNamespace(es_routing_field=field, es_host='localhost', es_index_name='test_index')
+
+
+def bool_query(occur, clauses):
+    return {"query": {"bool": {occur: clauses}}}
+
+
+class GetRoutingTestCase(SimpleTestCase):
+
+    def test_term_and_terms_on_the_routing_field(self):
+        dataset = routed_dataset()
+        for occur in ['filter', 'must']:
+            self.assertEqual(get_routing(dataset, bool_query(occur, [{"term": {"CHROM": "1"}}])), '1')
+            self.assertEqual(get_routing(dataset, bool_query(occur, [{"term": {"CHROM": {"value": "X"}}}])), 'X')
+            self.assertEqual(get_routing(dataset, bool_query(occur, [{"terms": {"CHROM": ["2", "1"]}}])), '1,2')
+            # a single clause given as a dict instead of a list
+            self.assertEqual(get_routing(dataset, bool_query(occur, {"term": {"CHROM": "1"}})), '1')
+
+    def test_clauses_on_the_routing_field_intersect(self):
+        dataset = routed_dataset()
+        query_body = {"query": {"bool": {
+            "filter": [{"terms": {"CHROM": ["1", "2", "3"]}}, {"range": {"POS": {"gte": 100}}}],
+            "must": [{"terms": {"CHROM": ["2", "3", "4"]}}]}}}
+        self.assertEqual(get_routing(dataset, query_body), '2,3')
+
+    def test_no_routing(self):
+        dataset = routed_dataset()
+        nested = {"nested": {"path": "sample", "query": {"bool": {"filter": [{"term": {"CHROM": "1"}}]}}}}
+        for query_body in [
+                {},
+                {"query": {"match_all": {}}},
+                bool_query('should', [{"term": {"CHROM": "1"}}]),
+                bool_query('must_not', [{"term": {"CHROM": "1"}}]),
+                bool_query('filter', [nested]),
+                bool_query('filter', [{"term": {"POS": 100}}]),
+                bool_query('filter', [{"terms": {"CHROM": []}}]),
+                bool_query('filter', [{"term": {"CHROM": " "}}])]:
+            self.assertIsNone(get_routing(dataset, query_body), query_body)
+
+    def test_dataset_without_routing_field(self):
+        self.assertIsNone(get_routing(routed_dataset(''), bool_query('filter', [{"term": {"CHROM": "1"}}])))
+
+
+class GetEsDocumentTestCase(SimpleTestCase):
+
+    @mock.patch('core.utils.elasticsearch.Elasticsearch')
+    def test_routed_dataset_searches_by_id(self, es_class):
+        es = es_class.return_value
+        es.search.return_value = {"hits": {"hits": [{"_source": {"CHROM": "1"}}]}}
+
+        self.assertEqual(get_es_document(routed_dataset(), 'variant_1'), {"CHROM": "1"})
+        es.search.assert_called_once_with(index='test_index', body={"query": {"ids": {"values": ['variant_1']}}})
+        es.get.assert_not_called()
+
+    @mock.patch('core.utils.elasticsearch.Elasticsearch')
+    def test_default_routing_gets_by_id(self, es_class):
+        es = es_class.return_value
+        es.get.return_value = {"_source": {"CHROM": "1"}}
+
+        self.assertEqual(get_es_document(routed_dataset(''), 'variant_1'), {"CHROM": "1"})
+        es.get.assert_called_once_with(index='test_index', id='variant_1')
@@ -74,11 +74,51 @@ def get_values_from_es(dataset_es_index_name,
 
 def get_es_document(dataset_obj, document_id):
     es = elasticsearch.Elasticsearch(host=dataset_obj.es_host)
+    if dataset_obj.es_routing_field:
+        # a get by id needs the routing value, which is not known here, so look the id up on all shards
+        result = es.search(index=dataset_obj.es_index_name,
+                body={"query": {"ids": {"values": [document_id]}}})
+        return result["hits"]["hits"][0]["_source"]
+
     result = es.get(index=dataset_obj.es_index_name, 
             id=document_id)
     return result["_source"]
 
 
+def get_routing(dataset_obj, query_body):
+    """Routing values of a search on a routed dataset, e.g. '1,2' when the filters only allow CHROM 1 or 2.
+
+    Returns None, i.e. search all shards, if the dataset uses the default
+    routing or the query does not restrict the routing field.
+    """
+    field = dataset_obj.es_routing_field
+    if not field:
+        return None
+
+    bool_query = query_body.get('query', {}).get('bool', {})
+    values = None
+    for occur in ['filter', 'must']:
+        clauses = bool_query.get(occur, [])
+        if isinstance(clauses, dict):
+            clauses = [clauses]
+
+        for clause in clauses:
+            if field in clause.get('term', {}):
+                value = clause['term'][field]
+                clause_values = {value.get('value') if isinstance(value, dict) else value}
+            elif field in clause.get('terms', {}):
+                clause_values = set(clause['terms'][field])
+            else:
+                continue
+
+            clause_values = {str(value).strip() for value in clause_values if value is not None and str(value).strip()}
+            values = clause_values if values is None else values & clause_values
+
+    if not values:
+        return None
+    return ','.join(sorted(values))
+
+
 def get_user_group_for_reviewing(dataset_obj, user_obj):
     """
     Cases:
@@ -829,7 +869,8 @@ class BaseElasticSearchQueryExecutor:
             index=self.dataset_obj.es_index_name,
             body=json.dumps(self.query_body),
             request_timeout=120,
-            terminate_after=self.elasticsearch_terminate_after)
+            terminate_after=self.elasticsearch_terminate_after,
+            routing=get_routing(self.dataset_obj, self.query_body))
 
         self.elasticsearch_response = response
 
@@ -1155,6 +1196,7 @@ class BaseDownloadAllResults:
                                               size=1000,
                                               preserve_order=False,
                                               index=self.search_log_obj.dataset.es_index_name,
+                                              routing=get_routing(self.search_log_obj.dataset, self.query_body),
                                               ):
             tmp_source = hit['_source']
             es_id = hit['_id']
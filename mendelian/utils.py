@@ -12,10 +12,16 @@ from core.models import AttributeField, SearchLog
 from core.utils import (BaseElasticSearchQueryDSL,
                         BaseElasticSearchQueryExecutor,
                         BaseElasticsearchResponseParser,
-                        BaseSearchElasticsearch, get_values_from_es)
+                        BaseSearchElasticsearch, get_routing,
+                        get_values_from_es)
 
 thismodule = sys.modules[__name__]
 
+# side-car index of the mendelian labels of an index, written by utils/load_vcf.py --label_write sidecar
+ANNOTATIONS_SUFFIX = '_annotations'
+# labelled variants of one sample looked up per query
+SIDECAR_PAGE_SIZE = 1000
+
 
 def filter_using_inner_hits(source_data, inner_hits_data):
 
@@ -62,7 +68,9 @@ class MendelianElasticSearchQueryExecutor(BaseElasticSearchQueryExecutor):
         self.limit_results = limit_results
         self.elasticsearch_terminate_after = elasticsearch_terminate_after
 
-    def add_analysis_type_filter(self, analysis_type):
+    def add_analysis_type_filter(self, analysis_type, sample_clause=None):
+        if sample_clause is None:
+            sample_clause = {"term": {"sample.mendelian_diseases": analysis_type}}
         query_body = copy.deepcopy(self.query_body)
         if 'query' not in query_body:
             query_body['query'] = {'bool': {}}
@@ -75,7 +83,7 @@ class MendelianElasticSearchQueryExecutor(BaseElasticSearchQueryExecutor):
                         "query": {
                             "bool": {
                                 "filter": [
-                                    {"term": {"sample.mendelian_diseases": analysis_type}}
+                                    sample_clause
                                 ]
                             }
                         }
@@ -93,8 +101,7 @@ class MendelianElasticSearchQueryExecutor(BaseElasticSearchQueryExecutor):
 
             if sample_array:
                 sample_array['nested']['inner_hits'] = {}
-                sample_array['nested']['query']['bool']['filter'].append(
-                    {"term": {"sample.mendelian_diseases": analysis_type}})
+                sample_array['nested']['query']['bool']['filter'].append(sample_clause)
                 filter_array_copy.append(sample_array)
                 query_body['query']['bool']['filter'] = filter_array_copy
             else:
@@ -107,7 +114,7 @@ class MendelianElasticSearchQueryExecutor(BaseElasticSearchQueryExecutor):
                             "query": {
                                 "bool": {
                                     "filter": [
-                                        {"term": {"sample.mendelian_diseases": analysis_type}}
+                                        sample_clause
                                     ]
                                 }
                             }
@@ -116,26 +123,39 @@ class MendelianElasticSearchQueryExecutor(BaseElasticSearchQueryExecutor):
                 )
         return query_body
 
-    def search(self):
-        results = {
-            "took": None,
-            "hits": {
-                "total": None,
-                "hits": deque()
-            }
+    def iter_sidecar_pages(self, es, index):
+        """(Sample_ID, [variant _id, ...]) pages of the labels of the analysis type in the side-car index of index,
+        None if it has none. The labels are streamed sorted by sample, at most SIDECAR_PAGE_SIZE variants a page"""
+        sidecar = index + ANNOTATIONS_SUFFIX
+        if not es.indices.exists(index=sidecar):
+            return None
+
+        query_body = {
+            "_source": ["variant_id", "Sample_ID"],
+            "query": {"term": {"mendelian_disease": self.mendelian_analysis_type}},
+            "sort": [{"Sample_ID": "asc"}, {"variant_id": "asc"}]
         }
-        count = 0
-        start_time = datetime.datetime.now()
 
-        es = elasticsearch.Elasticsearch(host=self.dataset_obj.es_host, port=self.dataset_obj.es_port)
-
-        if 'CSQ_nested' in es.indices.get_mapping()[self.dataset_obj.es_index_name]['mappings']['properties']:
-            annotation = 'VEP'
-        elif 'ExonicFunc_refGene' in es.indices.get_mapping()[self.dataset_obj.es_index_name]['mappings']['properties']:
-            annotation = 'ANNOVAR'
-
-        query_body = self.add_analysis_type_filter(self.mendelian_analysis_type)
+        def pages():
+            sample_id, variant_ids = None, []
+            for hit in helpers.scan(es, query=query_body, scroll=u'5m', size=1000, preserve_order=True, index=sidecar):
+                if variant_ids and (hit['_source']['Sample_ID'] != sample_id or len(variant_ids) >= SIDECAR_PAGE_SIZE):
+                    yield sample_id, variant_ids
+                    variant_ids = []
+                sample_id = hit['_source']['Sample_ID']
+                variant_ids.append(hit['_source']['variant_id'])
+            if variant_ids:
+                yield sample_id, variant_ids
+
+        return pages()
+
+    def add_sidecar_filter(self, sample_id, variant_ids):
+        """The analysis type filter as a join: variant_ids, with the inner hit of the sample they are labelled for"""
+        query_body = self.add_analysis_type_filter(self.mendelian_analysis_type, {"term": {"sample.Sample_ID": sample_id}})
+        query_body['query']['bool']['filter'].append({"ids": {"values": variant_ids}})
+        return query_body
 
+    def add_consequence_filter(self, query_body, annotation):
         if annotation == 'VEP' and self.mendelian_analysis_type in ['autosomal_recessive', 'compound_heterozygous', 'x_linked_recessive']:
             query_body['query']['bool']['filter'].append(
             {"nested": {
@@ -151,31 +171,68 @@ class MendelianElasticSearchQueryExecutor(BaseElasticSearchQueryExecutor):
                  "score_mode": "none"
                 }
              })
+        return query_body
 
-        print("$$$$ query %s" % query_body)
-        for hit in helpers.scan(
-                es,
-                query=query_body,
-                scroll=u'5m',
-                size=1000,
-                preserve_order=False,
-                doc_type = '_doc',
-                index=self.dataset_obj.es_index_name):
+    def search(self):
+        results = {
+            "took": None,
+            "hits": {
+                "total": None,
+                "hits": deque()
+            }
+        }
+        start_time = datetime.datetime.now()
 
+        es = elasticsearch.Elasticsearch(host=self.dataset_obj.es_host, port=self.dataset_obj.es_port)
+
+        # es_index_name may be an alias, the mapping is keyed by the index it points to
+        mapping = es.indices.get_mapping(index=self.dataset_obj.es_index_name)
+        properties = list(mapping.values())[0]['mappings']['properties']
+        sidecar_pages = self.iter_sidecar_pages(es, list(mapping)[0])
+        if 'CSQ_nested' in properties:
+            annotation = 'VEP'
+        elif 'ExonicFunc_refGene' in properties:
+            annotation = 'ANNOVAR'
+
+        if sidecar_pages is None:
+            query_bodies = [self.add_consequence_filter(self.add_analysis_type_filter(self.mendelian_analysis_type), annotation)]
+        else:
+            # one query per page of a sample's labelled variants, a variant labelled for several samples is found once per sample
+            query_bodies = (self.add_consequence_filter(self.add_sidecar_filter(sample_id, variant_ids), annotation)
+                            for sample_id, variant_ids in sidecar_pages)
+
+        hits_by_id = {}
+        for query_body in query_bodies:
             if self.limit_results and len(results['hits']['hits']) > self.elasticsearch_terminate_after:
                 break
-
-            inner_hits_sample = hit['inner_hits']['sample']['hits']['hits']
-            sample_data = extract_sample_inner_hits_as_array(inner_hits_sample)
-            tmp_results = hit.copy()
-            tmp_results['_source']['sample'] = sample_data
-            tmp_results['inner_hits'].pop('sample')
-            results['hits']['hits'].append(tmp_results)
-            count += 1
+            for hit in helpers.scan(
+                    es,
+                    query=query_body,
+                    scroll=u'5m',
+                    size=1000,
+                    preserve_order=False,
+                    doc_type = '_doc',
+                    index=self.dataset_obj.es_index_name,
+                    routing=get_routing(self.dataset_obj, query_body)):
+
+                inner_hits_sample = hit['inner_hits']['sample']['hits']['hits']
+                sample_data = extract_sample_inner_hits_as_array(inner_hits_sample)
+                if hit['_id'] in hits_by_id:
+                    hits_by_id[hit['_id']]['_source']['sample'].extend(sample_data)
+                    continue
+
+                if self.limit_results and len(results['hits']['hits']) > self.elasticsearch_terminate_after:
+                    break
+
+                tmp_results = hit.copy()
+                tmp_results['_source']['sample'] = sample_data
+                tmp_results['inner_hits'].pop('sample')
+                results['hits']['hits'].append(tmp_results)
+                hits_by_id[hit['_id']] = tmp_results
         elapsped_time = int((datetime.datetime.now() - start_time).total_seconds() * 1000)
 
         results['took'] = elapsped_time
-        results['hits']['total'] = count
+        results['hits']['total'] = len(results['hits']['hits'])
 
         return results
 
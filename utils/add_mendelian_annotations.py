@@ -395,6 +395,8 @@ import pprint
 import json
 from natsort import natsorted
 
+from annotation_writer import AnnotationWriter
+
 
 def is_autosomal_dominant(sample_information):
 
@@ -634,26 +636,46 @@ def get_family_dict(es, index_name):
 
     family_ids = get_values_from_es(es, index_name, 'Family_ID', 'sample')
 
-    family_dict = {}
-
+    # the child of a family is the smallest Sample_ID with both parents, the same one load_vcf.py labels while parsing (ped_probands)
+    # the query keeps the aggregation to the variants of the family's children
     body_template = """
           {
-           "_source": false,
-           "size": 1,
+           "size": 0,
            "query": {
                "nested": {
                    "path": "sample",
                    "score_mode": "none",
                    "query": {
                        "bool": {
-                            "must" : [{"term": { "sample.Family_ID": "%s"}},
-                                      {"exists": { "field": "sample.Father_ID"}},
-                                      {"exists": { "field": "sample.Mother_ID"}}
-                            ]
-
-                        }
-                   },
-                   "inner_hits": {}
+                           "filter" : [{"term": { "sample.Family_ID": "%s"}},
+                                       {"exists": { "field": "sample.Father_ID"}},
+                                       {"exists": { "field": "sample.Mother_ID"}}
+                           ]
+                       }
+                   }
+               }
+           },
+           "aggs": {
+               "sample": {
+                   "nested": {"path": "sample"},
+                   "aggs": {
+                       "family": {
+                           "filter": {
+                               "bool": {
+                                    "filter" : [{"term": { "sample.Family_ID": "%s"}},
+                                                {"exists": { "field": "sample.Father_ID"}},
+                                                {"exists": { "field": "sample.Mother_ID"}}
+                                    ]
+                                }
+                           },
+                           "aggs": {
+                               "child": {
+                                   "terms": {"field": "sample.Sample_ID", "size": 1, "order": {"_key": "asc"}},
+                                   "aggs": {"info": {"top_hits": {"size": 1}}}
+                               }
+                           }
+                       }
+                   }
                }
            }
         }
@@ -661,10 +683,13 @@ def get_family_dict(es, index_name):
     family_dict = {}
     for family_id in family_ids:
 
-        body = body_template % (family_id)
+        body = body_template % (family_id, family_id)
         results = es.search(index=index_name, body=body, request_timeout=120)
 
-        result = results['hits']['hits'][0]['inner_hits']['sample']['hits']['hits'][0]["_source"]
+        buckets = results['aggregations']['sample']['family']['child']['buckets']
+        if not buckets:
+            continue
+        result = buckets[0]['info']['hits']['hits'][0]["_source"]
         father_id = result.get('Father_ID')
         mother_id = result.get('Mother_ID')
         child_id = result.get('Sample_ID')
@@ -675,6 +700,13 @@ def get_family_dict(es, index_name):
     return family_dict
 
 
+def routing_meta(routing):
+    """Bulk meta data sending an update to the shard of a document indexed with custom routing, i.e. load_vcf.py --route_by_chrom"""
+    if routing is None:
+        return {}
+    return {'_routing': routing}
+
+
 def pop_sample_with_id(sample_array, sample_id):
 
     saved_index = 0
@@ -737,91 +769,19 @@ def are_variants_compound_heterozygous(variants):
         return False
 
 
-def annotate_autosomal_recessive(es, index_name,family_dict, annotation):
-
-    sample_matched = []
-    for family_id, family in family_dict.items():
-        count = 0
-        actions = []
-        child_id = family.get('child_id')
-        # print(child_id)
-        if annotation == 'vep':
-            query_body = autosomal_recessive_vep_query_body_template % (child_id)
-        elif annotation == 'annovar':
-            query_body = autosomal_recessive_annovar_query_body_template % (child_id)
-        # print(query_body)
-        query_body = json.loads(query_body)
-        for hit in helpers.scan(
-                es,
-                query=query_body,
-                scroll=u'5m',
-                size=1000,
-                preserve_order=False,
-                index=index_name):
-
-            es_id = hit['_id']
-            sample_array = hit["_source"]["sample"]
-            sample = pop_sample_with_id(sample_array, child_id)
-            tmp_id = es_id + child_id
-            mendelian_diseases = sample.get('mendelian_diseases', [])
-            if 'autosomal_recessive' in mendelian_diseases:
-                if tmp_id not in sample_matched:
-                    sample_matched.append(tmp_id)
-                continue
-
-            to_update = False
-            if mendelian_diseases:
-                if 'autosomal_recessive' not in mendelian_diseases:
-                    mendelian_diseases.append('autosomal_recessive')
-                    to_update = True
-            else:
-                to_update = True
-                sample['mendelian_diseases'] = ['autosomal_recessive']
-
-
-            if tmp_id not in sample_matched:
-                sample_matched.append(tmp_id)
-
-            if to_update:
-                sample_array.append(sample)
-                action = {
-                    "_index": index_name,
-                    '_op_type': 'update',
-                    "_id": es_id,
-                    "doc": {
-                        "sample": sample_array
-                    }
-                }
-                count += 1
-
-                actions.append(action)
-
-
-            if count % 500 == 0:
-                helpers.bulk(es, actions, refresh=True)
-                actions = []
-
-        helpers.bulk(es, actions, refresh=True)
-        es.indices.refresh(index_name)
-        es.cluster.health(wait_for_no_relocating_shards=True)
-
-
-    print('Found {} autosomal_recessive samples'.format(len(list(set(sample_matched)))))
+def annotate_families(es, index_name, family_dict, model, make_query, is_match=None, writer=None):
+    """Label model on the child of every family in the variants make_query(child_id) finds and is_match(sample) accepts.
 
+    Families run concurrently on writer, the labels are sent in batches without
+    refresh. Without a writer of the caller one is made and finished here.
+    """
+    own_writer = writer is None
+    if own_writer:
+        writer = AnnotationWriter(es, index_name)
 
-def annotate_denovo(es, index_name, family_dict):
-
-
-    sample_matched = []
-
-    for family_id, family in family_dict.items():
-        count = 0
-        actions = []
+    def annotate_family(family):
         child_id = family.get('child_id')
-        # print(child_id)
-        query_body = denovo_query_body_template % (child_id)
-        # print(query_body)
-        query_body = json.loads(query_body)
+        query_body = json.loads(make_query(child_id))
         for hit in helpers.scan(
                 es,
                 query=query_body,
@@ -831,403 +791,89 @@ def annotate_denovo(es, index_name, family_dict):
                 index=index_name):
 
             es_id = hit['_id']
-            sample_array = hit["_source"]["sample"]
-            sample = pop_sample_with_id(sample_array, child_id)
-            tmp_id = es_id + child_id
-            mendelian_diseases = sample.get('mendelian_diseases', [])
-            if 'denovo' in mendelian_diseases:
-                if tmp_id not in sample_matched:
-                    sample_matched.append(tmp_id)
-                continue
-            to_update = False
-            if mendelian_diseases:
-                if 'denovo' not in mendelian_diseases:
-                    mendelian_diseases.append('denovo')
-                    print(es_id, mendelian_diseases)
-                    to_update = True
-            else:
-                sample['mendelian_diseases'] = ['denovo']
-                to_update = True
-
-            if tmp_id not in sample_matched:
-                sample_matched.append(tmp_id)
-
-            if to_update:
-                sample_array.append(sample)
-                action = {
-                    "_index": index_name,
-                    '_op_type': 'update',
-                    "_id": es_id,
-                    "doc": {
-                        "sample": sample_array
-                    }
-                }
-                count += 1
-
-                actions.append(action)
-
-
-            if count % 500 == 0:
-                helpers.bulk(es, actions, refresh=True)
-                actions = []
-
-        helpers.bulk(es, actions, refresh=True)
-        es.indices.refresh(index_name)
-        es.cluster.health(wait_for_no_relocating_shards=True)
+            sample = pop_sample_with_id(hit["_source"]["sample"], child_id)
+            if model in sample.get('mendelian_diseases', []):
+                writer.match(model, es_id + child_id)
+            elif is_match is None or is_match(sample):
+                writer.match(model, es_id + child_id)
+                writer.label(es_id, hit.get('_routing'), child_id, model)
 
+    writer.map_families(annotate_family, family_dict)
+    writer.flush()
+    if own_writer:
+        writer.finish()
 
-    print('Found {} denovo samples'.format(len(list(set(sample_matched)))))
 
+def annotate_autosomal_recessive(es, index_name, family_dict, annotation, writer=None):
+    if annotation == 'vep':
+        template = autosomal_recessive_vep_query_body_template
+    elif annotation == 'annovar':
+        template = autosomal_recessive_annovar_query_body_template
 
-def annotate_autosomal_dominant(es, index_name, family_dict):
+    annotate_families(es, index_name, family_dict, 'autosomal_recessive', lambda child_id: template % (child_id), writer=writer)
 
 
-    sample_matched = []
-
-    for family_id, family in family_dict.items():
-        count = 0
-        actions = []
-        child_id = family.get('child_id')
-        # print(child_id)
-        query_body = autosomal_dominant_query_body_template % (child_id)
-        # print(query_body)
-        query_body = json.loads(query_body)
-        for hit in helpers.scan(
-                es,
-                query=query_body,
-                scroll=u'5m',
-                size=1000,
-                preserve_order=False,
-                index=index_name):
-            # pprint.pprint(hit["_source"])
-            es_id = hit['_id']
-            sample_array = hit["_source"]["sample"]
-            sample = pop_sample_with_id(sample_array, child_id)
-            mendelian_diseases = sample.get('mendelian_diseases', [])
-            tmp_id = es_id + child_id
-            if 'autosomal_dominant' in mendelian_diseases:
-                if tmp_id not in sample_matched:
-                    sample_matched.append(tmp_id)
-                continue
-
-            if is_autosomal_dominant(sample):
-                to_update = False
-                if mendelian_diseases:
-                    if 'autosomal_dominant' not in mendelian_diseases:
-                        mendelian_diseases.append('autosomal_dominant')
-                        print(es_id, mendelian_diseases)
-                        to_update = True
-                else:
-                    sample['mendelian_diseases'] = ['autosomal_dominant']
-                    to_update = True
-
-
-                if tmp_id not in sample_matched:
-                    sample_matched.append(tmp_id)
-                if to_update:
-                    sample_array.append(sample)
-                    action = {
-                        "_index": index_name,
-                        '_op_type': 'update',
-                        "_id": es_id,
-                        "doc": {
-                            "sample": sample_array
-                        }
-                    }
-                    count += 1
-
-                    actions.append(action)
+def annotate_denovo(es, index_name, family_dict, writer=None):
+    annotate_families(es, index_name, family_dict, 'denovo', lambda child_id: denovo_query_body_template % (child_id), writer=writer)
 
 
-                if count % 500 == 0:
-                    helpers.bulk(es, actions, refresh=True)
-                    actions = []
-
-        helpers.bulk(es, actions, refresh=True)
-        es.indices.refresh(index_name)
-        es.cluster.health(wait_for_no_relocating_shards=True)
-
-
-    print('Found {} autosomal dominant samples'.format(len(list(set(sample_matched)))))
+def annotate_autosomal_dominant(es, index_name, family_dict, writer=None):
+    annotate_families(es, index_name, family_dict, 'autosomal_dominant', lambda child_id: autosomal_dominant_query_body_template % (child_id),
+                      is_autosomal_dominant, writer)
 
 
 range_rules = {
     'hg19/GRCh37': ([60001, 2699520], [154931044, 155260560]),
     'hg38/GRCh38': ([10001, 2781479], [155701383, 156030895])
 }
-24, 382, 427
-
-
-def annotate_x_linked_dominant(es, index_name, family_dict):
-
-
-    sample_matched = []
-    for family_id, family in family_dict.items():
-        count = 0
-        actions = []
-        child_id = family.get('child_id')
-        # print(child_id)
-        query_body = x_linked_dominant_query_body_template % (
-            child_id,
-            range_rules['hg19/GRCh37'][0][0],
-            range_rules['hg19/GRCh37'][0][1],
-            range_rules['hg19/GRCh37'][1][0],
-            range_rules['hg19/GRCh37'][1][1])
-        # print(query_body)
-        query_body = json.loads(query_body)
-        for hit in helpers.scan(
-                es,
-                query=query_body,
-                scroll=u'5m',
-                size=1000,
-                preserve_order=False,
-                index=index_name):
-            # pprint.pprint(hit["_source"])
-            es_id = hit['_id']
-            # print(es_id)
-            sample_array = hit["_source"]["sample"]
-            sample = pop_sample_with_id(sample_array, child_id)
-            tmp_id = es_id + child_id
-            mendelian_diseases = sample.get('mendelian_diseases', [])
-
-            if 'x_linked_dominant' in mendelian_diseases:
-                if tmp_id not in sample_matched:
-                    sample_matched.append(tmp_id)
-                continue
-
-            if is_x_linked_dominant(sample):
-                to_update = False
-                if mendelian_diseases:
-                    if 'x_linked_dominant' not in mendelian_diseases:
-                        mendelian_diseases.append('x_linked_dominant')
-                        print(es_id, mendelian_diseases)
-                        to_update = True
-                else:
-                    sample['mendelian_diseases'] = ['x_linked_dominant']
-                    to_update = True
-
-
-                if tmp_id not in sample_matched:
-                    sample_matched.append(tmp_id)
-
-                if to_update:
-                    sample_array.append(sample)
-                    action = {
-                        "_index": index_name,
-                        '_op_type': 'update',
-                        "_id": es_id,
-                        "doc": {
-                            "sample": sample_array
-                        }
-                    }
-                    count += 1
-
-                    actions.append(action)
-
-
-                if count % 500 == 0:
-                    helpers.bulk(es, actions, refresh=True)
-                    actions = []
-
-        helpers.bulk(es, actions, refresh=True)
-        es.indices.refresh(index_name)
-        es.cluster.health(wait_for_no_relocating_shards=True)
-
-
-    print('Found {} x_linked_dominant samples'.format(len(list(set(sample_matched)))))
-
-
-def annotate_x_linked_recessive(es, index_name, family_dict, annotation):
-
-
-    sample_matched = []
-
-    for family_id, family in family_dict.items():
-        count = 0
-        actions = []
-        child_id = family.get('child_id')
-        # print(child_id)
-        if annotation == 'vep':
-            query_body = x_linked_recessive_vep_query_body_template % (
-                child_id,
-                range_rules['hg19/GRCh37'][0][0],
-                range_rules['hg19/GRCh37'][0][1],
-                range_rules['hg19/GRCh37'][1][0],
-                range_rules['hg19/GRCh37'][1][1]
-            )
-        elif annotation == 'annovar':
-            query_body = x_linked_recessive_annovar_query_body_template % (
-                child_id,
-                range_rules['hg19/GRCh37'][0][0],
-                range_rules['hg19/GRCh37'][0][1],
-                range_rules['hg19/GRCh37'][1][0],
-                range_rules['hg19/GRCh37'][1][1]
-            )
-
-        # print(query_body)
-        query_body = json.loads(query_body)
-        for hit in helpers.scan(
-                es,
-                query=query_body,
-                scroll=u'5m',
-                size=1000,
-                preserve_order=False,
-                index=index_name):
-            # pprint.pprint(hit["_source"])
-            es_id = hit['_id']
-            sample_array = hit["_source"]["sample"]
-            sample = pop_sample_with_id(sample_array, child_id)
-            tmp_id = es_id + child_id
-            mendelian_diseases = sample.get('mendelian_diseases', [])
-            if 'x_linked_recessive' in mendelian_diseases:
-                if tmp_id not in sample_matched:
-                    sample_matched.append(tmp_id)
-                    continue
-
-            if is_x_linked_recessive(sample):
 
-                # sample['mendelian_diseases'] = 'x_linked_recessive'
-                to_update = False
-                if mendelian_diseases:
-                    if 'x_linked_recessive' not in mendelian_diseases:
-                        mendelian_diseases.append('x_linked_recessive')
-                        print(es_id, mendelian_diseases)
-                        to_update = True
-                else:
-                    sample['mendelian_diseases'] = ['x_linked_recessive']
-                    to_update = True
 
+def x_linked_query(template, child_id):
+    return template % (
+        child_id,
+        range_rules['hg19/GRCh37'][0][0],
+        range_rules['hg19/GRCh37'][0][1],
+        range_rules['hg19/GRCh37'][1][0],
+        range_rules['hg19/GRCh37'][1][1])
 
-                if tmp_id not in sample_matched:
-                    sample_matched.append(tmp_id)
-
-
-                if to_update:
-                    sample_array.append(sample)
-                    action = {
-                        "_index": index_name,
-                        '_op_type': 'update',
-                        "_id": es_id,
-                        "doc": {
-                            "sample": sample_array
-                        }
-                    }
-                    count += 1
 
-                    actions.append(action)
+def annotate_x_linked_dominant(es, index_name, family_dict, writer=None):
+    annotate_families(es, index_name, family_dict, 'x_linked_dominant', lambda child_id: x_linked_query(x_linked_dominant_query_body_template, child_id),
+                      is_x_linked_dominant, writer)
 
 
-                if count % 500 == 0:
-                    helpers.bulk(es, actions, refresh=True)
-                    actions = []
+def annotate_x_linked_recessive(es, index_name, family_dict, annotation, writer=None):
+    if annotation == 'vep':
+        template = x_linked_recessive_vep_query_body_template
+    elif annotation == 'annovar':
+        template = x_linked_recessive_annovar_query_body_template
 
-        helpers.bulk(es, actions, refresh=True)
-        es.indices.refresh(index_name)
-        es.cluster.health(wait_for_no_relocating_shards=True)
+    annotate_families(es, index_name, family_dict, 'x_linked_recessive', lambda child_id: x_linked_query(template, child_id),
+                      is_x_linked_recessive, writer)
 
-    print('Found {} x_linked_recessive samples'.format(len(list(set(sample_matched)))))
 
+def annotate_x_linked_denovo(es, index_name, family_dict, writer=None):
+    annotate_families(es, index_name, family_dict, 'x_linked_denovo', lambda child_id: x_linked_query(x_linked_de_novo_query_body_template, child_id),
+                      is_x_linked_denovo, writer)
 
-def annotate_x_linked_denovo(es, index_name, family_dict):
 
+def annotate_compound_heterozygous(es, index_name, family_dict, annotation, writer=None):
+    own_writer = writer is None
+    if own_writer:
+        writer = AnnotationWriter(es, index_name)
 
+    # the same for every family
+    if annotation == 'vep':
+        genes = get_vep_genes_from_es_for_compound_heterozygous(es, index_name)
+        template = compound_heterozygous_vep_query_body_template
+    elif annotation == 'annovar':
+        genes = get_annovar_genes_from_es_for_compound_heterozygous(es, index_name)
+        template = compound_heterozygous_annovar_query_body_template
 
-    sample_matched = []
-    for family_id, family in family_dict.items():
-        count = 0
-        actions = []
+    def annotate_family(family):
         child_id = family.get('child_id')
-        # print(child_id)
-        query_body = x_linked_de_novo_query_body_template % (
-            child_id,
-            range_rules['hg19/GRCh37'][0][0],
-            range_rules['hg19/GRCh37'][0][1],
-            range_rules['hg19/GRCh37'][1][0],
-            range_rules['hg19/GRCh37'][1][1])
-        # print(query_body)
-        query_body = json.loads(query_body)
-        for hit in helpers.scan(
-                es,
-                query=query_body,
-                scroll=u'5m',
-                size=1000,
-                preserve_order=False,
-                index=index_name):
-            # pprint.pprint(hit["_source"])
-            es_id = hit['_id']
-
-            sample_array = hit["_source"]["sample"]
-            sample = pop_sample_with_id(sample_array, child_id)
-
-            tmp_id = es_id + child_id
-            mendelian_diseases = sample.get('mendelian_diseases', [])
-            if 'x_linked_denovo' in mendelian_diseases:
-                if tmp_id not in sample_matched:
-                    sample_matched.append(tmp_id)
-                continue
-
-            if is_x_linked_denovo(sample):
-                mendelian_diseases = sample.get('mendelian_diseases')
-                to_update = False
-                if mendelian_diseases:
-                    if 'x_linked_denovo' not in mendelian_diseases:
-                        mendelian_diseases.append('x_linked_denovo')
-                        print(type(mendelian_diseases), es_id, mendelian_diseases)
-                        to_update = True
-                else:
-                    sample['mendelian_diseases'] = ['x_linked_denovo']
-                    to_update = True
-
-
-                tmp_id = es_id + child_id
-                if tmp_id not in sample_matched:
-                    sample_matched.append(tmp_id)
-
-                if to_update:
-                    sample_array.append(sample)
-                    action = {
-                        "_index": index_name,
-                        '_op_type': 'update',
-                        "_id": es_id,
-                        "doc": {
-                            "sample": sample_array
-                        }
-                    }
-                    count += 1
-
-                    actions.append(action)
-
-
-                if count % 500 == 0:
-                    helpers.bulk(es, actions, refresh=True)
-                    actions = []
-
-        helpers.bulk(es, actions, refresh=True)
-        es.indices.refresh(index_name)
-        es.cluster.health(wait_for_no_relocating_shards=True)
-
-
-    print('Found {} x_linked_denovo samples'.format(len(list(set(sample_matched)))))
-
-
-def annotate_compound_heterozygous(es, index_name, family_dict, annotation):
-
-
-    sample_matched = []
-    for family_id, family in family_dict.items():
-        child_id = family.get('child_id')
-        if annotation == 'vep':
-            genes = get_vep_genes_from_es_for_compound_heterozygous(es, index_name)
-        elif annotation == 'annovar':
-            genes = get_annovar_genes_from_es_for_compound_heterozygous(es, index_name)
-
         for gene in genes:
-
-            if annotation == 'vep':
-                query_body = compound_heterozygous_vep_query_body_template % (child_id, gene)
-            elif annotation == 'annovar':
-                query_body = compound_heterozygous_annovar_query_body_template % (child_id, gene)
-            query_body = json.loads(query_body)
+            query_body = json.loads(template % (child_id, gene))
             samples = []
             for hit in helpers.scan(
                     es,
@@ -1237,74 +883,23 @@ def annotate_compound_heterozygous(es, index_name, family_dict, annotation):
                     preserve_order=False,
                     index=index_name):
 
-                es_id = hit['_id']
-                sample_array = hit["_source"]["sample"]
-
-                sample = pop_sample_with_id_apply_compound_het_rules(sample_array, child_id)
-
+                sample = pop_sample_with_id_apply_compound_het_rules(hit["_source"]["sample"], child_id)
                 if not sample:
                     continue
 
-                sample.update({'es_id': es_id})
+                sample.update({'es_id': hit['_id'], 'es_routing': hit.get('_routing')})
                 samples.append(sample)
 
-            actions = []
-            count = 0
             if len(samples) > 1 and are_variants_compound_heterozygous(samples):
-
                 for sample in samples:
-                    es_id = sample.pop("es_id")
-
-                    es_document = es.get(index_name, es_id)
-                    sample_array = es_document["_source"]["sample"]
-                    sample = pop_sample_with_id(sample_array, child_id)
-
-
-                    mendelian_diseases = sample.get('mendelian_diseases', [])
-                    tmp_id = es_id + child_id
-                    if 'compound_heterozygous' in mendelian_diseases:
-                        if tmp_id not in sample_matched:
-                            sample_matched.append(tmp_id)
-                        continue
-
-                    to_update = False
-                    if mendelian_diseases:
-                        if 'compound_heterozygous' not in mendelian_diseases:
-                            mendelian_diseases.append('compound_heterozygous')
-                            print(es_id, mendelian_diseases)
-                            to_update = True
-                    else:
-                        sample['mendelian_diseases'] = ['compound_heterozygous']
-                        to_update = True
-
-                    if tmp_id not in sample_matched:
-                        sample_matched.append(tmp_id)
-
-                    if to_update:
-                        sample_array.append(sample)
-                        action = {
-                            "_index": index_name,
-                            '_op_type': 'update',
-                            "_id": es_id,
-                            "doc": {
-                                "sample": sample_array
-                            }
-                        }
-                        count += 1
-
-                        actions.append(action)
-
-
-                    if count % 500 == 0:
-                        helpers.bulk(es, actions, refresh=True)
-                        actions = []
+                    writer.match('compound_heterozygous', sample['es_id'] + child_id)
+                    if 'compound_heterozygous' not in sample.get('mendelian_diseases', []):
+                        writer.label(sample['es_id'], sample['es_routing'], child_id, 'compound_heterozygous')
 
-                helpers.bulk(es, actions, refresh=True)
-                es.indices.refresh(index_name)
-                es.cluster.health(wait_for_no_relocating_shards=True)
-
-
-    print('Found {} compound_heterozygous samples'.format(len(list(set(sample_matched)))))
+    writer.map_families(annotate_family, family_dict)
+    writer.flush()
+    if own_writer:
+        writer.finish()
 
 
 def main():
@@ -1319,42 +914,23 @@ def main():
 
     all_start_time = datetime.datetime.now()
 
-    start_time = datetime.datetime.now()
-    print('Starting annotate_autosomal_recessive', start_time)
-    annotate_autosomal_recessive(es, index_name, family_dict, annotation)
-    print('Finished annotate_autosomal_recessive', int((datetime.datetime.now() - start_time).total_seconds()), 'seconds')
+    # imported here, mendelian_engine uses the predicates of this module
+    from mendelian_engine import annotate_mendelian, annotate_compound_het
+    writer = AnnotationWriter(es, index_name)
 
     start_time = datetime.datetime.now()
-    print('Starting annotate_denovo', start_time)
-    annotate_denovo(es, index_name,  family_dict)
-    print('Finished annotate_denovo', int((datetime.datetime.now() - start_time).total_seconds()), 'seconds')
+    print('Starting annotate_mendelian', start_time)
+    annotate_mendelian(es, index_name, family_dict, annotation, writer=writer)
+    print('Finished annotate_mendelian', int((datetime.datetime.now() - start_time).total_seconds()), 'seconds')
 
     start_time = datetime.datetime.now()
-    print('Starting annotate_autosomal_dominant', start_time)
-    annotate_autosomal_dominant(es, index_name, family_dict)
-    print('Finished annotate_autosomal_dominant', int((datetime.datetime.now() - start_time).total_seconds()), 'seconds')
-
-    start_time = datetime.datetime.now()
-    print('Starting annotate_x_linked_dominant', start_time)
-    annotate_x_linked_dominant(es, index_name, family_dict)
-    print('Finished annotate_x_linked_dominant', int((datetime.datetime.now() - start_time).total_seconds()), 'seconds')
-
-    start_time = datetime.datetime.now()
-    print('Starting annotate_x_linked_recessive', start_time)
-    annotate_x_linked_recessive(es, index_name, family_dict, annotation)
-    print('Finished annotate_x_linked_recessive', int((datetime.datetime.now() - start_time).total_seconds()), 'seconds')
-
-    start_time = datetime.datetime.now()
-    print('Starting annotate_x_linked_denovo', start_time)
-    annotate_x_linked_denovo(es, index_name, family_dict)
-    print('Finished annotate_x_linked_denovo', int((datetime.datetime.now() - start_time).total_seconds()), 'seconds')
-
-    start_time = datetime.datetime.now()
-    print('Starting annotate_compound_heterozygous', start_time)
-    annotate_compound_heterozygous(es, index_name, family_dict, annotation)
-    print('Finished annotate_compound_heterozygous', int(
+    print('Starting annotate_compound_het', start_time)
+    annotate_compound_het(es, index_name, family_dict, annotation, writer=writer)
+    print('Finished annotate_compound_het', int(
         (datetime.datetime.now() - start_time).total_seconds()), 'seconds')
 
+    writer.finish()
+
     print('Finished annotating all in ', int((datetime.datetime.now() - all_start_time).total_seconds()), 'seconds')
 
 
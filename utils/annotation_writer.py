@@ -0,0 +1,125 @@
+"""Bulk writer shared by the mendelian annotation passes.
+
+Label updates are batched and sent without refresh=True. Nothing is
+refreshed or waited for between batches, families or models: finish() does
+one refresh of the labelled index and one cluster health check after the
+last pass, and prints how many samples each model annotated.
+
+Families are annotated by a bounded pool of threads (map_families). Their
+labels are added by a stored script to the matching Sample_ID entry of the
+current document, so concurrent families labelling the same variant, or a
+scan that does not see an unrefreshed label yet, never overwrite each
+other's labels.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import helpers
+
+
+LABEL_SCRIPT_ID = 'genesysv_add_mendelian_labels'
+# params.labels: {Sample_ID: [model, ...]}, a noop if every label is there already
+ADD_LABELS_SCRIPT = """
+boolean changed = false;
+for (s in ctx._source.sample) {
+  List labels = params.labels.get(s.Sample_ID);
+  if (labels == null) { continue; }
+  if (s.mendelian_diseases == null) { s.mendelian_diseases = new ArrayList(); }
+  for (label in labels) {
+    if (!s.mendelian_diseases.contains(label)) { s.mendelian_diseases.add(label); changed = true; }
+  }
+}
+if (!changed) { ctx.op = 'none'; }
+"""
+
+
+def put_label_script(es):
+    es.put_script(id=LABEL_SCRIPT_ID, body={"script": {"lang": "painless", "source": ADD_LABELS_SCRIPT}})
+
+
+def script_label_action(index_name, es_id, routing, labels):
+    """Update adding labels, {Sample_ID: [model, ...]}, to a document with the stored label script"""
+    action = {
+        "_index": index_name,
+        '_op_type': 'update',
+        "_id": es_id,
+        # concurrent labels of the same variant are applied one after the other
+        '_retry_on_conflict': 3,
+        "script": {"id": LABEL_SCRIPT_ID, "params": {"labels": labels}}
+    }
+    if routing is not None:
+        action['_routing'] = routing
+    return action
+
+
+class AnnotationWriter:
+
+    def __init__(self, es, index_name, chunk_size=500, max_workers=4):
+        self.es = es
+        self.index_name = index_name # where the labels are written, refreshed by finish()
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+
+        self.lock = threading.Lock()
+        self.actions = []
+        self.matched = OrderedDict() # model -> es_id + child_id of the annotated samples
+        self.num_updates = 0
+        self.script_stored = False
+
+    def matched_samples(self, model):
+        with self.lock:
+            return self.matched.setdefault(model, set())
+
+    def match(self, model, match_id):
+        with self.lock:
+            self.matched.setdefault(model, set()).add(match_id)
+
+    def label(self, es_id, routing, child_id, model):
+        """Add model to the child's entry of the document with the stored label script"""
+        with self.lock:
+            if not self.script_stored:
+                put_label_script(self.es)
+                self.script_stored = True
+        self.add(script_label_action(self.index_name, es_id, routing, {child_id: [model]}))
+
+    def add(self, action):
+        with self.lock:
+            self.actions.append(action)
+            if len(self.actions) < self.chunk_size:
+                return
+            actions, self.actions = self.actions, []
+        self._send(actions)
+
+    def add_many(self, actions):
+        for action in actions:
+            self.add(action)
+
+    def flush(self):
+        """Send what is batched, without refreshing"""
+        with self.lock:
+            actions, self.actions = self.actions, []
+        self._send(actions)
+
+    def _send(self, actions):
+        if not actions:
+            return
+        helpers.bulk(self.es, actions, chunk_size=self.chunk_size)
+        with self.lock:
+            self.num_updates += len(actions)
+
+    def map_families(self, annotate_family, family_dict):
+        """Run annotate_family(family) for every family of family_dict, max_workers at a time"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # list() re-raises the first exception of a family
+            list(executor.map(annotate_family, family_dict.values()))
+
+    def finish(self):
+        """Send the rest, refresh and wait for the cluster once, and report the annotated samples per model"""
+        self.flush()
+        self.es.indices.refresh(index=self.index_name)
+        self.es.cluster.health(wait_for_no_relocating_shards=True)
+
+        for model, matched in self.matched.items():
+            print('Found {} {} samples'.format(len(matched), model))
+        print('Annotated {} samples in {} updates'.format(sum(len(matched) for matched in self.matched.values()), self.num_updates))
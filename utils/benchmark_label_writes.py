@@ -0,0 +1,81 @@
+"""Compare the bytes written per labelled variant by the label writes of mendelian_engine.py.
+
+For each way of writing a label (--label_write of load_vcf.py) two sizes are
+reported per labelled variant:
+
+- request: the bulk lines sent to Elasticsearch
+- reindexed: the source Elasticsearch writes again. An update, scripted or
+  not, reindexes the whole document with all its nested sample documents,
+  a side-car label is a new small document and leaves the variant alone
+
+'doc' also has to read the sample array back first when the labels do not
+come from a scan of the documents (compound heterozygous), that read is
+counted with its request.
+
+Documents are read from a chunk file written by load_vcf.py (--input), or
+generated with a shape similar to a VEP annotated variant (--num_docs).
+"""
+import argparse
+import copy
+import json
+
+from elasticsearch import helpers
+
+from benchmark_serialization import make_docs, read_docs
+from mendelian_engine import LABEL_WRITES, add_label, iter_label_actions
+
+
+def encoded_size(data):
+    return len(json.dumps(data, separators=(',', ':')).encode('utf-8')) + 1
+
+
+def bulk_size(action):
+    # the action and source lines the bulk helper sends for action
+    meta, body = helpers.expand_action(copy.deepcopy(action))
+    return encoded_size(meta) + (encoded_size(body) if body is not None else 0)
+
+
+def measure(docs, write, model, labels_per_variant):
+    request = 0
+    reindexed = 0
+    for i, doc in enumerate(docs):
+        es_id = 'variant_%d' % i
+        doc = copy.deepcopy(doc)
+        labelled = doc['sample'][:labels_per_variant]
+        for sample in labelled:
+            add_label(sample, model)
+        labels = {sample['Sample_ID']: [model] for sample in labelled}
+
+        actions = list(iter_label_actions('benchmark', es_id, None, labels, doc['sample'], write))
+        request += sum(bulk_size(action) for action in actions)
+        if write == 'sidecar':
+            reindexed += sum(encoded_size(action['_source']) for action in actions)
+        else:
+            reindexed += encoded_size(doc)
+        if write == 'doc' and model == 'compound_heterozygous':
+            request += encoded_size({'_source': {'sample': doc['sample']}})
+
+    return request / len(docs), reindexed / len(docs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="Intermediate chunk file written by load_vcf.py. Synthetic documents are used if not given")
+    parser.add_argument("--num_docs", type=int, default=200, help="Number of synthetic documents")
+    parser.add_argument("--num_samples", type=int, default=1000, help="Carrier samples per synthetic document")
+    parser.add_argument("--num_transcripts", type=int, default=5, help="CSQ transcripts per synthetic document")
+    parser.add_argument("--labels_per_variant", type=int, default=1, help="Samples labelled per variant")
+    args = parser.parse_args()
+
+    if args.input:
+        docs = [doc for doc in read_docs(args.input) if doc.get('sample')]
+    else:
+        docs = make_docs(args.num_docs, args.num_samples, args.num_transcripts)
+
+    print("%d documents, %.1f samples per document, %d labelled per variant" % (
+        len(docs), sum(len(doc['sample']) for doc in docs) / len(docs), args.labels_per_variant))
+    print("%-10s %-22s %16s %16s" % ('Write', 'Model', 'Request bytes', 'Reindexed bytes'))
+    for model in ['denovo', 'compound_heterozygous']:
+        for write in LABEL_WRITES:
+            request, reindexed = measure(docs, write, model, args.labels_per_variant)
+            print("%-10s %-22s %16.0f %16.0f" % (write, model, request, reindexed))
@@ -0,0 +1,112 @@
+"""Compare the old stdlib json round trip of load_vcf.py with encoding documents once with fast_json.
+
+Old path: json.dump each action into a text chunk file, json.loads every line
+back and let the bulk helper serialize action and source again.
+New path: encode each document once into NDJSON bulk lines and join the
+lines of the chunk file into bulk bodies without decoding them.
+
+Documents are read from a chunk file written by load_vcf.py (--input), or
+generated with a shape similar to a VEP annotated variant (--num_docs).
+"""
+import argparse
+import io
+import json
+import random
+import time
+
+import fast_json
+
+
+def make_docs(num_docs, num_samples, num_transcripts):
+    random.seed(1)
+    docs = []
+    for i in range(num_docs):
+        doc = {
+            'Variant': '1_%d_A_G' % (i + 1), 'CHROM': '1', 'POS': i + 1, 'ID': 'rs%d' % i, 'REF': 'A', 'ALT': 'G',
+            'dbSNP_ID': 'rs%d' % i, 'QUAL': random.random() * 1000, 'FILTER': 'PASS', 'VariantType': 'SNV',
+            'AC': random.randint(1, 100), 'AF': random.random(), 'AN': 2000, 'DP': random.randint(100, 9000),
+            'gnomAD_AF': random.random(), 'MAX_AF': random.random(), 'CLIN_SIG': ['benign', 'likely_benign'],
+        }
+        doc['CSQ_nested'] = [{'Allele': 'G', 'Consequence': ['missense_variant', 'splice_region_variant'], 'SYMBOL': 'GENE%d' % j,
+                              'Feature': 'ENST%011d' % j, 'SIFT_pred': 'deleterious', 'SIFT_score': 0.01, 'Protein_position': j} for j in range(num_transcripts)]
+        doc['sample'] = [{'Sample_ID': 'S%04d' % j, 'GT': '0/1', 'AD_ref': random.randint(0, 50), 'AD_alt': random.randint(0, 50),
+                          'DP': random.randint(0, 100), 'GQ': 99.0, 'PL': '0,30,300'} for j in range(num_samples)]
+        docs.append(doc)
+    return docs
+
+
+def read_docs(infile):
+    with open(infile, 'rb') as fp:
+        lines = fp.readlines()
+    return [json.loads(line) for line in lines[1::2]]
+
+
+def old_path(docs, index_name):
+    # writer: json.dump of the whole action into a text chunk file
+    fp = io.StringIO()
+    for doc in docs:
+        json.dump({"_index": index_name, "_type": '_doc', "_source": doc}, fp, ensure_ascii=True)
+        fp.write("\n")
+
+    # indexer: decode every line, then the bulk helper encodes action and source again
+    fp.seek(0)
+    body = []
+    for line in fp:
+        action = json.loads(line)
+        source = action.pop('_source')
+        body.append(json.dumps({'index': action}, ensure_ascii=False, separators=(',', ':')))
+        body.append(json.dumps(source, ensure_ascii=False, separators=(',', ':')))
+    return len("\n".join(body).encode('utf-8'))
+
+
+def new_path(docs, index_name):
+    # writer: encode each document once
+    fp = io.BytesIO()
+    action = fast_json.bulk_action(index_name)
+    for doc in docs:
+        fp.write(fast_json.bulk_item(action, doc))
+
+    # indexer: join lines into bulk bodies as they are
+    fp.seek(0)
+    size = 0
+    lines = []
+    for line in fp:
+        lines.append(line)
+        if len(lines) == 2000:
+            size += len(b''.join(lines))
+            lines = []
+    size += len(b''.join(lines))
+    return size
+
+
+def run(name, func, docs, index_name, repeat):
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        size = func(docs, index_name)
+        elapsed = time.time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-22s %10.1f docs/sec %8.1f MB/sec" % (name, len(docs)/best, size/best/1024/1024))
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="Intermediate chunk file written by load_vcf.py. Synthetic documents are used if not given")
+    parser.add_argument("--num_docs", type=int, default=5000, help="Number of synthetic documents")
+    parser.add_argument("--num_samples", type=int, default=50, help="Carrier samples per synthetic document")
+    parser.add_argument("--num_transcripts", type=int, default=5, help="CSQ transcripts per synthetic document")
+    parser.add_argument("--repeat", type=int, default=3, help="Report the best of this many runs")
+    args = parser.parse_args()
+
+    if args.input:
+        docs = read_docs(args.input)
+    else:
+        docs = make_docs(args.num_docs, args.num_samples, args.num_transcripts)
+
+    print("%d documents, json backends available: %s" % (len(docs), ', '.join(fast_json.available_backends())))
+    baseline = run('stdlib round trip', old_path, docs, 'benchmark', args.repeat)
+    for name in fast_json.available_backends():
+        fast_json.set_backend(name)
+        elapsed = run('encode once (%s)' % name, new_path, docs, 'benchmark', args.repeat)
+        print("%-22s %10.2fx" % ('', baseline/elapsed))
@@ -0,0 +1,207 @@
+"""In-process access to bgzip compressed files, replacing the grabix binary.
+
+A BGZF file is a series of gzip members of at most 64kb each. A position in
+the file is a "virtual offset": the compressed offset of a block shifted left
+by 16 bits, plus the offset of the byte inside the uncompressed block. The
+grabix .gbi index stores the virtual offset of the end of the header, the
+number of data lines and the virtual offset of every 10000th data line.
+"""
+import os
+import struct
+import zlib
+
+
+GRABIX_CHUNK_SIZE = 10000
+
+# ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN
+BGZF_HEADER = struct.Struct('<BBBBIBBH')
+
+
+def read_block(fp):
+    """Read the BGZF block at the current position of fp.
+
+    Returns the uncompressed data and the compressed size of the block, or
+    None at the end of the file.
+    """
+    header = fp.read(BGZF_HEADER.size)
+    if len(header) < BGZF_HEADER.size:
+        return None
+
+    id1, id2, cm, flg, mtime, xfl, os_, xlen = BGZF_HEADER.unpack(header)
+    if id1 != 31 or id2 != 139 or not flg & 4:
+        raise ValueError("Not a BGZF block at offset %d" % (fp.tell() - BGZF_HEADER.size))
+
+    extra = fp.read(xlen)
+    block_size = None
+    pos = 0
+    while pos + 4 <= xlen:
+        si1, si2, slen = struct.unpack_from('<BBH', extra, pos)
+        if si1 == 66 and si2 == 67: # 'BC' subfield holds the total block size - 1
+            block_size = struct.unpack_from('<H', extra, pos + 4)[0] + 1
+        pos += 4 + slen
+
+    if block_size is None:
+        raise ValueError("BGZF block without BSIZE field")
+
+    cdata = fp.read(block_size - BGZF_HEADER.size - xlen - 8)
+    fp.read(8) # CRC32 and ISIZE
+
+    return zlib.decompress(cdata, -15), block_size
+
+
+def is_bgzf(path):
+    """Return True if the file starts with a BGZF block"""
+    try:
+        with open(path, 'rb') as fp:
+            read_block(fp)
+    except (OSError, ValueError, zlib.error, struct.error):
+        return False
+    return True
+
+
+class BgzfReader:
+    """Read lines of a bgzip compressed file from any virtual offset"""
+
+    def __init__(self, path):
+        self.fp = open(path, 'rb')
+        self.block_offset = 0
+        self.next_block_offset = 0
+        self.buffer = b''
+        self.pos = 0
+
+    def _load_block(self, offset):
+        """Load the block at compressed offset, return False at the end of the file"""
+        self.fp.seek(offset)
+        block = read_block(self.fp)
+        self.block_offset = offset
+        self.pos = 0
+        if block is None:
+            self.buffer = b''
+            self.next_block_offset = offset
+            return False
+        self.buffer, block_size = block
+        self.next_block_offset = offset + block_size
+        return True
+
+    def seek(self, virtual_offset):
+        self._load_block(virtual_offset >> 16)
+        self.pos = virtual_offset & 0xffff
+
+    def tell(self):
+        """Virtual offset of the next unread byte"""
+        if self.pos >= len(self.buffer):
+            return self.next_block_offset << 16
+        return (self.block_offset << 16) | self.pos
+
+    def compressed_tell(self):
+        """Compressed offset of the block holding the next unread byte"""
+        return self.tell() >> 16
+
+    def readline(self):
+        """Return the next line including its newline, or b'' at the end of the file"""
+        parts = []
+        while True:
+            if self.pos >= len(self.buffer):
+                # empty blocks, such as the EOF marker, are skipped
+                if not self._load_block(self.next_block_offset):
+                    break
+                continue
+
+            end = self.buffer.find(b'\n', self.pos)
+            if end >= 0:
+                parts.append(self.buffer[self.pos:end + 1])
+                self.pos = end + 1
+                break
+
+            parts.append(self.buffer[self.pos:])
+            self.pos = len(self.buffer)
+
+        return b''.join(parts)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GrabixIndex:
+    """Contents of a grabix .gbi index: header end, number of data lines and per-chunk virtual offsets"""
+
+    def __init__(self, header_end, total_lines, chunk_offsets):
+        self.header_end = header_end
+        self.total_lines = total_lines
+        self.chunk_offsets = chunk_offsets
+
+    @classmethod
+    def load(cls, path):
+        """Load the .gbi index of path, creating it first if it does not exist"""
+        index_file = path + '.gbi'
+        if not os.path.exists(index_file):
+            write_grabix_index(path)
+
+        with open(index_file) as fp:
+            values = [int(line) for line in fp if line.strip()]
+
+        return cls(values[0], values[1], values[2:])
+
+    def chunk_for_line(self, line_number):
+        """Virtual offset of the chunk holding the 1-based data line number, and the first line number of that chunk"""
+        chunk_id = (line_number - 1) // GRABIX_CHUNK_SIZE
+        return self.chunk_offsets[chunk_id], chunk_id * GRABIX_CHUNK_SIZE + 1
+
+
+def write_grabix_index(path):
+    """Create a .gbi index compatible with `grabix index`"""
+    header_end = 0
+    total_lines = 0
+    chunk_offsets = []
+
+    with BgzfReader(path) as reader:
+        while True:
+            offset = reader.tell()
+            line = reader.readline()
+            if not line:
+                break
+            if total_lines == 0 and line.startswith(b'#'):
+                header_end = reader.tell()
+                continue
+            if total_lines % GRABIX_CHUNK_SIZE == 0:
+                chunk_offsets.append(offset)
+            total_lines += 1
+        chunk_offsets.append(reader.tell())
+
+    with open(path + '.gbi', 'w') as fp:
+        fp.write("%d\n%d\n" % (header_end, total_lines))
+        for offset in chunk_offsets:
+            fp.write("%d\n" % offset)
+
+
+def grab_lines(path, start, end, index=None):
+    """Yield data lines start to end (1-based, inclusive, header not counted) as bytes, like `grabix grab` without the header"""
+    if index is None:
+        index = GrabixIndex.load(path)
+
+    end = min(end, index.total_lines)
+    if start > end:
+        return
+
+    chunk_offset, line_number = index.chunk_for_line(start)
+    with BgzfReader(path) as reader:
+        reader.seek(chunk_offset)
+        for line in reader:
+            if line_number > end:
+                return
+            if line_number >= start:
+                yield line
+            line_number += 1
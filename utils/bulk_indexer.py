@@ -0,0 +1,189 @@
+"""Long-lived Elasticsearch bulk indexer that sizes requests by bytes.
+
+Documents are added as encoded bulk items (action line + source line, see
+fast_json.bulk_item) and sent in requests of about batch_bytes. The size is
+adapted to the cluster: it grows while requests take less than target_took
+and shrinks when they take longer or when Elasticsearch rejects requests
+or items with 429 (queue full) or 413 (request too large). Rejected items
+are retried with exponential backoff, split into requests of the shrunk
+size, and items that still fail are written to a dead-letter file that can
+be sent again with the _bulk API.
+
+Requests are sent synchronously in the order items were added, so when
+on_flush is called every item added so far has been acknowledged.
+"""
+import random
+import time
+
+import elasticsearch
+
+import fast_json
+
+
+MB = 1024 * 1024
+
+# request level status codes worth retrying, everything else fails for good
+RETRY_STATUS = (413, 429, 502, 503, 504)
+
+
+class BulkIndexer:
+    """Send bulk items in byte sized requests, adapting the size and retrying rejected items"""
+
+    def __init__(self, es, dead_letter_file, max_bytes=20 * MB, min_bytes=MB // 4, target_took=2000, max_retries=8, backoff=1.0, max_backoff=60.0, on_flush=None, append=False):
+        self.es = es
+        self.dead_letter_file = dead_letter_file
+        self.append = append # keep the failures of an earlier, resumed run
+        self.on_flush = on_flush
+        self.max_bytes = max_bytes
+        self.min_bytes = min(min_bytes, max_bytes)
+        self.batch_bytes = max(self.min_bytes, max_bytes // 4)
+        self.target_took = target_took # milliseconds, as reported by Elasticsearch
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.items = []
+        self.items_bytes = 0
+        self.dead_letter = None
+        self.errors = None
+
+        self.num_indexed = 0
+        self.num_failed = 0
+        self.num_retried = 0
+        self.num_requests = 0
+        self.num_rejected = 0
+
+    def add(self, item):
+        self.items.append(item)
+        self.items_bytes += len(item)
+        if self.items_bytes >= self.batch_bytes:
+            self.flush()
+
+    def add_many(self, items):
+        for item in items:
+            self.add(item)
+
+    def flush(self):
+        items = self.items
+        self.items = []
+        self.items_bytes = 0
+
+        for batch, size in self._split(items):
+            self._send(batch, size)
+
+        if items and self.on_flush is not None:
+            self.on_flush()
+
+    def close(self):
+        self.flush()
+        if self.dead_letter is not None:
+            self.dead_letter.close()
+            self.errors.close()
+
+    def _split(self, items):
+        """Consecutive (batch, size) of at most batch_bytes, at least one item per batch even if it is larger on its own"""
+        start = 0
+        while start < len(items):
+            end = start + 1
+            size = len(items[start])
+            while end < len(items) and size + len(items[end]) <= self.batch_bytes:
+                size += len(items[end])
+                end += 1
+            yield items[start:end], size
+            start = end
+
+    def _resend_smaller(self, batch, attempt):
+        """After a shrink, send batch again as requests of the new batch_bytes, each with a retry budget of its own.
+        False if batch fits into one request as it is"""
+        pieces = list(self._split(batch))
+        if len(pieces) == 1:
+            return False
+        self._sleep(attempt)
+        for piece, size in pieces:
+            self._send(piece, size)
+        return True
+
+    def _shrink(self, factor=0.5):
+        self.batch_bytes = max(self.min_bytes, int(self.batch_bytes * factor))
+
+    def _adapt(self, took, size):
+        """Scale the request size towards target_took, by at most a factor of 2 per request"""
+        if size < self.batch_bytes / 2:
+            # a short tail request says nothing about what a full one costs
+            return
+        factor = min(2.0, max(0.5, self.target_took / max(took, 1)))
+        self.batch_bytes = min(self.max_bytes, max(self.min_bytes, int(self.batch_bytes * factor)))
+
+    def _sleep(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def _send(self, batch, size):
+        attempt = 0
+        while batch:
+            if attempt:
+                self._sleep(attempt - 1)
+
+            self.num_requests += 1
+            try:
+                response = self.es.bulk(body=b''.join(batch))
+            except elasticsearch.TransportError as e:
+                # connection errors and timeouts have no integer status code and are retried as well
+                status = e.status_code if isinstance(e.status_code, int) else None
+                if (status is not None and status not in RETRY_STATUS) or attempt >= self.max_retries:
+                    self._fail(batch, status, str(e))
+                    return
+                if status in (413, 429):
+                    self.num_rejected += len(batch)
+                    self._shrink()
+                self.num_retried += len(batch)
+                # a request that was too large stays too large, it is split at the shrunk size
+                if status in (413, 429) and self._resend_smaller(batch, attempt):
+                    return
+                attempt += 1
+                continue
+
+            self._adapt(response['took'], size)
+            if not response['errors']:
+                self.num_indexed += len(batch)
+                return
+
+            retry = []
+            for item, result in zip(batch, response['items']):
+                result = next(iter(result.values()))
+                status = result.get('status', 500)
+                if status < 300:
+                    self.num_indexed += 1
+                elif status == 429 and attempt < self.max_retries:
+                    retry.append(item)
+                else:
+                    self._fail([item], status, result.get('error'), result.get('_id'))
+
+            if retry:
+                self.num_rejected += len(retry)
+                self.num_retried += len(retry)
+                self._shrink()
+                if self._resend_smaller(retry, attempt):
+                    return
+            batch = retry
+            size = sum(len(item) for item in batch)
+            attempt += 1
+
+    def _fail(self, items, status, error, doc_id=None):
+        """Write items to the dead-letter file, and their ids and errors next to it"""
+        if self.dead_letter is None:
+            mode = 'ab' if self.append else 'wb'
+            self.dead_letter = open(self.dead_letter_file, mode)
+            self.errors = open(self.dead_letter_file + '.errors', mode)
+
+        for item in items:
+            self.dead_letter.write(item)
+            self.errors.write(fast_json.dumps({'_id': doc_id, 'status': status, 'error': error}) + b'\n')
+        self.num_failed += len(items)
+
+    def report(self):
+        text = "indexed %d documents, %d failed, %d rejected, %d retried in %d requests, final request size %.1f MB" % (
+            self.num_indexed, self.num_failed, self.num_rejected, self.num_retried, self.num_requests, self.batch_bytes / MB)
+        if self.num_failed:
+            text += ", failed documents written to %s" % self.dead_letter_file
+        return text
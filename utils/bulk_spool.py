@@ -0,0 +1,75 @@
+"""Spool of ready to send _bulk segments and a sender that streams them from disk.
+
+A segment is a file of complete bulk items (action line + source line, as
+encoded by fast_json.bulk_item) that is never larger than max_bytes, so it
+can be sent as one _bulk request body as it is. The sender reads a segment
+in fixed size blocks and passes them to requests as a generator, which
+sends them with chunked transfer encoding: memory use stays at one block
+no matter how large or how many the segments are, and no document is
+decoded on the way.
+"""
+import os
+
+import requests
+
+
+MB = 1024 * 1024
+BLOCK_SIZE = MB
+
+
+class BulkSpoolWriter:
+    """Write bulk items to numbered segment files of at most max_bytes, calling on_segment(path, num_docs) for each finished one"""
+
+    def __init__(self, directory, prefix, max_bytes=80 * MB, on_segment=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.on_segment = on_segment
+
+        self.num_segments = 0
+        self.fp = None
+        self.path = None
+        self.segment_bytes = 0
+        self.segment_docs = 0
+
+    def add(self, item):
+        # an item larger than max_bytes gets a segment of its own
+        if self.fp is not None and self.segment_bytes + len(item) > self.max_bytes:
+            self._finish()
+        if self.fp is None:
+            self.num_segments += 1
+            self.path = os.path.join(self.directory, '%s.%05d.ndjson' % (self.prefix, self.num_segments))
+            self.fp = open(self.path, 'wb')
+
+        self.fp.write(item)
+        self.segment_bytes += len(item)
+        self.segment_docs += 1
+
+    def close(self):
+        if self.fp is not None:
+            self._finish()
+
+    def _finish(self):
+        self.fp.close()
+        path, num_docs = self.path, self.segment_docs
+        self.fp = None
+        self.path = None
+        self.segment_bytes = 0
+        self.segment_docs = 0
+        if self.on_segment is not None:
+            self.on_segment(path, num_docs)
+
+
+def iter_blocks(path, block_size=BLOCK_SIZE):
+    with open(path, 'rb') as fp:
+        while True:
+            block = fp.read(block_size)
+            if not block:
+                break
+            yield block
+
+
+def send_segment(url, path, timeout=600, block_size=BLOCK_SIZE):
+    """POST a segment to a _bulk url with chunked transfer encoding, returns the response"""
+    headers = {'Content-Type': 'application/x-ndjson'}
+    return requests.post(url, data=iter_blocks(path, block_size), headers=headers, timeout=timeout)
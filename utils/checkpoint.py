@@ -0,0 +1,71 @@
+"""Checkpoint manifest of an import, so an interrupted load_vcf.py run can be resumed.
+
+The manifest is a small json file written next to the intermediate chunk
+files. It records the vcf and index it belongs to and, for every chunk file,
+the byte offset up to which documents were acknowledged by Elasticsearch
+(indexed, or written to the dead-letter file) and how many documents that is.
+Documents have deterministic _ids, so the batch that was in flight when the
+import died can be sent again without creating duplicates.
+"""
+import json
+import os
+import threading
+
+
+class Checkpoint:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.manifest = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                self.manifest = json.load(fp)
+
+    def matches(self, vcf, index_name):
+        """True if the manifest holds a finished parse of vcf for index_name whose chunk files still exist"""
+        files = self.manifest.get('files', {})
+        return (self.manifest.get('vcf') == os.path.abspath(vcf)
+                and self.manifest.get('index_name') == index_name
+                and bool(self.manifest.get('physical_index'))
+                and bool(files)
+                and all(os.path.exists(infile) for infile in files))
+
+    def start(self, vcf, index_name, output_files, physical_index, compound_het_spilled=None):
+        """Record a finished parse, nothing indexed yet. physical_index is the version of index_name being loaded,
+        compound_het_spilled the candidates left to label_spilled_compound_het if the parsers labelled the inheritance models"""
+        self.manifest = {
+            'vcf': os.path.abspath(vcf),
+            'index_name': index_name,
+            'physical_index': physical_index,
+            'files': {infile: {'offset': 0, 'acknowledged': 0, 'done': False} for infile in output_files},
+        }
+        if compound_het_spilled is not None:
+            self.manifest['compound_het_spilled'] = compound_het_spilled
+        self.save()
+
+    def physical_index(self):
+        return self.manifest.get('physical_index')
+
+    def compound_het_spilled(self):
+        return self.manifest.get('compound_het_spilled')
+
+    def output_files(self):
+        return list(self.manifest['files'])
+
+    def position(self, infile):
+        """Byte offset to continue reading infile from, documents acknowledged before it and whether the file is done"""
+        state = self.manifest.get('files', {}).get(infile, {'offset': 0, 'acknowledged': 0, 'done': False})
+        return state['offset'], state['acknowledged'], state['done']
+
+    def update(self, infile, offset, acknowledged, done=False):
+        with self.lock:
+            self.manifest.setdefault('files', {})[infile] = {'offset': offset, 'acknowledged': acknowledged, 'done': done}
+            self.save()
+
+    def save(self):
+        # written under a temporary name and renamed, so a crash never leaves a truncated manifest
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.manifest, fp, indent=4)
+        os.replace(tmp_path, self.path)
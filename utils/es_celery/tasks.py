@@ -1,22 +1,32 @@
+import json
 import os
+import socket
+import subprocess
+import sys
+import tempfile
 import time
 
 import elasticsearch
-import requests
 
+import fast_json
+from bulk_spool import send_segment
 from es_celery.celery import app
 
 
 @app.task()
 def post_data(hostname, port, index, type, filename):
-    with open(filename,'rb') as payload:
-        headers = {'Content-type': 'application/json'}
-        # print((hostname, port, index, type))
-        url = 'http://%s:%s/%s/%s/_bulk' %(hostname, port, index, type, filename)
-        r = requests.post(url, data=payload, headers=headers)
-
-    output_dict = {}
-    json_data = r.json()
+    # filename is a bulk_spool segment, streamed as it is. Only the status and _id of each item come back
+    url = 'http://%s:%s/%s/%s/_bulk?filter_path=took,errors,items.*._id,items.*.status' % (hostname, port, index, type)
+    r = send_segment(url, filename)
+
+    # the result is the acknowledgement of the chunk, see import_progress.py
+    output_dict = {'filename': filename}
+    if r.status_code >= 300:
+        # the whole request was rejected, the chunk file is kept to be sent again
+        output_dict['error'] = 'status %d: %s' % (r.status_code, r.text[:500])
+        return output_dict
+
+    json_data = fast_json.loads(r.content)
     failed_item_ids = []
     took = json_data['took']
     if json_data['errors'] == False:
@@ -36,6 +46,8 @@ def post_data(hostname, port, index, type, filename):
     if failed_item_ids:
         output_dict['failed_item_ids'] = failed_item_ids
 
+    output_dict['indexed'] = len(json_data['items']) - len(failed_item_ids)
+    output_dict['failed'] = len(failed_item_ids)
     output_dict['took'] = took
 
     return output_dict
@@ -45,3 +57,31 @@ def post_data(hostname, port, index, type, filename):
 def update_refresh_interval(hostname, port, index_name, refresh_interval):
     es = elasticsearch.Elasticsearch(host=hostname, port=port)
     es.indices.put_settings(index=index_name, body={"refresh_interval": refresh_interval})
+
+
+@app.task()
+def parse_and_index_region(load_vcf_args, region, vcf_info):
+    """Parse and index the variant lines region = [start, end] of a vcf, for the load_vcf.py --celery coordinator.
+
+    load_vcf.py is run in its worker mode with the arguments of the coordinator, the vcf has to be
+    at the same path on every node. Returns the counts of the region for the coordinator report.
+    """
+    load_vcf = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'load_vcf.py')
+    with tempfile.TemporaryDirectory() as tmp:
+        vcf_info_file = os.path.join(tmp, 'vcf_info.json')
+        report_file = os.path.join(tmp, 'report.json')
+        with open(vcf_info_file, 'w') as fp:
+            json.dump(vcf_info, fp)
+
+        command = [sys.executable, load_vcf] + load_vcf_args + [
+            '--worker_region', str(region[0]), str(region[1]),
+            '--worker_vcf_info', vcf_info_file,
+            '--worker_report', report_file]
+        proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.dirname(load_vcf)))
+
+        if proc.returncode != 0 or not os.path.exists(report_file):
+            output = proc.stdout.decode('utf8', 'replace').strip().splitlines()
+            raise RuntimeError("load_vcf.py exited with %d on %s: %s" % (proc.returncode, socket.gethostname(), '\n'.join(output[-20:])))
+
+        with open(report_file) as fp:
+            return json.load(fp)
@@ -0,0 +1,61 @@
+"""JSON encoding for documents sent to Elasticsearch.
+
+Uses orjson if installed, then ujson, then the standard library json module.
+dumps() always returns UTF-8 bytes, so documents are encoded once and can be
+written to bulk files or joined into bulk request bodies without decoding.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj)
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+BACKENDS = {
+    'orjson': (_orjson_dumps, orjson.loads if orjson else None),
+    'ujson': (_ujson_dumps, ujson.loads if ujson else None),
+    'json': (_json_dumps, json.loads),
+}
+
+def available_backends():
+    return [name for name in ['orjson', 'ujson', 'json'] if BACKENDS[name][1] is not None]
+
+backend = None
+dumps = None
+loads = None
+
+def set_backend(name):
+    """Select the encoder by name, mainly for benchmarking. The fastest installed one is used by default"""
+    global backend, dumps, loads
+    if name not in available_backends():
+        raise ValueError("JSON backend %s is not installed" % name)
+    backend = name
+    dumps, loads = BACKENDS[name]
+
+set_backend(available_backends()[0])
+
+
+def bulk_action(index_name, action='index', doc_type='_doc', **meta):
+    """Encoded action line of a bulk request, i.e. b'{"index":{"_index":"name","_type":"_doc"}}\\n'"""
+    meta = dict(meta, _index=index_name, _type=doc_type)
+    return dumps({action: meta}) + b'\n'
+
+def bulk_item(action_line, doc):
+    """Action line followed by the encoded document, ready to be joined into a bulk body"""
+    return action_line + dumps(doc) + b'\n'
@@ -0,0 +1,102 @@
+"""Exact progress of an import whose chunks are indexed by Celery tasks.
+
+Every chunk (a bulk file, or a region of a vcf) is registered with the
+number of documents it holds and the AsyncResult of the task indexing it.
+The task result is the acknowledgement of the chunk: how many documents
+Elasticsearch indexed and which ones failed. Progress, rate and ETA are
+read from the result backend, so nothing is asked of the cluster being
+indexed into, and the final reconciliation names every chunk and document
+that did not make it.
+"""
+import time
+from collections import OrderedDict
+
+from tqdm import tqdm
+
+
+class ImportProgress:
+
+    def __init__(self, unit='docs'):
+        self.unit = unit
+        self.chunks = OrderedDict()
+        self.pending = []
+        self.start_time = time.time()
+
+        self.total = 0
+        self.acknowledged = 0
+        self.indexed = 0
+        self.failed = 0
+
+    def add(self, name, num_docs, result):
+        self.chunks[name] = {'docs': num_docs, 'result': result, 'report': None, 'error': None}
+        self.pending.append(name)
+        self.total += num_docs
+
+    def poll(self):
+        """Collect the results of finished tasks, returns the number of documents they acknowledged"""
+        acknowledged = 0
+        still_pending = []
+        for name in self.pending:
+            if self.chunks[name]['result'].ready():
+                acknowledged += self._collect(name)
+            else:
+                still_pending.append(name)
+        self.pending = still_pending
+        self.acknowledged += acknowledged
+        return acknowledged
+
+    def _collect(self, name):
+        chunk = self.chunks[name]
+        result = chunk['result']
+        report = result.get(propagate=False)
+        if result.failed():
+            # nothing of the chunk is known to be indexed
+            chunk['error'] = '%s: %s' % (type(report).__name__, report)
+            self.failed += chunk['docs']
+        elif report.get('error'):
+            chunk['report'] = report
+            chunk['error'] = report['error']
+            self.failed += chunk['docs']
+        else:
+            chunk['report'] = report
+            self.indexed += report['indexed']
+            self.failed += report['failed']
+        return chunk['docs']
+
+    def wait(self, interval=1.0):
+        """Show the acknowledged documents with rate and ETA until every chunk is acknowledged"""
+        with tqdm(total=self.total, initial=self.acknowledged, unit=' ' + self.unit, unit_scale=True) as pbar:
+            while self.pending:
+                time.sleep(interval)
+                pbar.update(self.poll())
+                pbar.set_postfix(failed=self.failed, chunks_left=len(self.pending))
+
+    def failed_chunks(self):
+        return [(name, chunk) for name, chunk in self.chunks.items() if chunk['error']]
+
+    def reconcile(self, failed_ids_file=None):
+        """Print what was indexed and which chunks and document ids failed, the failed ids are written to failed_ids_file"""
+        seconds = time.time() - self.start_time
+        print("%d chunks, %d %s: %d indexed, %d failed, %d not acknowledged, %.1f %s/sec" % (
+            len(self.chunks), self.total, self.unit, self.indexed, self.failed, self.total - self.acknowledged,
+            self.indexed / seconds if seconds > 0 else 0, self.unit))
+
+        for name, chunk in self.failed_chunks():
+            print("Chunk %s (%d %s) failed: %s" % (name, chunk['docs'], self.unit, chunk['error']))
+
+        failed_ids = []
+        for name, chunk in self.chunks.items():
+            report = chunk['report'] or {}
+            if report.get('failed_item_ids'):
+                print("Chunk %s: %d documents failed" % (name, len(report['failed_item_ids'])))
+                failed_ids.extend(report['failed_item_ids'])
+            if report.get('dead_letter'):
+                print("Chunk %s: %d failed documents written to %s" % (name, report['failed'], report['dead_letter']))
+
+        if failed_ids and failed_ids_file:
+            with open(failed_ids_file, 'w') as fp:
+                for doc_id in failed_ids:
+                    fp.write('%s\n' % doc_id)
+            print("Ids of the %d failed documents written to %s" % (len(failed_ids), failed_ids_file))
+
+        return self.failed == 0 and self.acknowledged == self.total
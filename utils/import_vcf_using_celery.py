@@ -17,7 +17,9 @@ import requests
 from elasticsearch import helpers
 from tqdm import tqdm
 
+from bulk_spool import MB, BulkSpoolWriter
 from es_celery.tasks import post_data, update_refresh_interval
+from import_progress import ImportProgress
 from utils import *
 
 # sys.stdout = open('stdout_import_vcf_using_celery.txt', 'a')
@@ -624,47 +626,20 @@ def main():
     index_name = args.index
     type_name = args.type
 
-    file_count = 1
-    file_size_total = 0
+    progress = ImportProgress()
     directory_name = tempfile.mkdtemp()
-    data_available = False
-    for line_count, data in enumerate(set_data(es, index_name,
-                                               type_name,
-                                               vcf_filename,
-                                               vcf_mapping,
-                                               vcf_label,
-                                               update=update), 1):
-        file_size_total += sys.getsizeof(data)
-        if line_count == 1:
-            filename = os.path.join(
-                directory_name, 'output_%s.json' % (file_count))
-            output_file = open(filename, 'w')
-
-        output_file.write('%s\n' % (data))
-        data_available = True
-
-        if file_size_total > 83886080 and ((line_count % 2) == 0):
-            output_file.close()
-            # print(args.hostname, args.port, index_name, type_name, filename)
-            post_data.delay(args.hostname, args.port,
-                            index_name, type_name, filename)
-            #
-            file_count += 1
-            filename = os.path.join(
-                directory_name, 'output_%s.json' % (file_count))
-            output_file = open(filename, 'w')
-            file_size_total = 0
-            data_available = False
-
-    # finally:
-    if data_available:
-        output_file.close()
-        post_data.delay(args.hostname, args.port,
-                        index_name, type_name, filename)
 
-    # time.sleep(30)
-    # es.indices.put_settings(index=index_name, body={"refresh_interval": "1s"})
-    update_refresh_interval.delay(args.hostname, args.port, index_name, '1s')
+    def queue_segment(filename, num_docs):
+        progress.add(filename, num_docs, post_data.delay(args.hostname, args.port,
+                                                         index_name, type_name, filename))
+        progress.poll()
+
+    # set_data yields the action and source line of each document, they are spooled as ready to send _bulk segments
+    spool = BulkSpoolWriter(directory_name, 'output', max_bytes=80 * MB, on_segment=queue_segment)
+    lines = set_data(es, index_name, type_name, vcf_filename, vcf_mapping, vcf_label, update=update)
+    for action, source in zip(lines, lines):
+        spool.add(('%s\n%s\n' % (action, source)).encode('utf8'))
+    spool.close()
     # pprint(data)
     # es.index(index=index_name, doc_type=type_name, body=data)
 
@@ -672,33 +647,12 @@ def main():
 
     print('\nIndexing %d variants in Elasticsearch' %
           (GLOBAL_NO_VARIANTS_PROCESSED))
-    while 1:
-        try:
-            previous_count = current_count = es.count(
-                index_name, doc_type=type_name, request_timeout=300)['count']
-            checks_after_probably_finished = 0
-            break
-        except:
-            continue
-
-    pbar = tqdm(total=GLOBAL_NO_VARIANTS_PROCESSED)
-    pbar.update(current_count)
-    while current_count < GLOBAL_NO_VARIANTS_PROCESSED and checks_after_probably_finished < 3:
-        try:
-            current_count = int(
-                es.count(index_name, doc_type=type_name, request_timeout=300)['count'])
-            difference = current_count - previous_count
-            previous_count = current_count
-            if difference > 0:
-                pbar.update(difference)
-
-            time.sleep(1)
-
-            if (current_count / GLOBAL_NO_VARIANTS_PROCESSED) > 0.999:
-                checks_after_probably_finished += 1
-        except:
-            continue
-    pbar.close()
+    # every chunk is acknowledged by the result of its post_data task, Elasticsearch is not polled
+    progress.wait()
+
+    # time.sleep(30)
+    # es.indices.put_settings(index=index_name, body={"refresh_interval": "1s"})
+    update_refresh_interval.delay(args.hostname, args.port, index_name, '1s')
 
     end_time = datetime.now()
     sys.stdout.flush()
@@ -713,6 +667,7 @@ def main():
     print("Number of variants updated:", GLOBAL_NO_VARIANTS_UPDATED)
     print("Number of variants failed indexing:", GLOBAL_NO_VARIANTS_FAILED)
     print("Number of variants skipped:", GLOBAL_NO_VARIANTS_SKIPPED)
+    progress.reconcile(os.path.join(directory_name, 'failed_ids.txt'))
 
     write_benchmark_results('benchmark.txt', vcf_filename, str((vcf_import_end_time - start_time).total_seconds()),
                             str((end_time - vcf_import_end_time).total_seconds()), str((end_time - start_time).total_seconds()))
@@ -0,0 +1,122 @@
+"""Versioned physical indices behind a dataset alias.
+
+load_vcf.py loads every import into a new physical index named
+<alias>_v<timestamp>. The name stored in Dataset.es_index_name is an alias
+that keeps pointing at the previous version until the new one is loaded and
+its GUI is built, then it is switched in a single atomic _aliases request.
+Older versions are kept for rollback. A plain index from before versioning,
+named like the alias, is first cloned into a version of its own.
+
+Run as a script to list the versions of an alias or to roll back:
+
+    python utils/index_versions.py --hostname localhost --port 9200 --index my_index
+    python utils/index_versions.py --hostname localhost --port 9200 --index my_index --rollback
+"""
+import argparse
+import re
+import sys
+import time
+
+import elasticsearch
+
+
+# suffix of the side-car index holding the mendelian labels of a version, see mendelian_engine.py
+ANNOTATIONS_SUFFIX = '_annotations'
+
+
+def annotations_index(index):
+    return index + ANNOTATIONS_SUFFIX
+
+
+def new_version_name(alias):
+    return '%s_v%s' % (alias, time.strftime('%Y%m%d%H%M%S'))
+
+
+def list_versions(es, alias):
+    """Physical versions of alias, oldest first"""
+    # the wildcard also matches versions of other aliases starting with alias + '_v'
+    pattern = re.compile(re.escape(alias) + r'_v\d{14}$')
+    indices = es.indices.get(index=alias + '_v*', allow_no_indices=True, expand_wildcards='open')
+    return sorted(index for index in indices if pattern.match(index))
+
+
+def current_version(es, alias):
+    """Index the alias points to, the alias itself if it is still a plain index from before versioning, or None"""
+    if es.indices.exists_alias(name=alias):
+        return sorted(es.indices.get_alias(name=alias))[-1]
+    if es.indices.exists(index=alias):
+        return alias
+    return None
+
+
+def keep_legacy_index(es, alias):
+    """Clone the plain index alias, from before versioning, into a version named after its creation time"""
+    settings = es.indices.get_settings(index=alias, name='index.creation_date')
+    creation_date = int(settings[alias]['settings']['index']['creation_date'])
+    # older than the version replacing it, so a rollback finds it
+    version = '%s_v%s' % (alias, time.strftime('%Y%m%d%H%M%S', time.localtime(creation_date / 1000)))
+
+    # a clone needs a read-only source, the plain index is removed once the alias is switched anyway
+    es.indices.put_settings(index=alias, body={"index.blocks.write": True})
+    try:
+        es.indices.clone(index=alias, target=version, body={"settings": {"index.blocks.write": None}})
+        es.cluster.health(index=version, wait_for_no_initializing_shards=True)
+    except elasticsearch.ElasticsearchException:
+        es.indices.put_settings(index=alias, body={"index.blocks.write": None})
+        raise
+    print("Index '%s' is a plain index from before versioning, it is kept for rollback as '%s'" % (alias, version))
+    return version
+
+
+def swap_alias(es, alias, index):
+    """Point alias at index, removing it from the version it pointed at before in the same request"""
+    actions = []
+    current = current_version(es, alias)
+    if current == alias:
+        # a plain index can not share its name with an alias, it has to go in the same request once it is kept as a version
+        current = keep_legacy_index(es, alias)
+        actions.append({"remove_index": {"index": alias}})
+    elif current is not None:
+        actions.append({"remove": {"index": current, "alias": alias}})
+    actions.append({"add": {"index": index, "alias": alias}})
+
+    es.indices.update_aliases(body={"actions": actions})
+    print("Alias '%s' now points to '%s', previous version: %s" % (alias, index, current))
+
+
+def prune_versions(es, alias, keep):
+    """Delete old versions, keeping the current one and the keep newest versions before it"""
+    current = current_version(es, alias)
+    old_versions = [index for index in list_versions(es, alias) if index < current] if current else []
+    for index in old_versions[:max(0, len(old_versions) - keep)]:
+        print("Deleting old version '%s' of '%s'" % (index, alias))
+        es.indices.delete(index=index)
+        es.indices.delete(index=annotations_index(index), ignore_unavailable=True)
+
+
+def rollback(es, alias):
+    """Point alias back at the newest version older than the current one"""
+    current = current_version(es, alias)
+    previous = [index for index in list_versions(es, alias) if current is None or index < current]
+    if not previous:
+        print("No version of '%s' older than '%s' to roll back to" % (alias, current))
+        sys.exit(2)
+    swap_alias(es, alias, previous[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the versions of a dataset index alias, or roll back to the previous one')
+    parser.add_argument("--hostname", help="ElasticSearch hostname", required=True)
+    parser.add_argument("--port", help="ElasticSearch host port number", required=True)
+    parser.add_argument("--index", help="Alias name, i.e. the --index given to load_vcf.py", required=True)
+    parser.add_argument("--rollback", help="Point the alias back at the previous version", action="store_true")
+    args = parser.parse_args()
+
+    es = elasticsearch.Elasticsearch(host=args.hostname, port=args.port)
+
+    if args.rollback:
+        rollback(es, args.index)
+
+    current = current_version(es, args.index)
+    for index in list_versions(es, args.index):
+        print("%s%s" % (index, ' (current)' if index == current else ''))
@@ -7,12 +7,17 @@ import subprocess
 from subprocess import check_output
 import multiprocessing
 import gzip
+import itertools
+import queue
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import argparse
 from pprint import pprint
 import multiprocessing
 import logging
 import math
 import re
+import socket
 from pathlib import Path
 from collections import defaultdict
 from collections import OrderedDict
@@ -23,7 +28,17 @@ from collections import deque
 from elasticsearch import helpers
 import time
 from make_gui import make_gui_config, make_gui
+from bgzf_reader import GRABIX_CHUNK_SIZE, GrabixIndex, grab_lines, is_bgzf
+from mapping_optimizer import trim_mapping, projected_savings, print_report
+import fast_json
+from bulk_indexer import MB, BulkIndexer
+from checkpoint import Checkpoint
+from import_progress import ImportProgress
+from index_versions import new_version_name, swap_alias, prune_versions
+from tabix_reader import TabixIndex, TabixReader, fetch_merged, plan_region_batches
 from add_mendelian_annotations import *
+from mendelian_engine import annotate_mendelian, annotate_compound_het, inheritance_models, ped_probands, CompoundHetBuffer, label_spilled_compound_het, labels_index, LABEL_WRITES
+from annotation_writer import AnnotationWriter
 import utils
 import sqlite3
 from utils import *
@@ -46,8 +61,8 @@ from core.utils import get_values_from_es
 
 parser = argparse.ArgumentParser(description='Parse vcf file(s) and create ElasticSearch mapping and index from the parsed data')
 required = parser.add_argument_group('required named arguments')
-required.add_argument("--vcf", help="Annovar or VEP annotated input vcf file. Must be compressed with bgzip and indexed with grabix", required=True)
-required.add_argument("--tmp_dir", help="Temporory directory to store intermediate files", required=True)
+required.add_argument("--vcf", help="Annovar or VEP annotated input vcf file. Must be compressed with bgzip. A grabix compatible .gbi index is created if missing", required=True)
+required.add_argument("--tmp_dir", help="Temporory directory to store intermediate files. Not needed with --streaming", required=False)
 required.add_argument("--annot", help="Type of variant consequence annotation. Valid values are 'annovar' or 'vep'", required=True)
 required.add_argument("--hostname", help="ElasticSearch hostname", required=True)
 required.add_argument("--port", help="ElasticSearch host port number", required=True)
@@ -57,13 +72,33 @@ required.add_argument("--dataset_name", help="Name of the dataset", required=Tru
 required.add_argument("--assembly", help="Reference genome assembly version used in the project, valid value is any of 'hg19|hg38|GRCh37|GRCh38'", required=True)
 required.add_argument("--num_cores", help="Number of cpu cores to use. Default to the number of cpu cores of the system", required=False)
 required.add_argument("--ped", help="Pedigree file in the format of '#Family Subject Father  Mother  Sex     Phenotype", required=False)
-required.add_argument("--control_vcf", help="vcf file from control study. Must be compressed with bgzip and indexed with grabix", required=False)
-required.add_argument("--interval_size", help="Genomic interval size (bp) for loading case/control vcf. Default is 5000000. Choose a smaller number if low in physical memory", required=False)
+required.add_argument("--control_vcf", help="vcf file from control study. Must be compressed with bgzip and indexed with tabix", required=False)
+required.add_argument("--interval_size", help="Deprecated and ignored. Case/control files are merged as streams, so memory no longer grows with the batch size", required=False)
 required.add_argument("--webserver_port", help="Port number for webser to explore variant data", required=False)
 parser.add_argument("--debug", help="Run in single CPU mode for debugging purposes", action="store_true")
 parser.add_argument("--cleanup", help="Remove temporary .json files under --tmp_dir after being indexed", action="store_true")
 parser.add_argument("--skip_parsing", help="Skip the parsing process, directly go to the indexing and GUI creating step. Useful when parsing was successful but indexing failed for various reasons", action="store_true")
 parser.add_argument("--gui_only", help="Only create GUI config. Used in situations where the paring and indexing were finished successfuly, but the final GUI creation failed", action="store_true")
+parser.add_argument("--streaming", help="Index documents while parsing by passing them from parser processes to indexer processes through a bounded queue. No intermediate .json files are written", action="store_true")
+parser.add_argument("--celery", help="Parse and index regions of --vcf in Celery tasks (see es_celery) on any number of nodes, and report the counts and failures of all regions. --vcf has to be at the same path on every worker node", action="store_true")
+parser.add_argument("--region_lines", help="Number of variant lines per Celery task with --celery. Default to 200000", required=False)
+parser.add_argument("--num_indexers", help="Number of indexer processes used with --streaming. Default to half of --num_cores", required=False)
+parser.add_argument("--num_shards", help="Number of primary shards of the index. Default to 8", required=False)
+parser.add_argument("--route_by_chrom", help="Route documents to shards by CHROM, so searches restricted to chromosomes only query the shards holding them", action="store_true")
+parser.add_argument("--keep_versions", help="Number of earlier versions of the index kept for rollback after the alias is switched to the new one. Default to 1", required=False)
+parser.add_argument("--update", help="Add the samples of --vcf to an existing index: variants already in the index get the new samples appended, novel variants are created. Nothing is deleted", action="store_true")
+parser.add_argument("--resume", help="Continue indexing an interrupted import from the checkpoint under --tmp_dir instead of parsing again and recreating the index", action="store_true")
+parser.add_argument("--max_bulk_size", help="Upper limit of a bulk request in MB. Requests are sized by bytes and adapted to how fast Elasticsearch handles them. Default to 20", required=False)
+parser.add_argument("--bulk_load", help="Load into an index without refreshes and replicas, then restore the refresh interval and replicas. Faster for large imports", action="store_true")
+parser.add_argument("--force_merge", help="With --bulk_load, force merge the loaded index to a single segment before the replicas are restored. Only for indices that will not be loaded into with --update later", action="store_true")
+parser.add_argument("--optimize_mapping", help="Create the index without the inverted index and doc values of fields the GUI never filters or aggregates on, store allele frequencies as scaled_float and print the projected savings, see mapping_optimizer.py", action="store_true")
+parser.add_argument("--label_write", help="How mendelian labels added after indexing are written: 'script' adds them to the matching samples with a stored script, 'doc' rewrites the sample array, 'sidecar' writes them to <index>_annotations, joined at query time. Default to script", choices=LABEL_WRITES, default='script')
+# used by the es_celery tasks that run a region of a --celery import
+parser.add_argument("--worker_region", help=argparse.SUPPRESS, nargs=2, type=int)
+parser.add_argument("--worker_index", help=argparse.SUPPRESS)
+parser.add_argument("--worker_vcf_info", help=argparse.SUPPRESS)
+parser.add_argument("--worker_report", help=argparse.SUPPRESS)
+parser.add_argument("--benchmark_parsing", help="Parse the first N variant lines of --vcf in a single process, report lines/sec with and without cached lookup tables and exit. Nothing is indexed", required=False)
 
 args = parser.parse_args()
 
@@ -85,21 +120,107 @@ control_vcf = args.control_vcf
 tmp_dir = args.tmp_dir
 annot = args.annot
 index_name = args.index
+# documents are written to a new version of the index behind the index_name alias, see index_versions.py
+physical_index = index_name
 study = args.study_name
 dataset_name = args.dataset_name
 ped = args.ped
-interval_size = args.interval_size
+if args.interval_size:
+	print("Warning: --interval_size is deprecated and ignored, case/control files are merged as streams")
 debug = args.debug
 cleanup = args.cleanup
 skip_parsing = args.skip_parsing
 gui_only = args.gui_only
 assembly = args.assembly
+streaming = args.streaming
+bulk_load = args.bulk_load
+force_merge = args.force_merge
+resume = args.resume
+update = args.update
+keep_versions = int(args.keep_versions) if args.keep_versions else 1
+num_shards = int(args.num_shards) if args.num_shards else 8
+route_by_chrom = args.route_by_chrom
+optimize_mapping = args.optimize_mapping
+label_write = args.label_write
+use_celery = args.celery
+worker_region = args.worker_region
+if worker_region:
+	physical_index = args.worker_index
+
+# regions start on a .gbi chunk, so each one starts with a single seek
+region_lines = int(args.region_lines) if args.region_lines else 200000
+region_lines = max(1, math.ceil(region_lines / GRABIX_CHUNK_SIZE)) * GRABIX_CHUNK_SIZE
+
+if args.max_bulk_size:
+	max_bulk_size = int(float(args.max_bulk_size) * MB)
+else:
+	max_bulk_size = 20 * MB
+
+if streaming and skip_parsing:
+	print("--streaming and --skip_parsing can not be used together, there are no intermediate files to index")
+	sys.exit(2)
+
+if update and bulk_load:
+	print("--update and --bulk_load can not be used together, --bulk_load is meant for a new index that is not searched while loading")
+	sys.exit(2)
+
+if force_merge and (update or not bulk_load):
+	print("--force_merge needs --bulk_load and can not be used with --update, an index that is written to later should not be merged to a single segment")
+	sys.exit(2)
+
+if update and optimize_mapping:
+	print("--update and --optimize_mapping can not be used together, the mapping of an existing index can not be trimmed")
+	sys.exit(2)
+
+if use_celery and (streaming or skip_parsing or resume or control_vcf):
+	print("--celery can not be used with --streaming, --skip_parsing, --resume or --control_vcf, the workers index single cohort regions while parsing them")
+	sys.exit(2)
+
+if streaming and resume:
+	print("--streaming and --resume can not be used together, there are no intermediate files to resume from")
+	sys.exit(2)
+
+if tmp_dir is None:
+	if streaming or gui_only or use_celery or worker_region:
+		tmp_dir = 'tmp' # only per process log files are written here
+	else:
+		print("Please specify --tmp_dir to store intermediate files, or use --streaming")
+		sys.exit(2)
+
+num_indexers = args.num_indexers
+if num_indexers is None:
+	num_indexers = max(1, num_cpus // 2)
+else:
+	num_indexers = int(num_indexers)
+
+benchmark_lines = args.benchmark_parsing
+if benchmark_lines is not None:
+	benchmark_lines = int(benchmark_lines)
+	if benchmark_lines <= 0:
+		print("--benchmark_parsing needs a positive number of lines")
+		sys.exit(2)
 
 if not assembly in ['hg19', 'hg38', 'GRCh37', 'GRCh38']:
 	print("Invalid assembly value. Supported values are 'hg19|hg38|GRCh37|GRCh38'")
 	sys.exit(2)
 
 
+# index settings after loading, and the bulk load profile used while loading with --bulk_load
+index_target_settings = {"number_of_replicas": 1, "refresh_interval": "1s"}
+bulk_load_settings = {"number_of_replicas": 0, "refresh_interval": "-1"}
+
+# compound heterozygous candidates of genes cut by the edge of a parser task, labelled by label_spilled_compound_het after indexing
+spilled_compound_het = []
+
+# used with --update: replace the entries of reloaded samples and append the new ones, the variant level fields of an existing document are kept
+APPEND_SAMPLES_SCRIPT = """
+if (ctx._source.sample == null) { ctx._source.sample = new ArrayList(); }
+Set ids = new HashSet();
+for (s in params.sample) { ids.add(s.Sample_ID); }
+ctx._source.sample.removeIf(s -> ids.contains(s.Sample_ID));
+ctx._source.sample.addAll(params.sample);
+"""
+
 excluded_list = ['AA', 'ANNOVAR_DATE', 'MQ0', 'DB', 'POSITIVE_TRAIN_SITE', 'NEGATIVE_TRAIN_SITE', 'culprit']
 cohort_specific = ['AC', 'AF', 'AN', 'BaseQRankSum', 'GQ_MEAN', 'GQ_STDDEV', 'HWP', 'MQRankSum', 'NCC', 'MQ', 'ReadPosRankSum', 'QD', 'VQSLOD']
 
@@ -115,18 +236,14 @@ def check_commandline(vcf, control_vcf, annot):
 
 	# check if valid vcf file specified
 	vcf = os.path.abspath(vcf)
-	out = check_output(["grabix", "check", vcf])
-
-	if str(out.decode('ascii').strip()) != 'yes':
-		print("Invalid vcf file. Please provide a bgzipped/grabix indexed vcf file.")
+	if not is_bgzf(vcf):
+		print("Invalid vcf file. Please provide a bgzipped vcf file.")
 		sys.exit(2)
 
 	if control_vcf:
 		control_vcf = os.path.abspath(control_vcf)
-		out = check_output(["grabix", "check", control_vcf])
-
-		if str(out.decode('ascii').strip()) != 'yes':
-			print("Invalid control_vcf file. Please provide a bgzipped/grabix indexed vcf file.")
+		if not is_bgzf(control_vcf):
+			print("Invalid control_vcf file. Please provide a bgzipped vcf file.")
 			sys.exit(2)
 	# check if tabix index files exist for case/control studies
 	if control_vcf:
@@ -411,590 +528,805 @@ def process_vcf_data(vcf, number_of_lines_to_read, vcf_info):
 
 	return(vcf_info)
 
-def parse_vcf(vcf, interval, outfile, vcf_info):
+def doc_key(doc):
+	"""_id and routing of the document of a variant"""
+	es_id = get_es_id(doc['CHROM'], doc['POS'], doc['REF'], doc['ALT'], '', index_name, '_doc')
+	return(es_id, doc['CHROM'] if route_by_chrom else None)
+
+def encode_bulk_item(doc):
+	"""Encoded bulk action/source lines of a document.
+
+	The _id is derived from CHROM, POS, REF and ALT only, so the same variant
+	gets the same _id in every vcf. With --update the document is sent as an
+	upsert that appends its samples to an existing variant.
+	"""
+	es_id, routing = doc_key(doc)
+	meta = {'_id': es_id}
+	if routing is not None:
+		meta['routing'] = routing
+	if not update:
+		return(fast_json.bulk_item(fast_json.bulk_action(physical_index, **meta), doc))
+
+	body = {
+		"script": {"source": APPEND_SAMPLES_SCRIPT, "lang": "painless", "params": {"sample": doc.get('sample', [])}},
+		"upsert": doc
+	}
+	return(fast_json.bulk_item(fast_json.bulk_action(physical_index, action='update', retry_on_conflict=3, **meta), body))
+
+class BulkFileSink:
+	"""Write each document as an encoded bulk action/source line pair of an intermediate chunk file"""
+
+	def __init__(self, outfile):
+		self.fp = open(outfile, 'wb')
+
+	def put(self, doc):
+		self.fp.write(encode_bulk_item(doc))
+
+	def close(self):
+		self.fp.close()
+
+class QueueSink:
+	"""Pass lists of encoded bulk items to the indexer processes through a bounded queue"""
+
+	def __init__(self, doc_queue, batch_size=500):
+		self.doc_queue = doc_queue
+		self.batch_size = batch_size
+		self.batch = []
+
+	def put(self, doc):
+		self.batch.append(encode_bulk_item(doc))
+		if len(self.batch) >= self.batch_size:
+			# blocks while the queue is full, so parsers can not run far ahead of the indexers
+			self.doc_queue.put(self.batch)
+			self.batch = []
+
+	def close(self):
+		if self.batch:
+			self.doc_queue.put(self.batch)
+			self.batch = []
+
+def open_sink(outfile, doc_queue):
+	if doc_queue is not None:
+		return(QueueSink(doc_queue))
+	return(BulkFileSink(outfile))
+
+def label_sink(sink, ctx):
+	"""Hold the compound heterozygous candidates of sink until their genes are complete, if the parser labels inheritance models"""
+	if ctx.annotate_inheritance:
+		return(CompoundHetBuffer(sink, annot, doc_key, ctx.probands))
+	return(sink)
+
+def finish_task(f):
+	if isinstance(f, CompoundHetBuffer):
+		f.finish_task()
+
+def dead_letter_file(name):
+	"""Where documents that could not be indexed are written, as a bulk file that can be sent again"""
+	return(os.path.join(tmp_dir, index_name + '.' + name + '.dead_letter.json'))
+
+def index_from_queue(doc_queue, hostname, port, name):
 	p = multiprocessing.current_process()
+	es = elasticsearch.Elasticsearch(host=hostname, port=port, request_timeout=300, max_retries=10, timeout=300, read_timeout=800)
+	indexer = BulkIndexer(es, dead_letter_file(name), max_bytes=max_bulk_size)
 
-	# divide interval into smaller chunks to minimize memory footprint
+	while True:
+		items = doc_queue.get()
+		if items is None: # sentinel, all parsers are done
+			break
+		indexer.add_many(items)
+
+	indexer.close()
+	print("Indexer pid %s: %s" % (p.pid, indexer.report()))
+
+def start_indexers(doc_queue):
+	indexers = []
+	for i in range(num_indexers):
+		proc = multiprocessing.Process(target=index_from_queue, args=[doc_queue, hostname, port, 'indexer_%d' % i])
+		proc.start()
+		indexers.append(proc)
+
+	return(indexers)
+
+def stop_indexers(doc_queue, indexers):
+	for proc in indexers:
+		doc_queue.put(None)
+	for proc in indexers:
+		proc.join()
+		print("Indexer %s finished ..." % proc.pid)
+
+def make_task_queue(tasks, num_workers):
+	"""Queue of small work units that idle parser processes pull from, followed by one stop sentinel per worker"""
+	task_queue = multiprocessing.Queue()
+	for task in tasks:
+		task_queue.put(task)
+	for i in range(num_workers):
+		task_queue.put(None)
+
+	return(task_queue)
+
+def iter_tasks(task_queue):
+	while True:
+		task = task_queue.get()
+		if task is None:
+			return
+		yield task
+
+def run_parsers(target, vcf_files, tasks, vcf_info, doc_queue=None):
+	"""Run target(*vcf_files, task_queue, outfile, vcf_info, doc_queue, stats_queue) in num_cpus processes sharing one task queue"""
+	num_workers = 1 if debug else num_cpus
+	task_queue = make_task_queue(tasks, num_workers)
+	stats_queue = multiprocessing.Queue()
+	output_prefix = os.path.basename(vcf_files[-1])
+
+	processes = []
+	output_json = []
+
+	if debug:
+		output_file = os.path.join(tmp_dir, output_prefix + '.debug.json')
+		target(*vcf_files, task_queue, output_file, vcf_info, doc_queue, stats_queue)
+		output_json.append(output_file)
+	else:
+		# dispatch subtasks to each of the processes
+		for i in range(num_workers):
+			output_file = os.path.join(tmp_dir, output_prefix + '.chunk_' + str(i) + '.json')
+			proc = multiprocessing.Process(target=target, args=[*vcf_files, task_queue, output_file, vcf_info, doc_queue, stats_queue])
+			proc.start()
+			processes.append(proc)
+			output_json.append(output_file)
+
+	# read the stats before joining, a process exits only once what it put on stats_queue is read
+	stats = []
+	while len(stats) < num_workers:
+		try:
+			stats.append(stats_queue.get(timeout=10))
+		except queue.Empty:
+			if not any(proc.is_alive() for proc in processes): # a parser process died before reporting
+				break
+
+	# wait for all the processes to finish
+	for proc in processes:
+		proc.join()
+		print("Process %s finished ..." % proc.pid)
+
+	print_parser_report(stats, num_workers)
+	for item in stats:
+		spilled_compound_het.extend(item.get('spilled', []))
+
+	return(output_json)
+
+def print_parser_report(stats, num_workers):
+	print("%-10s %8s %12s %10s %14s" % ('Parser', 'Tasks', 'Variants', 'Seconds', 'Variants/sec'))
+	for item in sorted(stats, key=lambda x: x['pid']):
+		rate = item['variants']/item['seconds'] if item['seconds'] > 0 else 0
+		print("%-10s %8d %12d %10.1f %14.1f" % (item['pid'], item['tasks'], item['variants'], item['seconds'], rate))
+
+	if len(stats) < num_workers:
+		print("Warning: %d of %d parser processes did not report, check their log files" % (num_workers - len(stats), num_workers))
+	if stats:
+		fastest = min(item['seconds'] for item in stats)
+		slowest = max(item['seconds'] for item in stats)
+		print("Slowest parser finished %.1f seconds after the fastest" % (slowest - fastest))
+
+def parse_vcf(vcf, task_queue, outfile, vcf_info, doc_queue=None, stats_queue=None):
+	p = multiprocessing.current_process()
+	t = time.time()
+	num_tasks = 0
+
+	# process the interval in smaller chunks to minimize memory footprint
 	chunk_size = 5000
-	start = interval[0]
 	num_variants_processed = 0
 
 	logfile = re.sub('json', 'log', outfile)
 	log = open(logfile, 'w')
 
-	with open(outfile, 'w') as f:
-		while True:
-			if start < interval[1]:
-				end = start + chunk_size - 1
-				if end >= interval[1]:
-					end = interval[1]
+	ctx = ParseContext(vcf_info)
+
+	f = label_sink(open_sink(outfile, doc_queue), ctx)
+	try:
+		index = GrabixIndex.load(vcf)
+		for interval in iter_tasks(task_queue):
+			num_tasks += 1
+
+			# seek to the start of the interval and stream lines from there
+			lines = grab_lines(vcf, interval[0], interval[1], index)
+			while True:
+				variant_lines = [line.decode('latin1').rstrip('\r\n') for line in itertools.islice(lines, chunk_size)]
+				if not variant_lines:
+					break
+
+				process_line_data(variant_lines, log, f, vcf_info, ctx)
+
+				num_variants_processed += len(variant_lines)
 
-				command = ["grabix", "grab", vcf, str(start), str(end)]
-				output = check_output(command)
+			# the next task continues elsewhere in the vcf
+			finish_task(f)
+			print("Pid %s: processed %d variants" % (p.pid, num_variants_processed))
+	finally:
+		f.close()
+
+	if stats_queue is not None:
+		stats_queue.put({'pid': p.pid, 'tasks': num_tasks, 'variants': num_variants_processed, 'seconds': time.time() - t,
+			'spilled': getattr(f, 'spilled', [])})
+
+def split_multi(val, sep):
+	# multi-valued fields are stored as arrays, single values as scalars
+	tmp = val.split(sep)
+	if len(tmp) > 1:
+		return tmp
+	return tmp[0]
+
+def convert_gene(key, val, result, tmp_dict, group, log):
+	source = key[len('Gene_'):] # refGene or ensGene
+	if 'x3b' in val:
+		tmp = val.split('\\x3b')
+	else:
+		tmp = val.split(',')
+	try:
+		tmp2 = tmp_dict['GeneDetail_' + source]
+	except KeyError:
+		log.write("KeyError: %s, %s" % (key, val))
+		return
+	if tmp2 == '.':
+		return
+
+	func = tmp_dict['Func_' + source]
+	tmp2 = tmp2.split('\\x3b')
+	if tmp2[0].startswith('dist'):
+		if func == 'downstream':
+			result['Upstream_' + source] = tmp[0]
+			if 'NONE' not in tmp2[0]:
+				result['Distance_to_upstream_' + source] = int(tmp2[0].replace('dist\\x3d', ''))
+		elif func == 'upstream':
+			result['Downstream_' + source] = tmp[0]
+			if 'NONE' not in tmp2[0]:
+				result['Distance_to_downstream_' + source] = int(tmp2[0].replace('dist\\x3d', ''))
+		elif func in ['intergenic', 'upstream\\x3bdownstream']:
+			result['Upstream_' + source] = tmp[0]
+			result['Downstream_' + source] = tmp[1]
+			if 'NONE' not in tmp2[0]:
+				result['Distance_to_upstream_' + source] = int(tmp2[0].replace('dist\\x3d', ''))
+			if 'NONE' not in tmp2[1]:
+				result['Distance_to_downstream_' + source] = int(tmp2[1].replace('dist\\x3d', ''))
+	else:
+		if func in ['exonic', 'intronic', 'ncRNA_intronic']:
+			result[key] = split_multi(tmp_dict[key], '\\x3b')
+		elif func in ['UTR5', 'UTR3', 'splicing', 'ncRNA_splicing']:
+			result[key] = tmp[0]
+			result['GeneDetail_' + source] = split_multi(tmp_dict['GeneDetail_' + source], '\\x3b')
+
+# sub-field names of the nested AAChange documents
+aachange_names = {
+	'AAChange_refGene' : ['Gene', 'RefSeq', 'exon_id_rg', 'cdna_change_rg', 'aa_change_rg'],
+	'AAChange_ensGene' : ['Ensembl_Gene_ID', 'Ensembl_Transcript_ID', 'exon_id_eg', 'cdna_change_eg', 'aa_change_eg']
+}
+
+def convert_aachange(key, val, result, tmp_dict, group, log):
+	if val == 'UNKNOWN':
+		return
+
+	gene_name, transcript_name, exon_name, cdna_name, aa_name = aachange_names[key]
+	aac_list = []
+	aac_dict = {}
+	for subval in val.split(','):
+		gene, transcript, exon, *cdna_aa = subval.split(':')
+		aac_dict[gene_name] = gene
+		aac_dict[transcript_name] = transcript
+		aac_dict[exon_name] = exon
+		if len(cdna_aa) == 2:
+			aac_dict[cdna_name] = cdna_aa[0]
+			aac_dict[aa_name] = cdna_aa[1]
+		else:
+			continue
+		aac_list.append(aac_dict)
+	result[key] = aac_list
+
+def make_info_integer_converter(key, cohort):
+	if key in ['CIPOS', 'CIEND']:
+		def convert_ci(key, val, result, tmp_dict, group, log):
+			result[key + group if cohort else key] = val # keep as is (i.e. string type)
+		return convert_ci
+	if key == 'FS':
+		def convert_fs(key, val, result, tmp_dict, group, log):
+			result[key + group] = val # keep FS integer string as is
+		return convert_fs
+
+	def convert_integer(key, val, result, tmp_dict, group, log):
+		try:
+			result[key + group] = int(val)
+		except ValueError:
+			log.write("Interger parsing problem: %s, %s\n" % (key, val))
+	return convert_integer
+
+def make_info_float_converter(cohort):
+	def convert_float(key, val, result, tmp_dict, group, log):
+		out_key = key + group if cohort else key
+		try:
+			x = float(val)
+		except ValueError:
+			result[out_key] = -999.99
+			return
+		if math.isnan(x):
+			x = -999.99
+		elif math.isinf(x):
+			x = 999.99
+		result[out_key] = x
+	return convert_float
+
+def convert_snp(key, val, result, tmp_dict, group, log):
+	if key == 'snp138NonFlagged':
+		result[key] = val
+	elif result.get('dbSNP_ID') is None:
+		result['dbSNP_ID'] = val
+
+def convert_icgc_id(key, val, result, tmp_dict, group, log):
+	result['ICGC_ID'] = val
+
+def convert_icgc_occurrence(key, val, result, tmp_dict, group, log):
+	tmp_list = []
+	for item in val.split(','):
+		tmp2 = item.split('|')
+		tmp_list.append({'ICGC_Cancer_Site': tmp2[0], 'ICGC_Allele_Count': tmp2[1], 'ICGC_Allele_Number': tmp2[2], 'ICGC_Allele_Frequency': tmp2[3]})
+	result['ICGC_nested'] = tmp_list
+
+def convert_clnsig(key, val, result, tmp_dict, group, log):
+	tmp = []
+	tmp_sig = val.split('|')
+	tmp_dbn = tmp_dict['CLNDN'].split('|')
+	tmp_revstat = tmp_dict['CLNREVSTAT'].split('|')
+
+	for i in range(len(tmp_sig)):
+		tmp.append({'CLNSIG': tmp_sig[i], 'CLNDN': tmp_dbn[i], 'CLNREVSTAT': tmp_revstat[i]})
+	result['CLNVAR_nested'] = tmp
+
+def make_gwas_catalog_converter(ctx):
+	def convert_gwas_catalog(key, val, result, tmp_dict, group, log):
+		val = val.replace('Name\\x3d', '')
+		tmp = [ctx.leading_underscore_pattern.sub('', item) for item in val.split(',')]
+		result['gwasCatalog'] = tmp if len(tmp) > 1 else tmp[0]
+	return convert_gwas_catalog
+
+def make_score_name_converter(ctx):
+	def convert_score_name(key, val, result, tmp_dict, group, log):
+		tmp = val.split('\\x3b')
+		if len(tmp) == 2:
+			result[key + '_Score'] = int(ctx.score_pattern.sub('', tmp[0]))
+			result[key + '_Name'] = ctx.name_pattern.sub('', tmp[1])
+	return convert_score_name
+
+def convert_wgrna(key, val, result, tmp_dict, group, log):
+	result[key] = val.replace('Name\\x3d', '')
+
+def convert_gtex(key, val, result, tmp_dict, group, log):
+	genes = val.split('|')
+	tissues = tmp_dict["GTEx_V6_tissue"].split('|')
+	result['GTEx_nested'] = [{"GTEx_V6_gene": genes[i], "GTEx_V6_tissue": tissues[i]} for i in range(len(genes))]
+
+def convert_cosmic(key, val, result, tmp_dict, group, log):
+	cosmic_id, occurrence = val.split("\\x3b")
+	cosmic_id = cosmic_id.split('\\x3d')[1]
+	occurrence = occurrence.split('\\x3d')[1]
+
+	result['COSMIC_ID'] = split_multi(cosmic_id, ',')
+	cosmic_list = []
+	for item in occurrence.split(','):
+		occurrence, cancer_site = item.split('(')
+		cancer_site = cancer_site.replace(')', '')
+		cosmic_list.append({'COSMIC_Occurrence': int(occurrence), 'COSMIC_Cancer_Site': cancer_site})
+	result['COSMIC_nested'] = cosmic_list
+
+def convert_variant_type(key, val, result, tmp_dict, group, log):
+	result['VariantType'] = val # replace with "VariantType"
+
+def make_info_string_converter(cohort, value_mapping):
+	def convert_string(key, val, result, tmp_dict, group, log):
+		val = val.replace('\\x3d', '=')
+		val = val.replace('\\x3b',';')
+		if cohort:
+			result[key + group] = val
+		elif value_mapping is not None:
+			result[key] = value_mapping.get(val, val)
+		else:
+			result[key] = val
+	return convert_string
+
+def make_info_converter(ctx, key, field_type):
+	"""Pick the converter for an INFO field, returns None for fields that are not indexed"""
+	cohort = key in ctx.cohort_specific
+	if key == 'CSQ' and annot == 'vep':
+		return ctx.convert_csq
+	elif key in ['Gene_refGene', 'Gene_ensGene']:
+		return convert_gene
+	elif key in ["GeneDetail_refGene", "GeneDetail_ensGene"]:
+		return None
+	elif key in aachange_names:
+		return convert_aachange
+	elif field_type == 'integer':
+		return make_info_integer_converter(key, cohort)
+	elif field_type == 'float':
+		return make_info_float_converter(cohort)
+	elif 'snp' in key:
+		return convert_snp
+	elif key in ['dbSNP_ID', 'COSMIC_ID']:
+		return None # skip because Annovar does not populate this field for unknown reason
+	elif key == 'ICGC_Id':
+		return convert_icgc_id
+	elif key == 'ICGC_Occurrence':
+		return convert_icgc_occurrence
+	elif key in ['CLINSIG', 'CLNSIG']:
+		return convert_clnsig
+	elif key.startswith('CLN'):
+		return None
+	elif key == 'gwasCatalog':
+		return make_gwas_catalog_converter(ctx)
+	elif key in ['tfbsConsSites', 'targetScanS']:
+		return make_score_name_converter(ctx)
+	elif key == 'wgRna':
+		return convert_wgrna
+	elif key == "GTEx_V6_gene":
+		return convert_gtex
+	elif key == 'GTEx_V6_tissue':
+		return None
+	elif 'cosmic' in key:
+		return convert_cosmic
+	elif key == 'VT':
+		return convert_variant_type
+	else: # other string type
+		return make_info_string_converter(cohort, ctx.value_mappings.get(key))
+
+def make_csq_local_converter(ctx, key, field_type):
+	"""Converter for a CSQ sub-field kept in the per-transcript nested documents"""
+	if key in ['SIFT', 'PolyPhen']:
+		p = ctx.sift_polyphen_pattern
+		def convert_sift_polyphen(key, val, out):
+			if val == '':
+				return
+			m = p.match(val)
+			if m:
+				out[key + '_pred'] = m.group(1)
+				out[key + '_score'] = float(m.group(2))
+			else: # empty value or only pred or score are included in vep annotation
 				try:
-					output = output.decode('latin1') #ascii')
+					out[key + '_score'] = float(val)
 				except ValueError:
-					log.write("decoding error: %s, %s\n" % (start, end))
-					start = end + 1
-					continue
-				# remove the header lines from output
-				lines = output.splitlines()
-				variant_lines = lines[vcf_info['num_header_lines']:]
+					pass
+		return convert_sift_polyphen
+	elif field_type == 'integer':
+		def convert_integer(key, val, out):
+			if val == '':
+				out[key] = -999
+				return
+			try:
+				out[key] = int(val)
+			except ValueError:
+				tmp = val.split('-')
+				try:
+					out[key] = int(tmp[0])
+				except ValueError:
+					try:
+						out[key] = int(tmp[1])
+					except ValueError:
+						pass
+		return convert_integer
+	elif key == 'Consequence':
+		def convert_consequence(key, val, out):
+			if val != '':
+				out[key] = split_multi(val, '&')
+		return convert_consequence
+	else:
+		def convert_string(key, val, out):
+			if val != '':
+				out[key] = val
+		return convert_string
+
+def make_csq_global_converter(key, field_type):
+	"""Converter for a CSQ sub-field that is variant specific and moved to the top level document, returns None for skipped fields"""
+	if field_type == 'integer':
+		def convert_integer(key, val, result):
+			if val == '':
+				return
+			tmp = [int(item) for item in val.split('&')]
+			result[key] = tmp if len(tmp) > 1 else tmp[0]
+		return convert_integer
+	elif key == "AF":
+		return None # skip AF annotation from VEP, as it is in correct
+	elif field_type == 'float':
+		def convert_float(key, val, result):
+			if val == '':
+				if key not in result:
+					result[key] = -999.99
+				return
+			if '&.' in val or '.&' in val:
+				val = val.replace('&.', '&-999')
+				val = val.replace('.&', '-999&')
+			tmp = val.split('&')
+			if len(tmp) > 1:
+				result[key] = [float(item) for item in tmp]
+			else:
+				result[key] = float(val)
+		return convert_float
+	elif key == 'SOMATIC':
+		return None
+	elif key == 'Existing_variation':
+		def convert_existing_variation(key, val, result):
+			if val == '':
+				return
+			tmp_variants = val.split('&')
+			cosmic_ids = [item for item in tmp_variants if item.startswith('COSM')]
+			dbsnp_ids = [item for item in tmp_variants if item.startswith('rs')]
+			if len(cosmic_ids) > 0:
+				result['COSMIC_ID'] = cosmic_ids if len(cosmic_ids) > 1 else cosmic_ids[0]
+			if len(dbsnp_ids) > 0:
+				result['dbSNP_ID'] = dbsnp_ids if len(dbsnp_ids) > 1 else dbsnp_ids[0] # use array value for multiple ids
+		return convert_existing_variation
+	elif key in ['CLIN_SIG', 'MAX_AF_POPS']:
+		def convert_multi(key, val, result):
+			if val != '':
+				result[key] = split_multi(val, '&')
+		return convert_multi
+	else:
+		def convert_string(key, val, result):
+			result[key] = val
+		return convert_string
+
+def make_csq_converter(ctx, vcf_info):
+	"""VEP annotation repeats the variant specific features, such as MAF, for every transcript, so move them to global space.
+	Only gene and consequence related info is kept in the nested structure"""
+	local_plan = []
+	global_plan = []
+	for i, key in enumerate(vcf_info['csq_fields']):
+		if key in vcf_info['csq_dict_local']:
+			local_plan.append((i, key, make_csq_local_converter(ctx, key, vcf_info['csq_dict_local'][key]['type'])))
+		if key in vcf_info['csq_dict_global']:
+			convert = make_csq_global_converter(key, vcf_info['csq_dict_global'][key]['type'])
+			if convert is not None:
+				global_plan.append((i, key, convert))
+
+	def convert_csq(key, val, result, tmp_dict, group, log):
+		csq_list = []
+		for csq in val.split(','):
+			csq2 = csq.split('|')
+			num_fields = len(csq2)
+
+			csq_dict_local = {}
+			for i, key2, convert in local_plan:
+				if i < num_fields:
+					convert(key2, csq2[i], csq_dict_local)
+			for i, key2, convert in global_plan:
+				if i < num_fields:
+					convert(key2, csq2[i], result)
+			csq_list.append(csq_dict_local)
+
+		result['CSQ_nested'] = csq_list
+	return convert_csq
+
+def make_format_converter(key, field_type):
+	"""Converter for a FORMAT sub-field of a sample column"""
+	if key in ['GT', 'PGT', 'PID']:
+		def convert_raw(key, val, out, log):
+			out[key] = val
+		return convert_raw
+
+	if key == 'DP':
+		scalar = int
+	elif field_type == 'float':
+		scalar = float
+	elif field_type == 'integer':
+		scalar = int
+	else:
+		scalar = None
 
-				process_line_data(variant_lines, log, f, vcf_info)
+	def convert(key, val, out, log):
+		# handle comma-delimited numeric values
+		if ',' in val:
+			if key == 'AD':
+				ad_ref, ad_alt, *_ = val.split(',')
+				out['AD_ref'] = int(ad_ref)
+				out['AD_alt'] = int(ad_alt)
+			elif key == 'PL':
+				out[key] = val
+			else:
+				log.write("Unknown type: %s, %s\n" % (key, val))
+		elif scalar is not None:
+			out[key] = scalar(val)
+		else:
+			log.write("Unknown type: %s, %s\n" % (key, val))
+	return convert
+
+class ParseContext:
+	"""Lookup tables used for every variant line. Built once per parser process instead of once per line"""
+
+	def __init__(self, vcf_info):
+		with open('./utils/default_vcf_mappings.json') as fp:
+			patho_dict = json.load(fp)
+		self.value_mappings = {key: val['value_mapping'] for key, val in patho_dict['INFO_FIELDS'].items() if 'value_mapping' in val}
+
+		self.sift_polyphen_pattern = re.compile(r'^(.*?)\((.*)\)') # for parsing SIFT and PolyPhen predition and score
+		self.leading_underscore_pattern = re.compile('^_')
+		self.score_pattern = re.compile('Score\\\\x3d')
+		self.name_pattern = re.compile('Name\\\\x3d')
+
+		self.excluded_keys = frozenset(excluded_list)
+		self.cohort_specific = frozenset(cohort_specific)
+
+		self.fixed_header = vcf_info['col_header'][:7]
+		self.sample_ids = vcf_info['col_header'][9:]
+		self.sample_index = {sample_id: i for i, sample_id in enumerate(self.sample_ids)}
+		self.pedigree = make_pedigree_table(vcf_info['ped_info'] if ped else {}, self.sample_index)
+
+		# (Sample_IDs, pedigree table) of the sample columns of each group, the control vcf of case/control has a header of its own
+		self.group_samples = {'': (self.sample_ids, self.pedigree), '_case': (self.sample_ids, self.pedigree)}
+		if 'control_col_header' in vcf_info:
+			control_ids = vcf_info['control_col_header'][9:]
+			control_index = {sample_id: i for i, sample_id in enumerate(control_ids)}
+			self.group_samples['_control'] = (control_ids, make_pedigree_table(vcf_info['ped_info'] if ped else {}, control_index))
+
+		# the inheritance models are labelled while parsing, except for case/control whose control samples have no pedigree
+		# and for side-car labels, which are written after indexing
+		self.annotate_inheritance = bool(ped) and not control_vcf and label_write != 'sidecar'
+		# only the child get_family_dict picks for each family is labelled, like the annotation of an existing index
+		self.probands = ped_probands(vcf_info['ped_info'], self.sample_ids) if self.annotate_inheritance else frozenset()
+
+		# sample columns that are not stored: no GT, and hom_ref GT unless a ped file needs the whole family
+		self.skip_prefixes = ('.|.', './.', '0|.', '.|0', '0/.')
+		self.skip_exact = frozenset()
+		if not ped:
+			self.skip_prefixes += ('0/0', '0|0', '0:')
+			self.skip_exact = frozenset(['0'])
+
+		# one ready to call converter per field, so parsing a value is a single lookup and call
+		self.convert_csq = make_csq_converter(self, vcf_info) if annot == 'vep' else None
+		self.info_converters = {key: make_info_converter(self, key, val['type']) for key, val in vcf_info['info_dict'].items()}
+		self.format_converters = {key: make_format_converter(key, val['type']) for key, val in vcf_info['format_dict'].items()}
+
+def benchmark_parsing(vcf, num_lines, vcf_info):
+	"""Compare parsing throughput with the lookup tables built once against rebuilding them for every line"""
+	variant_lines = [line.decode('latin1').rstrip('\r\n') for line in grab_lines(vcf, 1, num_lines)]
+	num_lines = len(variant_lines)
+
+	log = open(os.devnull, 'w')
+	f = BulkFileSink(os.devnull)
+
+	t = time.time()
+	for line in variant_lines:
+		process_line_data([line], log, f, vcf_info, ParseContext(vcf_info))
+	uncached = time.time() - t
 
-				num_variants_processed += end - start + 1
+	t = time.time()
+	process_line_data(variant_lines, log, f, vcf_info, ParseContext(vcf_info))
+	cached = time.time() - t
 
-				print("Pid %s: processed %d variants" % (p.pid, num_variants_processed))
+	f.close()
+	log.close()
 
-				# update start and end positions
-				start = end + 1
+	print("Parsed %d variant lines" % num_lines)
+	print("Lookup tables rebuilt per line: %.1f lines/sec" % (num_lines/uncached))
+	print("Lookup tables built once: %.1f lines/sec" % (num_lines/cached))
 
-				if start >= interval[1]:
-					break
+class ListSink:
+	"""Keep the parsed documents in memory, used to sample documents for the mapping optimizer"""
 
-def parse_info_fields(info_fields, result, log, vcf_info, group = ''):
-	with open('./utils/default_vcf_mappings.json') as f2:
-		patho_dict = json.load(f2)
+	def __init__(self):
+		self.docs = []
 
-	p = re.compile(r'^(.*?)\((.*)\)') # for parsing SIFT and PolyPhen predition and score
+	def put(self, doc):
+		self.docs.append(doc)
+
+	def close(self):
+		pass
+
+def sample_documents(vcf, num_lines, vcf_info):
+	variant_lines = [line.decode('latin1').rstrip('\r\n') for line in grab_lines(vcf, 1, num_lines)]
+	log = open(os.devnull, 'w')
+	f = ListSink()
+	process_line_data(variant_lines, log, f, vcf_info, ParseContext(vcf_info))
+	log.close()
+	return(f.docs)
+
+def parse_info_fields(info_fields, result, log, vcf_info, ctx, group = ''):
 	tag_fields = [item for item in info_fields if not '=' in item]
 	for tag in tag_fields:
 		result[tag] = 'Yes'
 
 	tmp = [info for info in info_fields if '=' in info]
 	tmp_dict = {d[0].replace('.', '_'):d[1] for d in [item.split('=') for item in tmp]} # i.e. "Gene.refGene" "GeneDetail.refGene", "Gene.ensGene" "GeneDetail.ensGene"
-	for item in excluded_list:
-		if item in tmp_dict:
-			del tmp_dict[item]
 
+	info_converters = ctx.info_converters
 	for key, val in tmp_dict.items():
-		if key not in  vcf_info['info_dict']:
+		if key in ctx.excluded_keys:
+			continue
+		try:
+			convert = info_converters[key]
+		except KeyError:
 			log.write("Key not exists: %s" % key)
 			continue
-		if val == '.' and key != 'CSQ':
+		if convert is None or (val == '.' and key != 'CSQ'):
 			continue
+		convert(key, val, result, tmp_dict, group, log)
 
-		if key == 'CSQ' and annot == 'vep':
-			# VEP annotation repeated the variant specific features, such as MAF, so move them to globol space.
-			# Only keey gene and consequence related info in the nested structure
-			csq_list = []
-			info_csq = val.split(',')
-
-			for csq in info_csq:
-				csq2	= csq.split('|')
-				csq_dict2 = dict(zip(vcf_info['csq_fields'], csq2)) # map names to values for CSQ annotation sub-fields
-
-				# partition csq_dict2 into global and local space
-				csq_dict2_local = {key:val for key, val in csq_dict2.items() if key in vcf_info['csq_dict_local']}
-				csq_dict2_global = {key:val for key, val in csq_dict2.items() if key in vcf_info['csq_dict_global']}
-
-
-				csq_dict3_local = {}
-
-				for key2, val2 in csq_dict2_local.items():
-					if key2 in ['SIFT', 'PolyPhen']:
-						if val2 == '':
-							continue
-
-						m = p.match(val2)
-						if m:
-							csq_dict3_local[key2 + '_pred'] = m.group(1)
-							csq_dict3_local[key2 + '_score'] = float(m.group(2))
-						else: # empty value or only pred or score are included in vep annotation
-							try:
-								x = float(val2)
-								csq_dict3_local[key2 + '_score'] = x
-							except ValueError:
-								continue
-
-					elif vcf_info['csq_dict_local'][key2]['type'] == 'integer':
-						if val2 == '':
-							csq_dict3_local[key2] = -999
-							continue
-						try:
-							csq_dict3_local[key2] = int(csq_dict2_local[key2])
-						except ValueError:
-							tmp = val2.split('-')
-							try:
-								x = int(tmp[0])
-								csq_dict3_local[key2] = x
-							except ValueError:
-								try:
-									x = int(tmp[1])
-									csq_dict3_local[key2] = x
-								except ValueError:
-									continue
-					elif key2 == 'Consequence':
-						if val2 == '':
-							continue
-
-						tmp = val2.split('&')
-						if len(tmp) > 1:
-							csq_dict3_local[key2] = tmp
-						else:
-							csq_dict3_local[key2] = tmp[0]
-					else:
-						if val2 == '':
-							continue
-						else:
-							csq_dict3_local[key2] = val2
-
-				for key2, val2 in csq_dict2_global.items():
-					if vcf_info['csq_dict_global'][key2]['type'] == 'integer':
-						if val2 == '':
-							continue
-						tmp = [int(item) for item in csq_dict2_global[key2].split('&')]
-						if len(tmp) > 1:
-							result[key2] = tmp
-						else:
-							result[key2] = tmp[0]
-					elif key2 == "AF":
-						continue # skip AF annotation from VEP, as it is in correct	
-					elif vcf_info['csq_dict_global'][key2]['type'] == 'float':
-						if val2 == '':
-							if key2 not in result:
-								result[key2] = -999.99
-						else:
-							if '&.' in val2 or '.&' in val2:
-								val2 = val2.replace('&.', '&-999')
-								val2 = val2.replace('.&', '-999&')
-							tmp = val2.split('&')
-							if len(tmp) > 1:
-								
-								result[key2] = [float(item) for item in tmp]
-							else:
-								result[key2] = float(val2)
-					else:
-						if key2 == 'SOMATIC':
-							continue
-						elif key2 == 'Existing_variation':
-							if val2 == '':
-								continue
-
-							tmp_variants = val2.split('&')
-							cosmic_ids = [item for item in tmp_variants if item.startswith('COSM')]
-							dbsnp_ids = [item for item in tmp_variants if item.startswith('rs')]
-							if len(cosmic_ids) > 0:
-								if len(cosmic_ids) > 1:
-									result['COSMIC_ID'] = cosmic_ids
-								else:
-									result['COSMIC_ID'] = cosmic_ids[0]
-							if len(dbsnp_ids) > 0:
-								if len(dbsnp_ids) > 1:
-									result['dbSNP_ID'] = dbsnp_ids # use array value
-								else:
-									result['dbSNP_ID'] = dbsnp_ids[0] # use scalar value
-						elif key2 in ['CLIN_SIG', 'MAX_AF_POPS']:
-							if val2 == '':
-								continue
-							tmp = val2.split('&')
-							if len(tmp) > 1:
-								result[key2] = tmp
-							else:
-								result[key2] = tmp[0]
-						else:
-							result[key2] = val2
-				csq_list.append(csq_dict3_local)
-
-			result['CSQ_nested'] = csq_list
-		elif key == 'Gene_refGene':
-			if 'x3b' in val:
-				tmp = val.split('\\x3b')
-			else:
-				tmp = val.split(',')
-			try:
-				tmp2 = tmp_dict['GeneDetail_refGene']
-			except KeyError:
-				log.write("KeyError: %s, %s" % (key, val))
-				continue
-			if tmp2 != '.':
-				tmp2 = tmp2.split('\\x3b')
-				if tmp2[0].startswith('dist'):
-					if tmp_dict['Func_refGene'] == 'downstream':
-						result['Upstream_refGene'] = tmp[0]
-						if 'NONE' not in tmp2[0]:
-							result['Distance_to_upstream_refGene'] = int(tmp2[0].replace('dist\\x3d', ''))
-					elif tmp_dict['Func_refGene'] == 'upstream':
-						result['Downstream_refGene'] = tmp[0]
-						if 'NONE' not in tmp2[0]:
-							result['Distance_to_downstream_refGene'] = int(tmp2[0].replace('dist\\x3d', ''))
-					elif tmp_dict['Func_refGene'] in ['intergenic', 'upstream\\x3bdownstream']:
-						result['Upstream_refGene'] = tmp[0]
-						result['Downstream_refGene'] = tmp[1]
-						if 'NONE' not in tmp2[0]:
-							result['Distance_to_upstream_refGene'] = int(tmp2[0].replace('dist\\x3d', ''))
-						if 'NONE' not in tmp2[1]:
-							result['Distance_to_downstream_refGene'] = int(tmp2[1].replace('dist\\x3d', ''))
-				else:
-					if tmp_dict['Func_refGene'] in ['exonic', 'intronic', 'ncRNA_intronic']:
-						tmp = tmp_dict['Gene_refGene'].split('\\x3b')
-						if len(tmp) == 1:
-							result['Gene_refGene'] = tmp[0]
-						else:
-							result['Gene_refGene'] = tmp
-					elif tmp_dict['Func_refGene'] in ['UTR5', 'UTR3', 'splicing', 'ncRNA_splicing']:
-						result['Gene_refGene'] = tmp[0]
-						tmp = tmp_dict['GeneDetail_refGene'].split('\\x3b')
-						if len(tmp) == 1:
-							result['GeneDetail_refGene'] = tmp[0]
-						else:
-							result['GeneDetail_refGene'] = tmp
-		elif key == 'Gene_ensGene':
-			if 'x3b' in val:
-				tmp = val.split('\\x3b')
-			else:
-				tmp = val.split(',')
-
-			tmp2 = tmp_dict['GeneDetail_ensGene']
-			if tmp2 != '.':
-				tmp2 = tmp2.split('\\x3b')
-				if tmp2[0].startswith('dist'):
-					if tmp_dict['Func_ensGene'] == 'downstream':
-						result['Upstream_ensGene'] = tmp[0]
-						if 'NONE' not in tmp2[0]:
-							result['Distance_to_upstream_ensGene'] = int(tmp2[0].replace('dist\\x3d', ''))
-					elif tmp_dict['Func_ensGene'] == 'upstream':
-						result['Downstream_ensGene'] = tmp[0]
-						if 'NONE' not in tmp2[0]:
-							result['Distance_to_downstream_ensGene'] = int(tmp2[0].replace('dist\\x3d', ''))
-					elif tmp_dict['Func_ensGene'] in ['intergenic', 'upstream\\x3bdownstream']:
-						result['Upstream_ensGene'] = tmp[0]
-						result['Downstream_ensGene'] = tmp[1]
-						if 'NONE' not in tmp2[0]:
-							result['Distance_to_upstream_ensGene'] = int(tmp2[0].replace('dist\\x3d', ''))
-						if 'NONE' not in tmp2[1]:
-							result['Distance_to_downstream_ensGene'] = int(tmp2[1].replace('dist\\x3d', ''))
-				else:
-					if tmp_dict['Func_ensGene'] in ['exonic', 'intronic', 'ncRNA_intronic']:
-						tmp = tmp_dict['Gene_ensGene'].split('\\x3b')
-						if len(tmp) == 1:
-							result['Gene_ensGene'] = tmp[0]
-						else:
-							result['Gene_ensGene'] = tmp
-					elif tmp_dict['Func_ensGene'] in ['UTR5', 'UTR3', 'splicing', 'ncRNA_splicing']:
-						result['Gene_ensGene'] = tmp[0]
-						tmp = tmp_dict['GeneDetail_ensGene'].split('\\x3b')
-						if len(tmp) == 1:
-							result['GeneDetail_ensGene'] = tmp[0]
-						else:
-							result['GeneDetail_ensGene'] = tmp
+	return(result)
 
-		elif key in ["GeneDetail_refGene", "GeneDetail_ensGene"]:
+# ped file fields copied into every sample document of a family member, only when they are set
+pedigree_static_fields = [('Family_ID', 'family'), ('Father_ID', 'father'), ('Mother_ID', 'mother'), ('Sex', 'sex'), ('Phenotype', 'phenotype'), ('Age', 'age'),
+	('Affected_Siblings_IDs', 'affected_sibs_id'), ('Affected_Siblings_Ages', 'affected_sibs_age'), ('Affected_Siblings_Sex', 'affected_sibs_sex'),
+	('Unaffected_Siblings_IDs', 'unaffected_sibs_id'), ('Unaffected_Siblings_Ages', 'unaffected_sibs_age'), ('Unaffected_Siblings_Sex', 'unaffected_sibs_sex')]
+
+def make_pedigree_table(ped_info, sample_index):
+	"""One entry per sample column: None for samples not in the ped file, otherwise
+	(static fields, father column, mother column, affected sibling columns, unaffected sibling columns)
+	so that adding the family genotypes of a variant is plain list indexing"""
+	table = [None] * len(sample_index)
+	for sample_id, column in sample_index.items():
+		if sample_id not in ped_info:
 			continue
-		elif key == 'AAChange_refGene':
-			aac_list = []
-			aac_dict = {}
+		info = ped_info[sample_id]
 
-			if val == 'UNKNOWN':
-				continue
-			else:
-				val_list = val.split(',')
-				for subval in val_list:
-					gene, refseq, exon, *cdna_aa = subval.split(':')
-					aac_dict['Gene'] = gene
-					aac_dict['RefSeq'] = refseq
-					aac_dict['exon_id_rg'] = exon
-
-					if len(cdna_aa) == 2:
-						aac_dict['cdna_change_rg'] = cdna_aa[0]
-						aac_dict['aa_change_rg'] = cdna_aa[1]
-					else:
-						continue
-					aac_list.append(aac_dict)
+		static_fields = {}
+		for name, key in pedigree_static_fields:
+			# family, father, mother, sex and phenotype are always included, the others only if they exist
+			if key in ['family', 'father', 'mother', 'sex', 'phenotype'] or info.get(key) is not None:
+				static_fields[name] = info.get(key)
+		for name, parent in [('Mother_Phenotype', 'mother'), ('Father_Phenotype', 'father')]:
+			if info[parent] in ped_info:
+				static_fields[name] = ped_info[info[parent]]['phenotype']
 
-			result[key] = aac_list
-		elif key == 'AAChange_ensGene':
-			aac_list = []
-			aac_dict = {}
-			if val == 'UNKNOWN':
-				continue
-			else:
-				val_list = val.split(',')
-				for subval in val_list:
-					gene, transcript, exon, *cdna_aa = subval.split(':')
-					aac_dict['Ensembl_Gene_ID'] = gene
-					aac_dict['Ensembl_Transcript_ID'] = transcript
-					aac_dict['exon_id_eg'] = exon
-					if len(cdna_aa) == 2:
-						aac_dict['cdna_change_eg'] = cdna_aa[0]
-						aac_dict['aa_change_eg'] = cdna_aa[1]
-					else:
-						continue
+		sib_columns = []
+		for key in ['affected_sibs_id', 'unaffected_sibs_id']:
+			sib_ids = info.get(key).split(',') if info.get(key) is not None else []
+			sib_columns.append([sample_index[sid] for sid in sib_ids if sid not in ['-9', 'NA'] and sid in sample_index])
 
-					aac_list.append(aac_dict)
-			result[key] = aac_list
+		table[column] = (static_fields, sample_index.get(info['father']), sample_index.get(info['mother']), sib_columns[0], sib_columns[1])
 
-		elif vcf_info['info_dict'][key]['type'] == 'integer':
-			if key == 'CIPOS' or key == 'CIEND':
-				if key in cohort_specific:
-					result[key + group] = val # keep as is (i.e. string type)
-				else:
-					result[key] = val
-			else:
-				if key == 'FS':
-					result[key + group] = val # keep FS integer string as is
-				else:
-					try:
-						result[key + group] = int(val)
-						if math.isnan(int(val)):
-							if key in cohort_specific:
-								result[key + group] = -999
-							else:
-								result[key] = -999
-					except ValueError:
-						log.write("Interger parsing problem: %s, %s\n" % (key, val))
-						continue
+	return(table)
 
-		elif vcf_info['info_dict'][key]['type'] == 'float':
-			try:
-				x = float(val)
-				if math.isnan(x):
-					if key in cohort_specific:
-						result[key + group] = -999.99
-					else:
-						result[key] = -999.99
+def carrier_columns(sample_columns, ctx):
+	"""Indexes of the sample columns to parse. One prefix test per column, so the rest of the per-line work scales with the number of carriers"""
+	skip_prefixes = ctx.skip_prefixes
+	skip_exact = ctx.skip_exact
+	return [i for i, sample_data in enumerate(sample_columns) if not sample_data.startswith(skip_prefixes) and sample_data not in skip_exact]
 
-				elif math.isinf(x):
-					if key in cohort_specific:
-						result[key + group] = 999.99
-					else:
-						result[key] = 999.99
-				else:
-					if key in cohort_specific:
-						result[key + group] = x
-					else:
-						result[key] = x
-			except ValueError:
-				if key in cohort_specific:
-					result[key + group] = - 999.99
-				else:
-					result[key] = -999.99
-				#log.write("Parsing problem: %s %s. value is assigned with -999.99\n" % (key, val))
-				continue
-		elif 'snp' in key:
-			if key == 'snp138NonFlagged':
-				result[key] = val
-			else:
-				if 'dbSNP_ID' in result and result['dbSNP_ID'] is not None:
-					continue
-				else:
-					result['dbSNP_ID'] = val
-		elif key == 'dbSNP_ID':
-			continue # skip because Annovar does not populate this field for unknown reason
-		elif key == 'COSMIC_ID':
-			continue # same reason as above
-		elif key == 'ICGC_Id':
-			result['ICGC_ID'] = val
-		elif key == 'ICGC_Occurrence':
-			tmp = val.split(',')
-			tmp_list = []
-			for item in tmp:
-				tmp_dict2 = {}
-				tmp2 = item.split('|')
-				tmp_dict2.update({'ICGC_Cancer_Site': tmp2[0]})
-				tmp_dict2.update({'ICGC_Allele_Count': tmp2[1]})
-				tmp_dict2.update({'ICGC_Allele_Number': tmp2[2]})
-				tmp_dict2.update({'ICGC_Allele_Frequency': tmp2[3]})
-				tmp_list.append(tmp_dict2)
-
-			result['ICGC_nested'] = tmp_list
-
-		elif key in ['CLINSIG', 'CLNSIG'] and val != '.':
-			tmp = []
-			tmp_sig = val.split('|')
-			tmp_dbn = tmp_dict['CLNDN'].split('|')
-			tmp_revstat = tmp_dict['CLNREVSTAT'].split('|')
-
-			if len(tmp_sig) > 0:
-				for i in range(len(tmp_sig)):
-					tmp_dict2 = {'CLNSIG': tmp_sig[i]}
-					if tmp_dbn is not None:
-						tmp_dict2.update({'CLNDN': tmp_dbn[i]})
-					if tmp_revstat is not None:
-						tmp_dict2.update({'CLNREVSTAT': tmp_revstat[i]})
-					tmp.append(tmp_dict2)
-
-				result['CLNVAR_nested'] = tmp
-
-		elif key.startswith('CLN'):
-			continue
-		elif key == 'gwasCatalog':
-			val = val.replace('Name\\x3d', '')
-			tmp = [re.sub('^_', '', item) for item in val.split(',')]
-			if len(tmp) > 1:
-				result['gwasCatalog'] = tmp
-			else:
-				result['gwasCatalog'] = tmp[0]
-		elif key in ['tfbsConsSites', 'targetScanS']:
-			tmp = val.split('\\x3b')
-			if len(tmp) == 2:
-				score = re.sub('Score\\\\x3d', '', tmp[0])
-				name = re.sub('Name\\\\x3d', '', tmp[1])
-				result[key + '_Score'] = int(score)
-				result[key + '_Name'] = name
-		elif key == 'wgRna':
-			val = val.replace('Name\\x3d', '')
-			result[key] = val
-		elif key == "GTEx_V6_gene":
-			genes = val.split('|')
-			tissues = tmp_dict["GTEx_V6_tissue"].split('|')
-			if len(genes) > 0:
-				tmp = []
-				for i in range(len(genes)):
-					tmp.append({"GTEx_V6_gene": genes[i], "GTEx_V6_tissue": tissues[i]})
-				result['GTEx_nested'] = tmp
-		elif key == 'GTEx_V6_tissue':
-			continue
-		elif 'cosmic' in key:
-			cosmic_id, occurrence = val.split("\\x3b")
-			cosmic_id = cosmic_id.split('\\x3d')[1]
-			occurrence = occurrence.split('\\x3d')[1]
-
-			tmp = cosmic_id.split(',')
-			if len(tmp) > 1:
-				result['COSMIC_ID'] = tmp
-			else:
-				result['COSMIC_ID'] = tmp[0]
-			tmp = occurrence.split(',')
-			cosmic_list = []
-			for item in tmp:
-				occurrence, cancer_site = item.split('(')
-				cancer_site = cancer_site.replace(')', '')
-				cosmic_list.append({'COSMIC_Occurrence': int(occurrence), 'COSMIC_Cancer_Site': cancer_site})
-			result['COSMIC_nested'] = cosmic_list
-		elif key == 'VT':
-			result['VariantType'] = val # replace with "VariantType"
-		else: # other string type
-			val = val.replace('\\x3d', '=')
-			val = val.replace('\\x3b',';')
-			if key in cohort_specific:
-				result[key + group] = val
-			else:
-				try:
-					result[key] = patho_dict['INFO_FIELDS'][key]['value_mapping'][val]
-				except KeyError:
-					result[key] = val
-					continue
-
-	return(result)
-
-def parse_sample_info(result, format_fields, sample_info, log, vcf_info, group = ''):
+def parse_sample_info(result, format_fields, sample_columns, log, vcf_info, ctx, group = ''):
 	sample_data_array = []
+	format_converters = ctx.format_converters
+	sample_ids, pedigree = ctx.group_samples[group]
+	format_fields = format_fields if isinstance(format_fields, list) else [format_fields]
 
-	for sample_id, sample_data in sample_info.items():
+	for i in carrier_columns(sample_columns, ctx):
+		sample_id = sample_ids[i]
+		sample_data = sample_columns[i]
 		sample_data_dict = {}
 
-		# do not waste time and storage for no GT
-		if sample_data.startswith('.|.') or sample_data.startswith('./.') or sample_data.startswith('0|.') or sample_data.startswith('.|0') or sample_data.startswith('0/.'):
-			continue
-		# skip parsing hom_ref GT if no ped file is specified to save time and disk space
-		if not ped and (sample_data.startswith('0/0') or sample_data.startswith('0|0') or sample_data == '0' or sample_data.startswith('0:')):
-			continue
-
-		format_fields = format_fields if isinstance(format_fields, list) else [format_fields]
 		tmp = sample_data.split(':')
 		sample_sub_info_dict = dict(zip(format_fields, tmp))
 
-		# handle comma-delimited numeric values
 		for (key, val) in sample_sub_info_dict.items():
 			if val == '.':
 				continue
-			if key in ['GT', 'PGT', 'PID']:
-				sample_data_dict[key] = val
-			elif ',' in val:
-				sub_items = val.split(',')
-				if key == 'AD':
-					sample_data_dict['AD_ref'], sample_data_dict['AD_alt'], *_ = sub_items
-					sample_data_dict['AD_ref'] = int(sample_data_dict['AD_ref'])
-					sample_data_dict['AD_alt'] = int(sample_data_dict['AD_alt'])
-				elif key == 'PL':
-					sample_data_dict[key] = val
-				else:
-					log.write("Unknown type: %s, %s\n" % (key, val))
-					continue
-			elif key == 'DP':
-				sample_data_dict[key] = int(val)
-			else:
-				if vcf_info['format_dict'][key]['type'] == 'float':
-					sample_data_dict[key] = float(val)
-				elif vcf_info['format_dict'][key]['type'] == 'integer':
-					sample_data_dict[key] = int(val)
-				else:
-					log.write("Unknown type: %s, %s\n" % (key, val))
-					continue
+			try:
+				convert = format_converters[key]
+			except KeyError:
+				convert = format_converters[key] = make_format_converter(key, None)
+			convert(key, val, sample_data_dict, log)
 
 		# add information from ped file
-		if ped and sample_id in  vcf_info['ped_info']:
-			sample_data_dict['Family_ID'] = vcf_info['ped_info'][sample_id]['family']
-			sample_data_dict['Father_ID'] = vcf_info['ped_info'][sample_id]['father']
-			sample_data_dict['Mother_ID'] = vcf_info['ped_info'][sample_id]['mother']
-			sample_data_dict['Sex'] = vcf_info['ped_info'][sample_id]['sex']
-			sample_data_dict['Phenotype'] = vcf_info['ped_info'][sample_id]['phenotype']
-
-			# fields below may not be always available, so only include them if they exist
-			if 'age' in vcf_info['ped_info'][sample_id] and  vcf_info['ped_info'][sample_id]['age'] is not None:
-				sample_data_dict['Age'] = vcf_info['ped_info'][sample_id]['age']
-			if 'affected_sibs_id' in vcf_info['ped_info'][sample_id] and vcf_info['ped_info'][sample_id]['affected_sibs_id'] is not None:
-				sample_data_dict['Affected_Siblings_IDs'] = vcf_info['ped_info'][sample_id]['affected_sibs_id']
-			if 'affected_sibs_age' in vcf_info['ped_info'][sample_id] and  vcf_info['ped_info'][sample_id]['affected_sibs_age'] is not None:
-				sample_data_dict['Affected_Siblings_Ages'] = vcf_info['ped_info'][sample_id]['affected_sibs_age']
-			if 'affected_sibs_sex' in vcf_info['ped_info'][sample_id] and  vcf_info['ped_info'][sample_id]['affected_sibs_sex'] is not None:
-				sample_data_dict['Affected_Siblings_Sex'] = vcf_info['ped_info'][sample_id]['affected_sibs_sex']
-			if 'unaffected_sibs_id' in vcf_info['ped_info'][sample_id] and vcf_info['ped_info'][sample_id]['unaffected_sibs_id'] is not None:
-				sample_data_dict['Unaffected_Siblings_IDs'] = vcf_info['ped_info'][sample_id]['unaffected_sibs_id']
-			if 'unaffected_sibs_age' in vcf_info['ped_info'][sample_id] and vcf_info['ped_info'][sample_id]['unaffected_sibs_age'] is not None:
-				sample_data_dict['Unaffected_Siblings_Ages'] = vcf_info['ped_info'][sample_id]['unaffected_sibs_age']
-			if 'unaffected_sibs_sex' in vcf_info['ped_info'][sample_id] and vcf_info['ped_info'][sample_id]['unaffected_sibs_sex'] is not None:
-				sample_data_dict['Unaffected_Siblings_Sex'] = vcf_info['ped_info'][sample_id]['unaffected_sibs_sex']
+		entry = pedigree[i]
+		if entry is not None:
+			static_fields, father_column, mother_column, affected_sib_columns, unaffected_sib_columns = entry
+			sample_data_dict.update(static_fields)
 
 			# caculate additional fields
-			father_id = vcf_info['ped_info'][sample_id]['father']
-			if father_id in sample_info:
-				father_data = sample_info[father_id]
-				father_gt = father_data.split(':')[0]
-				sample_data_dict['Father_Genotype'] = father_gt
-
-			mother_id = vcf_info['ped_info'][sample_id]['mother']
-			if mother_id in sample_info:
-				mother_data = sample_info[mother_id]
-				mother_gt = mother_data.split(':')[0]
-				sample_data_dict['Mother_Genotype'] = mother_gt
-
-			if father_id in vcf_info['ped_info']:
-				father_phenotype = vcf_info['ped_info'][father_id]['phenotype']
-			if mother_id in vcf_info['ped_info']:
-				mother_phenotype = vcf_info['ped_info'][mother_id]['phenotype']
-				sample_data_dict['Mother_Phenotype'] = mother_phenotype
-
-			if father_id in vcf_info['ped_info']:
-				father_phenotype = vcf_info['ped_info'][father_id]['phenotype']
-				sample_data_dict['Father_Phenotype'] = father_phenotype
-
-
-			if 'Affected_Siblings_IDs' in sample_data_dict:
-				sib_gts = []
-				for sid in sample_data_dict['Affected_Siblings_IDs'].split(','):
-					if sid == '-9' or sid == 'NA':
-						continue
-					else:
-						sib_data = sample_info[sid]
-						sib_gt = sib_data.split(':')[0]
-						sib_gts.append(sib_gt)
-				if len(sib_gts) > 0:
-					sample_data_dict['Affected_Siblings_Genotypes'] = ','.join(sib_gts)
-
-			if 'Unaffected_Siblings_IDs' in sample_data_dict:
-				sib_gts = []
-				for sid in sample_data_dict['Unaffected_Siblings_IDs'].split(','):
-					if sid == '-9' or sid =='NA':
-						continue
-					else:
-						sib_data = sample_info[sid]
-						sib_gt = sib_data.split(':')[0]
-						sib_gts.append(sib_gt)
-				if len(sib_gts) > 0:
-					sample_data_dict['Unaffected_Siblings_Genotypes'] = ','.join(sib_gts)
+			if father_column is not None:
+				sample_data_dict['Father_Genotype'] = sample_columns[father_column].split(':', 1)[0]
+			if mother_column is not None:
+				sample_data_dict['Mother_Genotype'] = sample_columns[mother_column].split(':', 1)[0]
+			if affected_sib_columns:
+				sample_data_dict['Affected_Siblings_Genotypes'] = ','.join([sample_columns[column].split(':', 1)[0] for column in affected_sib_columns])
+			if unaffected_sib_columns:
+				sample_data_dict['Unaffected_Siblings_Genotypes'] = ','.join([sample_columns[column].split(':', 1)[0] for column in unaffected_sib_columns])
+
+			if sample_id in ctx.probands:
+				models = inheritance_models(result, sample_data_dict, annot)
+				if models:
+					sample_data_dict['mendelian_diseases'] = models
 
 		sample_data_dict['Sample_ID'] = sample_id
 		if group != '':
@@ -1006,11 +1338,11 @@ def parse_sample_info(result, format_fields, sample_info, log, vcf_info, group =
 
 	return(result)
 
-def process_line_data(variant_lines, log, f, vcf_info):
+def process_line_data(variant_lines, log, f, vcf_info, ctx):
 	for line in variant_lines:
 		result = OrderedDict()
 		col_data = line.strip().split("\t")
-		data_fixed = dict(zip(vcf_info['col_header'][:7], col_data[:7]))
+		data_fixed = dict(zip(ctx.fixed_header, col_data[:7]))
 		result['Variant'] = "_".join([data_fixed['CHROM'], data_fixed['POS'], data_fixed['REF'][:10], data_fixed['ALT'][:10]])
 
 		# in the first 8 field of vcf format, POS and QUAL are of non-string type, so convert them to the right type
@@ -1048,241 +1380,254 @@ def process_line_data(variant_lines, log, f, vcf_info):
 		format_fields = col_data[8].split(":")
 
 		# parse INFO field
-		result = parse_info_fields(info_fields, result, log, vcf_info)
+		result = parse_info_fields(info_fields, result, log, vcf_info, ctx)
 
 		# parse sample related data
-		sample_info = dict(zip(vcf_info['col_header'][9:], col_data[9:]))
+		result = parse_sample_info(result, format_fields, col_data[9:], log, vcf_info, ctx)
 
-		result = parse_sample_info(result, format_fields, sample_info, log, vcf_info)
+		f.put(result)
 
-		json.dump({"_index" : index_name, "_type" : '_doc', "_source" : result}, f, ensure_ascii=True)
-		f.write("\n")
 
-
-def process_single_cohort(vcf, vcf_info):
+def process_single_cohort(vcf, vcf_info, doc_queue=None):
 
 	# get the total number of variants in the input vcf
-	out = check_output(["grabix", "size", vcf])
-	total_lines = int(out.decode('latin1').strip())
+	# the .gbi index is created here if missing, before the parser processes need it
+	total_lines = GrabixIndex.load(vcf).total_lines
 
-	# calculate number of variants each cpu core need to process
-	num_lines_per_proc = math.ceil(total_lines/num_cpus)
+	# small line ranges aligned to the .gbi chunks, so each task starts with a single seek
+	tasks = [[line_start, min(line_start + GRABIX_CHUNK_SIZE - 1, total_lines)] for line_start in range(1, total_lines + 1, GRABIX_CHUNK_SIZE)]
 
-	# create a intervals list for distributing variants into each of the processes
-	intervals = []
-	line_start = 1
-	line_end = num_lines_per_proc + line_start
+	return(run_parsers(parse_vcf, [vcf], tasks, vcf_info, doc_queue))
 
-	# get the interval list
-	while True:
-		if (line_start < total_lines):
-			line_end = line_start + num_lines_per_proc - 1
-			if line_end >= total_lines:
-				line_end = total_lines
+class IndexerSink:
+	"""Send each document straight to a BulkIndexer, used by the region workers of --celery"""
 
-			interval = [line_start, line_end]
-			intervals.append(interval)
-			line_start = line_end + 1
+	def __init__(self, indexer):
+		self.indexer = indexer
 
-			if (line_end >= total_lines):
-				break
+	def put(self, doc):
+		self.indexer.add(encode_bulk_item(doc))
 
-	# to be used to hold the process ids for the join() function
-	processes = []
-	output_json = []
+	def close(self):
+		self.indexer.close()
 
-	if debug:
-		for intev in intervals: # debug
-			output_file = 'tmp/output_' + str(intev) + '.json'
-			parse_vcf(vcf, intev, output_file, vcf_info)
-			output_json.append(output_file)
-	else:
- 		# dispatch subtasks to each of the processes
-		for i in range(num_cpus):
-			output_file = os.path.join(tmp_dir, os.path.basename(vcf) + '.chunk_' + str(i) + '.json')
-			proc = multiprocessing.Process(target=parse_vcf, args=[vcf, intervals[i], output_file, vcf_info])
-			proc.start()
-			processes.append(proc)
-			output_json.append(output_file)
+def index_region(es, vcf_info, region, report_file):
+	"""Parse and index the variant lines of region, run by an es_celery worker. The counts are written to report_file"""
+	t = time.time()
+	name = 'region_%d_%d' % (region[0], region[1])
+	logfile = os.path.join(tmp_dir, os.path.basename(vcf) + '.' + name + '.log')
+	log = open(logfile, 'w')
 
-	 	# wait for all the processes to finish
-		for proc in processes:
-			proc.join()
-			print("Process %s finished ..." % proc.pid)
+	ctx = ParseContext(vcf_info)
+	indexer = BulkIndexer(es, dead_letter_file(name), max_bytes=max_bulk_size)
+	f = label_sink(IndexerSink(indexer), ctx)
+	num_variants = 0
+	try:
+		lines = grab_lines(vcf, region[0], region[1])
+		while True:
+			variant_lines = [line.decode('latin1').rstrip('\r\n') for line in itertools.islice(lines, 5000)]
+			if not variant_lines:
+				break
+			process_line_data(variant_lines, log, f, vcf_info, ctx)
+			num_variants += len(variant_lines)
+	finally:
+		f.close()
+		log.close()
+
+	report = {'region': region, 'host': socket.gethostname(), 'variants': num_variants, 'indexed': indexer.num_indexed, 'failed': indexer.num_failed,
+		'rejected': indexer.num_rejected, 'retried': indexer.num_retried, 'requests': indexer.num_requests, 'seconds': time.time() - t,
+		'dead_letter': '%s:%s' % (socket.gethostname(), dead_letter_file(name)) if indexer.num_failed else None,
+		'spilled': getattr(f, 'spilled', [])}
+	with open(report_file, 'w') as fp:
+		json.dump(report, fp)
+	print("Region %d-%d: %s" % (region[0], region[1], indexer.report()))
+
+def celery_worker_args():
+	"""load_vcf.py arguments of the region workers, the region itself is added by the task"""
+	worker_args = ['--vcf', os.path.abspath(vcf), '--annot', annot, '--hostname', hostname, '--port', str(port), '--index', index_name,
+		'--study_name', study, '--dataset_name', dataset_name, '--assembly', assembly, '--tmp_dir', tmp_dir,
+		'--max_bulk_size', str(max_bulk_size / MB), '--worker_index', physical_index]
+	if ped:
+		worker_args += ['--ped', os.path.abspath(ped)]
+	if update:
+		worker_args.append('--update')
+	if route_by_chrom:
+		worker_args.append('--route_by_chrom')
+	worker_args += ['--label_write', label_write]
+	return(worker_args)
+
+def process_celery(vcf, vcf_info):
+	"""Hand out regions of vcf to the es_celery workers and collect their reports, returns (reports, failed regions)"""
+	# celery is only needed for distributed imports
+	from es_celery.tasks import parse_and_index_region
+
+	total_lines = GrabixIndex.load(vcf).total_lines
+	regions = [[line_start, min(line_start + region_lines - 1, total_lines)] for line_start in range(1, total_lines + 1, region_lines)]
+	print("Sending %d regions of up to %d variant lines to the Celery workers" % (len(regions), region_lines))
+
+	worker_args = celery_worker_args()
+	progress = ImportProgress(unit='variants')
+	for region in regions:
+		progress.add('%d-%d' % (region[0], region[1]), region[1] - region[0] + 1, parse_and_index_region.delay(worker_args, region, vcf_info))
+
+	# each region is acknowledged by the result of its task
+	progress.wait()
+
+	reports = [chunk['report'] for name, chunk in progress.chunks.items() if chunk['report']]
+	for report in reports:
+		spilled_compound_het.extend(report.get('spilled', []))
+	failures = [{'region': name, 'error': chunk['error']} for name, chunk in progress.failed_chunks()]
+	print_celery_report(reports)
+	progress.reconcile()
+	return(reports, failures)
+
+def print_celery_report(reports):
+	hosts = defaultdict(lambda: defaultdict(float))
+	for report in reports:
+		host = hosts[report['host']]
+		host['regions'] += 1
+		for key in ['variants', 'indexed', 'failed', 'rejected', 'retried', 'seconds']:
+			host[key] += report[key]
+
+	print("%-24s %8s %12s %12s %8s %10s %10s %14s" % ('Host', 'Regions', 'Variants', 'Indexed', 'Failed', 'Rejected', 'Seconds', 'Variants/sec'))
+	for name, host in sorted(hosts.items()):
+		rate = host['variants']/host['seconds'] if host['seconds'] > 0 else 0
+		print("%-24s %8d %12d %12d %8d %10d %10.1f %14.1f" % (name, host['regions'], host['variants'], host['indexed'], host['failed'], host['rejected'], host['seconds'], rate))
+
+	total = {key: sum(host[key] for host in hosts.values()) for key in ['regions', 'variants', 'indexed', 'failed', 'rejected']}
+	print("%-24s %8d %12d %12d %8d %10d" % ('total', total['regions'], total['variants'], total['indexed'], total['failed'], total['rejected']))
+
+def process_case_control(case_vcf, control_vcf, vcf_info, doc_queue=None):
+	batch_bytes = 4 * 1024 * 1024 # compressed case + control data per batch, the unit of work handed to a parser process
+
+	# size batches from the .tbi indexes and skip regions without variants in either file
+	indexes = [TabixIndex.load(case_vcf), TabixIndex.load(control_vcf)]
+	chroms = list(vcf_info['chr2len'])
+	for index in indexes:
+		chroms.extend(name for name in index.names if name not in chroms)
+
+	batch_list = plan_region_batches(indexes, chroms, batch_bytes)
+	print("Planned %d case/control batches" % len(batch_list))
+
+	return(run_parsers(parse_case_control, [case_vcf, control_vcf], batch_list, vcf_info, doc_queue))
+
+def iter_case_control_sites(stream):
+	"""Group a position sorted (POS, group, line) stream into one OrderedDict per position, mapping each CHROM_POS_REF_ALT to its {group: col_data} records.
+	Multi-allelic sites split over several lines give one entry per allele, records found in one cohort only have a single group"""
+	for pos, records in itertools.groupby(stream, key=lambda x: x[0]):
+		site = OrderedDict()
+		for pos, group, line in records:
+			col_data = line.decode('latin1').strip().split("\t")
+			v_id = '_'.join([col_data[0], col_data[1], col_data[3], col_data[4]])
+			site.setdefault(v_id, {})[group] = col_data
+		yield site
+
+def make_case_control_doc(records, log, vcf_info, ctx):
+	"""Combine the case and control records of one variant into a single document"""
+	result = None
+	for group in ['_case', '_control']:
+		if group not in records:
+			continue
 
-	return(output_json)
+		col_data = records[group]
+		data_fixed = dict(zip(ctx.fixed_header, col_data[:7]))
 
-def process_case_control(case_vcf, control_vcf, vcf_info):
-	batch_size = 1000000 # reduce this number if memory is an issue
-	if interval_size:
-		batch_size = interval_size
+		if result is not None: # already found in case
+			# parse INFO field
+			info_fields = col_data[7].split(";")
+			result.update(parse_info_fields(info_fields, {}, log, vcf_info, ctx, group))
 
-	batch_list = []
-	output_json = []
-	processes = []
+			# parse FORMAT field
+			format_fields = col_data[8].split(":")
 
-	for chrom, length in vcf_info['chr2len'].items():
-		start = 1
-		while True:
-			if (start < length):
-				end = start + batch_size - 1
-				batch = chrom + ':' + str(start) + '-' + str(end)
-				if (end >= length):
-					batch = chrom + ':' + str(start) + '-' + str(length)
+			# parse sample related data
+			result_sample = parse_sample_info({}, format_fields, col_data[9:], log, vcf_info, ctx, group=group)
+			result['sample'].extend(result_sample['sample'])
 
-				batch_list.append(batch)
+			result['QUAL' + group] = float(data_fixed['QUAL'])
+			result['FILTER' + group] = data_fixed['FILTER']
+		else:
+			# make a short format of variant IDs, i.e. keep at most 9 bases for indels
+			variant = '_'.join([data_fixed['CHROM'], data_fixed['POS'], data_fixed['REF'][:10], data_fixed['ALT'][:10]])
 
-				start = end + 1
-				if (start >= length):
-					break
+			result = {}
+			result['Variant'] = variant
+			result['CHROM'] = data_fixed['CHROM']
+			result['POS'] = int(data_fixed['POS'])
+			result['ID'] = data_fixed['ID']
+			result['REF'] = data_fixed['REF']
+			result['ALT'] = data_fixed['ALT']
+
+			if data_fixed['ID'].startswith('rs'):
+				result['dbSNP_ID'] = data_fixed['ID']
+			else:
+				result['dbSNP_ID'] = None # boolean filters can not use 'NA'
 
-	# calculate number of batches each cpu need to process
-	batches_per_cpu = math.ceil(len(batch_list)/num_cpus)
-	batch_start = 0
+			# QUAL and FILTER field
+			result['QUAL' + group] = float(data_fixed['QUAL'])
+			result['FILTER' + group] = data_fixed['FILTER']
 
-	if debug:
-		output_file = 'tmp/output_case_control_' + str(batch_list[0]) + '.json'
-		parse_case_control(case_vcf, control_vcf, [batch_list[0]], output_file, vcf_info)
-		output_json.append(output_file)
-	else:
-		for i in range(num_cpus):
-			batch_end = batch_start + batches_per_cpu
-			if batch_end > len(batch_list):
-				batch_end = len(batch_list)
+			if data_fixed['REF'] in ['G','A','T','C'] and data_fixed['ALT'] in ['G','A','T','C']:
+				result['VariantType'] = 'SNV'
+			else:
+				result['VariantType'] = 'INDEL'
 
-			output_file = os.path.join(tmp_dir, os.path.basename(control_vcf) + '.chunk_' + str(i) + '.json')
-			proc = multiprocessing.Process(target=parse_case_control, args=[case_vcf, control_vcf, batch_list[batch_start:batch_end], output_file, vcf_info])
-			proc.start()
-			processes.append(proc)
-			output_json.append(output_file)
+			# parse INFO field
+			info_fields = col_data[7].split(";")
+			result.update(parse_info_fields(info_fields, {}, log, vcf_info, ctx, group))
 
-			batch_start = batch_end + 1
+			# parse FORMAT field
+			format_fields = col_data[8].split(":")
 
-		# wait for all the processes to finish
-		for proc in processes:
-			proc.join()
-			print("Process %s finished ..." % proc.pid)
+			# parse sample related data
+			result.update(parse_sample_info({}, format_fields, col_data[9:], log, vcf_info, ctx, group=group))
 
-	return(output_json)
+	return(result)
 
-def parse_case_control(case_vcf, control_vcf, batch_sub_list, outfile, vcf_info):
+def parse_case_control(case_vcf, control_vcf, task_queue, outfile, vcf_info, doc_queue=None, stats_queue=None):
 
 	p = multiprocessing.current_process()
+	t = time.time()
+	num_variants_processed = 0
 
 	logfile = re.sub('json', 'log', outfile)
 	log = open(logfile, 'w')
 
 	batch_count = 0
-	total_batches = len(batch_sub_list)
 
-	with open(outfile, 'w') as f:
-		for batch in batch_sub_list:
-			batch_count += 1
-			data_dict = defaultdict()
-			data_dict['_case'] = {}
-			data_dict['_control'] = {}
-
-	 		# get a chunck of line from each of the vcf files
-			output_case = check_output(["tabix", case_vcf, batch])
-			output_control = check_output(["tabix", control_vcf, batch])
-
-			if len(output_case) + len(output_control) == 0:
-				print("Empty batch %s" % batch)
-				continue
+	ctx = ParseContext(vcf_info)
+	readers = {'_case': TabixReader(case_vcf), '_control': TabixReader(control_vcf)}
 
-			print("Pid %s processing batch  %s, %d of %d"% (p.pid, batch, batch_count, total_batches))
-
-			output_case = output_case.decode('latin1')
-			output_control = output_control.decode('latin1')
-
-			lines_case = output_case.splitlines()
-			lines_control = output_control.splitlines()
-
-			for line in lines_case:
-				col_data = line.strip().split("\t")
-				v_id = '_'.join([col_data[0], col_data[1], col_data[3], col_data[4]])
-				data_dict['_case'][v_id] = col_data
-			for line in lines_control:
-				col_data = line.strip().split("\t")
-				v_id = '_'.join([col_data[0], col_data[1], col_data[3], col_data[4]])
-				data_dict['_control'][v_id] = col_data
-
-			result = defaultdict()
-			seen = {}
-
-			counter = 0
-			for group in ['_case', '_control']:
-				for v_id in data_dict[group]:
-					tmp = {}
-					tmp2 = {}
-
-					data_fixed = dict(zip(vcf_info['col_header'][:7], data_dict[group][v_id][:7]))
-
-
-					if v_id in seen: # alread found in case
-						# parse INFO field
-						info_fields = data_dict[group][v_id][7].split(";")
-						result_info = parse_info_fields(info_fields, tmp, log, vcf_info, group)
-						result[v_id].update(result_info)
-
-						# parse FORMAT field
-						format_fields = data_dict[group][v_id][8].split(":")
-
-						# parse sample related data
-						sample_info = dict(zip(vcf_info['col_header'][9:], data_dict[group][v_id][9:]))
-						result_sample = parse_sample_info(tmp2, format_fields, sample_info, log, vcf_info, group=group)
-						result[v_id]['sample'].extend(result_sample['sample'])
-
-						result[v_id]['QUAL' + group] = float(data_fixed['QUAL'])
-						result[v_id]['FILTER' + group] = data_fixed['FILTER']
-					else:
-						seen[v_id] = True
-
-						# make a short format of variant IDs, i.e. keep at most 9 bases for indels
-						variant = '_'.join([data_fixed['CHROM'], data_fixed['POS'], data_fixed['REF'][:10], data_fixed['ALT'][:10]])
-
-						result[v_id] = {}
-						result[v_id]['Variant'] = variant
-						result[v_id]['CHROM'] = data_fixed['CHROM']
-						result[v_id]['POS'] = int(data_fixed['POS'])
-						result[v_id]['ID'] = data_fixed['ID']
-						result[v_id]['REF'] = data_fixed['REF']
-						result[v_id]['ALT'] = data_fixed['ALT']
-
-						if data_fixed['ID'].startswith('rs'):
-							result[v_id]['dbSNP_ID'] = data_fixed['ID']
-						else:
-						 	result[v_id]['dbSNP_ID'] = None # boolean filters can not use 'NA'
-
-						# QUAL and FILTER field
-						result[v_id]['QUAL' + group] = float(data_fixed['QUAL'])
-						result[v_id]['FILTER' + group] = data_fixed['FILTER']
-
-						if data_fixed['REF'] in ['G','A','T','C'] and data_fixed['ALT'] in ['G','A','T','C']:
-							result[v_id]['VariantType'] = 'SNV'
-						else:
-							result[v_id]['VariantType'] = 'INDEL'
-
-						# parse INFO field
-						info_fields = data_dict[group][v_id][7].split(";")
-						result_info = parse_info_fields(info_fields, tmp, log, vcf_info, group)
-						result[v_id].update(result_info)
+	f = open_sink(outfile, doc_queue)
+	try:
+		for batch in iter_tasks(task_queue):
+			batch_count += 1
+			batch_variants = 0
 
-						# parse FORMAT field
-						format_fields = data_dict[group][v_id][8].split(":")
+			# walk both vcf files in lockstep, only the records of one position are held in memory
+			for site in iter_case_control_sites(fetch_merged(readers, *batch)):
+				for records in site.values():
+					f.put(make_case_control_doc(records, log, vcf_info, ctx))
+				batch_variants += len(site)
 
-						# parse sample related data
-						sample_info = dict(zip(vcf_info['col_header'][9:], data_dict[group][v_id][9:]))
-						result_sample = parse_sample_info(tmp2, format_fields, sample_info, log, vcf_info, group=group)
-						result[v_id].update(result_sample)
+			num_variants_processed += batch_variants
+			print("Pid %s processed batch %s:%d-%d, %d variants, %d batches so far"% (p.pid, *batch, batch_variants, batch_count))
 
-			for v_id in result:
-				json.dump({"_index" : index_name, "_type" : '_doc', "_source": result[v_id]}, f, ensure_ascii=True)
-				f.write("\n")
+		print("Pid %s: finished processing %d batches" % (p.pid, batch_count))
+	finally:
+		f.close()
+		for reader in readers.values():
+			reader.close()
 
-		print("Pid %s: finished processing %s, batch %d of %d" % (p.pid, batch, batch_count, total_batches))
+	if stats_queue is not None:
+		stats_queue.put({'pid': p.pid, 'tasks': batch_count, 'variants': num_variants_processed, 'seconds': time.time() - t})
 
 def make_es_mapping(vcf_info):
+	# values per document for the projected savings, parsed before the field types below are changed in vcf_info
+	sample_docs = None
+	if optimize_mapping and not control_vcf:
+		sample_docs = sample_documents(vcf, 1000, copy.deepcopy(vcf_info))
+
 	info_dict2 = vcf_info['info_dict']
 	format_dict2 = vcf_info['format_dict']
 
@@ -1291,6 +1636,9 @@ def make_es_mapping(vcf_info):
 
 	p = re.compile(r'snp\d+')
 
+	# keys removed from the mapping only, keep the global list used by the parser untouched
+	mapping_excluded_list = list(excluded_list)
+
 	if annot == 'vep':
 		csq_dict_global =vcf_info['csq_dict_global']
 		csq_dict_local = vcf_info['csq_dict_local']
@@ -1304,7 +1652,7 @@ def make_es_mapping(vcf_info):
 			del csq_dict_local['SIFT']
 		if 'SOMATIC' in csq_dict_global:
 			del csq_dict_global['SOMATIC']
-		excluded_list.append('CSQ')
+		mapping_excluded_list.append('CSQ')
 
 		# define mapping for other variables
 		for key in csq_dict_local:
@@ -1376,23 +1724,23 @@ def make_es_mapping(vcf_info):
 		mapping["properties"]['ICGC_ID'] = {"type" : "keyword"}
 
 		# these variables are replaced with the nested variable names, so remove them
-		excluded_list.append('AAChange_refGene')
-		excluded_list.append('AAChange_ensGene')
-		excluded_list.append('ANNOVAR_DATE')
-		excluded_list.append('CLNSIG')
-		excluded_list.append('CLNDN')
-		excluded_list.append('CLNREVSTAT')
-		excluded_list.append('GTEx_V6_tissue')
-		excluded_list.append('GTEx_V6_gene')
-		excluded_list.append('COSMIC_Occurrence')
-		excluded_list.append('DB')
-		excluded_list.append('DP')
-		excluded_list.append('Gene_pos')
-		excluded_list.append('ICGC_Id') # replaced with "ICGC_ID"
-		excluded_list.append("NEGATIVE_TRAIN_SITE")
-		excluded_list.append("POSITIVE_TRAIN_SITE")
-		excluded_list.append('GeneDetail_refGene')
-		excluded_list.append('GeneDetail_ensGene')
+		mapping_excluded_list.append('AAChange_refGene')
+		mapping_excluded_list.append('AAChange_ensGene')
+		mapping_excluded_list.append('ANNOVAR_DATE')
+		mapping_excluded_list.append('CLNSIG')
+		mapping_excluded_list.append('CLNDN')
+		mapping_excluded_list.append('CLNREVSTAT')
+		mapping_excluded_list.append('GTEx_V6_tissue')
+		mapping_excluded_list.append('GTEx_V6_gene')
+		mapping_excluded_list.append('COSMIC_Occurrence')
+		mapping_excluded_list.append('DB')
+		mapping_excluded_list.append('DP')
+		mapping_excluded_list.append('Gene_pos')
+		mapping_excluded_list.append('ICGC_Id') # replaced with "ICGC_ID"
+		mapping_excluded_list.append("NEGATIVE_TRAIN_SITE")
+		mapping_excluded_list.append("POSITIVE_TRAIN_SITE")
+		mapping_excluded_list.append('GeneDetail_refGene')
+		mapping_excluded_list.append('GeneDetail_ensGene')
 
 	# variables used for boolean type need to have None value if empty
 	mapping["properties"].update({"COSMIC_ID" : {"type" : "keyword"}, "dbSNP_ID" : {"type" : "keyword"}})
@@ -1411,7 +1759,7 @@ def make_es_mapping(vcf_info):
 			del format_dict2[key]['Description']
 
 	keys = list(info_dict2.keys())
-	keys = [x for x in keys if (x in utils.SUMMARY_STATISTICS_FIELDS or x in utils.VARIANT_QUALITY_RELATED_FIELDS) and x not in excluded_list]
+	keys = [x for x in keys if (x in utils.SUMMARY_STATISTICS_FIELDS or x in utils.VARIANT_QUALITY_RELATED_FIELDS) and x not in mapping_excluded_list]
 
 	# Perhaps we have to hand made a list of attributes that are meaningful to have "_case" and "_control" appended
 	if control_vcf:
@@ -1428,7 +1776,7 @@ def make_es_mapping(vcf_info):
 		info_dict2['FILTER_case'] = {"type" : "keyword"}
 		info_dict2['FILTER_control'] = {"type" : "keyword"}
 
-	for key in excluded_list:
+	for key in mapping_excluded_list:
 		if key in info_dict2:
 			del info_dict2[key]
 
@@ -1497,9 +1845,9 @@ def make_es_mapping(vcf_info):
 
 	index_settings = {}
 	index_settings["settings"] = {
-		"number_of_shards": 8,
-		"number_of_replicas": 1,
-		"refresh_interval": "1s",
+		"number_of_shards": num_shards,
+		"number_of_replicas": index_target_settings["number_of_replicas"],
+		"refresh_interval": index_target_settings["refresh_interval"],
 		"index.mapping.ignore_malformed": True,
 		"index.write.wait_for_active_shards": 1,
 		"index.merge.policy.max_merge_at_once": 7,
@@ -1510,62 +1858,177 @@ def make_es_mapping(vcf_info):
 		"index.merge.policy.max_merged_segment": "10gb"
 	}
 
+	if route_by_chrom:
+		# routing can only be set up when the index is created. _meta tells make_gui and the searches which field the documents are routed by
+		index_settings["mappings"] = {"_routing": {"required": True}, "_meta": {"routing_field": "CHROM"}}
+
 	dir_path = os.path.dirname(os.path.realpath(__file__))
 	create_index_script = os.path.join(dir_path,  'scripts', 'create_index_%s_and_put_mapping.sh' % index_name)
 	mapping_file = os.path.join(dir_path,  'scripts', '%s_mapping.json' % index_name)
 
+	# the GUI config and --update read the full mapping, only the index is created with the optimized one
+	with open(mapping_file, 'w') as fp:
+		json.dump(mapping, fp, sort_keys=True, indent=2, ensure_ascii=False)
+
+	index_mapping = mapping
+	if optimize_mapping:
+		gui_mapping = make_gui_config(out_vcf_info, mapping_file, index_name, annot, bool(control_vcf), ped)
+		index_mapping, changes = trim_mapping(mapping, gui_mapping)
+		print_report(changes, projected_savings(changes, sample_docs), GrabixIndex.load(vcf).total_lines)
+
+		optimized_mapping_file = os.path.join(dir_path,  'scripts', '%s_mapping.optimized.json' % index_name)
+		with open(optimized_mapping_file, 'w') as fp:
+			json.dump(index_mapping, fp, sort_keys=True, indent=2, ensure_ascii=False)
+
 	with open(create_index_script, 'w') as fp:
-		fp.write("curl -XPUT \'%s:%s/%s?pretty\' -H \'Content-Type: application/json\' -d\'\n" % (hostname, port, index_name))
+		fp.write("curl -XPUT \'%s:%s/%s?pretty\' -H \'Content-Type: application/json\' -d\'\n" % (hostname, port, physical_index))
 		json.dump(index_settings, fp, sort_keys=True, indent=2, ensure_ascii=False)
 		fp.write("\'\n")
-		fp.write("curl -XPUT \'%s:%s/%s/_mapping?pretty\' -H \'Content-Type: application/json\' -d\'\n" % (hostname, port, index_name))
-		json.dump(mapping, fp, sort_keys=True, indent=2, ensure_ascii=False)
+		fp.write("curl -XPUT \'%s:%s/%s/_mapping?pretty\' -H \'Content-Type: application/json\' -d\'\n" % (hostname, port, physical_index))
+		json.dump(index_mapping, fp, sort_keys=True, indent=2, ensure_ascii=False)
 		fp.write("\'")
 
-	with open(mapping_file, 'w') as fp:
-		json.dump(mapping, fp, sort_keys=True, indent=2, ensure_ascii=False)
-
 	return(create_index_script, mapping_file)
 
-def put_mendelian_to_es(es, index_name,  annotation):
-
-	family_dict = get_family_dict(es, index_name)
-	all_start_time = datetime.datetime.now()
+def create_index(es, create_index_script):
+	# a new version never exists, unless an earlier attempt with the same name failed
+	if es.indices.exists(physical_index):
+		print("deleting '%s' index..." % physical_index)
+		res = es.indices.delete(index = physical_index)
+		print("response: '%s'" % res)
+
+	print("creating '%s' index..." % physical_index)
+	res = check_output(["bash", create_index_script])
+	print("Response: '%s'" % res.decode('ascii'))
+
+	if bulk_load:
+		# nothing is searched until loading is done, so skip refreshes and replicate the merged segments once at the end
+		es.indices.put_settings(index=physical_index, body={"index": bulk_load_settings})
+		print("Index '%s' switched to bulk load settings: %s" % (physical_index, bulk_load_settings))
+
+def update_mapping(es, mapping_file):
+	"""Add the fields of a vcf loaded with --update to the mapping of the existing index"""
+	if not es.indices.exists(index_name):
+		print("Index '%s' does not exist, --update needs an index created by an earlier import" % index_name)
+		sys.exit(2)
 
-	start_time = datetime.datetime.now()
-	print('Starting annotate_autosomal_recessive', start_time)
-	annotate_autosomal_recessive(es, index_name,  family_dict, annotation)
-	print('Finished annotate_autosomal_recessive', int((datetime.datetime.now() - start_time).total_seconds()))
+	with open(mapping_file) as fp:
+		mapping = json.load(fp)
 
-	start_time = datetime.datetime.now()
-	print('Starting annotate_denovo', start_time)
-	annotate_denovo(es, index_name,  family_dict)
-	print('Finished annotate_denovo', int((datetime.datetime.now() - start_time).total_seconds()))
+	print("adding new fields to the mapping of '%s' index..." % index_name)
+	try:
+		res = es.indices.put_mapping(index=index_name, body=mapping)
+		print("Response: '%s'" % res)
+	except elasticsearch.RequestError as e:
+		# a field with a different type than in the earlier import, its values are dropped by index.mapping.ignore_malformed
+		print("Mapping of '%s' not updated: %s" % (index_name, e))
+
+def finish_bulk_load(es):
+	"""Restore the target refresh interval and replicas of the loaded index, force merged first with --force_merge, and wait for the replicas"""
+	phases = []
+
+	t = time.time()
+	es.indices.put_settings(index=physical_index, body={"index": {"refresh_interval": index_target_settings["refresh_interval"]}})
+	es.indices.refresh(index=physical_index)
+	phases.append(('refresh', time.time() - t))
+
+	# a resumed index may already have been merged or searched, only a fresh load is merged
+	if force_merge and not resume:
+		t = time.time()
+		es.indices.forcemerge(index=physical_index, max_num_segments=1, request_timeout=86400)
+		phases.append(('force merge', time.time() - t))
+
+	t = time.time()
+	replicas = index_target_settings["number_of_replicas"]
+	es.indices.put_settings(index=physical_index, body={"index": {"number_of_replicas": replicas}})
+
+	# replicas can not be allocated on the node holding the primaries, a single node cluster stays yellow
+	num_data_nodes = es.cluster.health()['number_of_data_nodes']
+	status = 'green' if num_data_nodes > replicas else 'yellow'
+	es.cluster.health(index=physical_index, wait_for_status=status, timeout='24h', request_timeout=86400)
+	phases.append(('restore replicas, wait for %s' % status, time.time() - t))
+
+	for phase, seconds in phases:
+		print("Bulk load %s: %.1f seconds" % (phase, seconds))
+
+def parsed_output_files():
+	"""Chunk files written by an earlier parse of vcf, indexed again with --skip_parsing"""
+	return([os.path.join(tmp_dir, os.path.basename(vcf) + '.chunk_' + str(i) + '.json') for i in range(num_cpus)])
+
+def parsed_index(output_files):
+	"""Index named by the action lines of the chunk files, None if they hold no documents"""
+	for infile in output_files:
+		if not os.path.exists(infile):
+			continue
+		with open(infile, 'rb') as fp:
+			line = fp.readline()
+		if line.strip():
+			return(next(iter(json.loads(line).values()))['_index'])
+	return(None)
+
+def index_output_file(es, checkpoint, infile):
+	offset, acknowledged, done = checkpoint.position(infile)
+	if done:
+		print("File %s was indexed before, skipping" % infile)
+		return(0, 0)
+
+	print("Indexing file %s from byte %d, %d documents acknowledged before" % (infile, offset, acknowledged))
+	index_start = time.time()
+
+	# offset is advanced as items are added, so after a flush it points behind the last acknowledged document
+	position = [offset]
+	def save_position():
+		checkpoint.update(infile, position[0], acknowledged + indexer.num_indexed + indexer.num_failed)
+
+	indexer = BulkIndexer(es, dead_letter_file(os.path.basename(infile)), max_bytes=max_bulk_size, on_flush=save_position, append=resume)
+	with open(infile, 'rb') as fp:
+		fp.seek(offset)
+		# an item is the action line and the encoded document, passed on without decoding
+		for action in fp:
+			item = action + fp.readline()
+			position[0] += len(item)
+			indexer.add(item)
+	indexer.close()
+	checkpoint.update(infile, position[0], acknowledged + indexer.num_indexed + indexer.num_failed, done=True)
+
+	# report indexing time
+	index_end = time.time()
+	index_time = index_end - index_start
+	print("File %s took: %s seconds, %s" % (infile, index_time, indexer.report()))
+
+	return(indexer.num_indexed, indexer.num_failed)
+
+def index_output_files(es, output_files, checkpoint):
+	# one long-lived indexer per chunk file, each adapting its request size on its own
+	pool = ThreadPool(num_cpus)
+	results = pool.map(partial(index_output_file, es, checkpoint), output_files)
+	pool.close()
+	pool.join()
+
+	num_indexed = sum(success for success, failed in results)
+	num_failed = sum(failed for success, failed in results)
+	print("Indexed %d documents, %d failed" % (num_indexed, num_failed))
 
-	start_time = datetime.datetime.now()
-	print('Starting annotate_autosomal_dominant', start_time)
-	annotate_autosomal_dominant(es, index_name, family_dict)
-	print('Finished annotate_autosomal_dominant', int((datetime.datetime.now() - start_time).total_seconds()))
+def put_mendelian_to_es(es, index_name,  annotation):
 
-	start_time = datetime.datetime.now()
-	print('Starting annotate_x_linked_dominant', start_time)
-	annotate_x_linked_dominant(es, index_name, family_dict)
-	print('Finished annotate_x_linked_dominant', int((datetime.datetime.now() - start_time).total_seconds()))
+	family_dict = get_family_dict(es, index_name)
+	all_start_time = datetime.datetime.now()
+	# both passes are refreshed, waited for and reported on once at the end
+	writer = AnnotationWriter(es, labels_index(index_name, label_write))
 
+	# the per-variant models of all families in a single scan of the index
 	start_time = datetime.datetime.now()
-	print('Starting annotate_x_linked_recessive', start_time)
-	annotate_x_linked_recessive(es, index_name, family_dict, annotation)
-	print('Finished annotate_x_linked_recessive', int((datetime.datetime.now() - start_time).total_seconds()))
+	print('Starting annotate_mendelian', start_time)
+	annotate_mendelian(es, index_name, family_dict, annotation, label_write, writer)
+	print('Finished annotate_mendelian', int((datetime.datetime.now() - start_time).total_seconds()))
 
+	# the compound heterozygous candidates of all families in a single scan, grouped by gene in memory
 	start_time = datetime.datetime.now()
-	print('Starting annotate_x_linked_denovo', start_time)
-	annotate_x_linked_denovo(es, index_name,  family_dict)
-	print('Finished annotate_x_linked_denovo', int((datetime.datetime.now() - start_time).total_seconds()))
+	print('Starting annotate_compound_het', start_time)
+	annotate_compound_het(es, index_name, family_dict, annotation, label_write, writer)
+	print('Finished annotate_compound_het', int((datetime.datetime.now() - start_time).total_seconds()))
 
-	start_time = datetime.datetime.now()
-	print('Starting annotate_compound_heterozygous', start_time)
-	annotate_compound_heterozygous(es, index_name,  family_dict, annotation)
-	print('Finished annotate_compound_heterozygous', int((datetime.datetime.now() - start_time).total_seconds()))
+	writer.finish()
 
 	print('Finished annotating all in seconds: ', int((datetime.datetime.now() - all_start_time).total_seconds()))
 
@@ -1585,33 +2048,54 @@ if __name__ == '__main__':
 	es = elasticsearch.Elasticsearch( host=hostname, port=port, request_timeout=300, max_retries=10, timeout=300, read_timeout=800)
 	es.cluster.health(wait_for_status='yellow')
 
+	if worker_region:
+		# a region of a --celery import, run by es_celery/tasks.py on any node. The index is created by the coordinator
+		with open(args.worker_vcf_info) as f:
+			vcf_info = json.load(f)
+		index_region(es, vcf_info, worker_region, args.worker_report)
+		sys.exit(0)
+
 	# append assembly version to dataset name
 	dataset_name += '_' + assembly
 
-	# make sure the destination dataset not exists
-	conn = sqlite3.connect('db.sqlite3')
-	c = conn.cursor()
-
-
-	query = "DELETE FROM core_dataset WHERE name = '" + dataset_name + "'"
-	try:
-		c.execute(query)
-	except Exception as e:
-		print("Sqlite error: %s" % e)
-
-	conn.commit()
-	conn.close()
+	# single cohort imports label the inheritance models while parsing, see ParseContext
+	inheritance_labelled = bool(ped) and not control_vcf and not skip_parsing and not gui_only and label_write != 'sidecar'
 
 	if gui_only:
 		gui_mapping_file = os.path.join("config", index_name + '_gui_config.json')
 		with open(gui_mapping_file) as f:
 			gui_mapping = json.load(f)
+			# the dataset is rebuilt from scratch, its filters cascade with it
+			Dataset.objects.filter(name=dataset_name).delete()
 			make_gui(es, hostname, port, index_name, study, dataset_name,  gui_mapping)
 	else:
 		case_control = False
 		if control_vcf:
 			case_control = True
 
+		checkpoint = Checkpoint(os.path.join(tmp_dir, index_name + '.checkpoint.json'))
+		if resume and not (checkpoint.matches(vcf, index_name) and es.indices.exists(checkpoint.physical_index())):
+			print("No resumable import of %s into '%s' found in %s, starting from the beginning" % (vcf, index_name, checkpoint.path))
+			resume = False
+
+		# the alias keeps serving the previous version until the new one is loaded and its GUI is built
+		if resume:
+			physical_index = checkpoint.physical_index()
+		elif skip_parsing:
+			# the action lines of the chunk files and the create index script of the earlier parse name the version it was parsed for
+			physical_index = parsed_index(parsed_output_files())
+			if physical_index is None:
+				print("No parsed documents of %s found in %s, run without --skip_parsing" % (vcf, tmp_dir))
+				sys.exit(2)
+		elif not update:
+			physical_index = new_version_name(index_name)
+		print("Loading into index '%s'" % physical_index)
+
+		if update and es.indices.exists(index_name):
+			# new documents have to be routed like the ones already in the index
+			existing_mapping = list(es.indices.get_mapping(index=index_name).values())[0]['mappings']
+			route_by_chrom = existing_mapping.get('_meta', {}).get('routing_field') == 'CHROM'
+
 		if not skip_parsing:
 			check_commandline(vcf, control_vcf, annot)
 
@@ -1628,6 +2112,8 @@ if __name__ == '__main__':
 				rv2 = process_vcf_header(control_vcf)
 				vcf_info2 = dict(zip([ 'num_header_lines', 'csq_fields', 'col_header', 'chr2len', 'info_dict', 'format_dict', 'contig_dict', 'csq_dict_local', 'csq_dict_global'], rv2))
 				vcf_info['info_dict'] = {**vcf_info['info_dict'], **vcf_info2['info_dict']}
+				# the control sample columns are named by the control header
+				vcf_info['control_col_header'] = vcf_info2['col_header']
 
 			# read 5000 lines of data to verify data types for each field extracted from vcf header by the above function
 			vcf_info = process_vcf_data(vcf, 5000, vcf_info)
@@ -1641,63 +2127,81 @@ if __name__ == '__main__':
 				ped_info = process_ped_file(ped)
 				vcf_info['ped_info'] = ped_info
 
-			# determine which work flow to choose, i.e. single cohort or case-control analysis
-			if control_vcf:
-				output_files = process_case_control(vcf, control_vcf, vcf_info)
-			else:
-				output_files = process_single_cohort(vcf, vcf_info)
+			if benchmark_lines:
+				benchmark_parsing(vcf, benchmark_lines, vcf_info)
+				sys.exit(0)
 
-			t1 = time.time()
-			parsing_time = t1-t0
+			if streaming or use_celery:
+				# the index has to exist before the first document arrives, make_es_mapping modifies vcf_info so give it a copy
+				create_index_script, mapping_file = make_es_mapping(copy.deepcopy(vcf_info))
+				if update:
+					update_mapping(es, mapping_file)
+				else:
+					create_index(es, create_index_script)
 
-			print("Finished parsing vcf file in %s seconds, now creating ElasticSearch index ..." % parsing_time)
+				if use_celery:
+					reports, failures = process_celery(vcf, vcf_info)
+					if failures:
+						print("%d of %d regions were not indexed into '%s', stopping before the GUI is built and the alias is switched" % (len(failures), len(failures) + len(reports), physical_index))
+						sys.exit(1)
+				else:
+					doc_queue = multiprocessing.Queue(maxsize=num_indexers * 4)
+					indexers = start_indexers(doc_queue)
 
+					if control_vcf:
+						process_case_control(vcf, control_vcf, vcf_info, doc_queue)
+					else:
+						process_single_cohort(vcf, vcf_info, doc_queue)
 
-			create_index_script, mapping_file = make_es_mapping(vcf_info)
+					stop_indexers(doc_queue, indexers)
 
-		else:
+				t1 = time.time()
+				parsing_time = t1-t0
 
-			for i in range(num_cpus):
-				output_file = os.path.join(tmp_dir, os.path.basename(vcf) + '.chunk_' + str(i) + '.json')
-				output_files.append(output_file)
+				print("Finished parsing and indexing vcf file in %s seconds" % parsing_time)
+			elif resume:
+				output_files = checkpoint.output_files()
+				if checkpoint.compound_het_spilled() is None: # parsed before the inheritance models were labelled while parsing
+					inheritance_labelled = False
+				else:
+					spilled_compound_het.extend(checkpoint.compound_het_spilled())
 
+				t1 = time.time()
+				parsing_time = t1-t0
 
-		# prepare for elasticsearch
-		if es.indices.exists(index_name):
-			print("deleting '%s' index..." % index_name)
-			res = es.indices.delete(index = index_name)
-			print("response: '%s'" % res)
+				print("Resuming indexing of %s from checkpoint %s ..." % (vcf, checkpoint.path))
+			else:
+				# determine which work flow to choose, i.e. single cohort or case-control analysis
+				if control_vcf:
+					output_files = process_case_control(vcf, control_vcf, vcf_info)
+				else:
+					output_files = process_single_cohort(vcf, vcf_info)
+				checkpoint.start(vcf, index_name, output_files, physical_index, spilled_compound_het if inheritance_labelled else None)
 
-		print("creating '%s' index..." % index_name)
-		res = check_output(["bash", create_index_script])
-		print("Response: '%s'" % res.decode('ascii'))
+				t1 = time.time()
+				parsing_time = t1-t0
 
+				print("Finished parsing vcf file in %s seconds, now creating ElasticSearch index ..." % parsing_time)
 
-		for infile in output_files:
-			print("Indexing file %s" % infile)
-			data = []
-			index_start = time.time()
-
-			with open(infile, 'r') as fp:
-				for line in fp:
-					tmp = json.loads(line)
-					data.append(tmp)
-					if len(data) % 1000 == 0:
-						try:
-							deque(helpers.parallel_bulk(es, data, thread_count=num_cpus, raise_on_exception=False), maxlen=0)
-							data = []
-						except ValueError as e:
-							print("Failed indexing %s" % e)
-							continue
-			# leftover data
-			try:
-				deque(helpers.parallel_bulk(es, data, thread_count=num_cpus), maxlen=0)
-			except:
-				continue
-			# report indexing time
-			index_end = time.time()
-			index_time = index_end - index_start
-			print("Took: %s seconds"% index_time)
+
+				create_index_script, mapping_file = make_es_mapping(vcf_info)
+
+		else:
+
+			output_files = parsed_output_files()
+			checkpoint.start(vcf, index_name, output_files, physical_index)
+
+
+		if not streaming and not use_celery:
+			# a resumed import keeps the index and the documents acknowledged so far
+			if update and not resume:
+				update_mapping(es, mapping_file)
+			elif not resume:
+				create_index(es, create_index_script)
+			index_output_files(es, output_files, checkpoint)
+
+		if bulk_load:
+			finish_bulk_load(es)
 
 
 		t2 = time.time()
@@ -1711,7 +2215,9 @@ if __name__ == '__main__':
 		gui_mapping = make_gui_config(out_vcf_info, mapping_file, index_name,  annot, case_control, ped)
 
 
-		make_gui(es, hostname, port, index_name, study, dataset_name,  gui_mapping)
+		# the dataset is rebuilt from scratch, its filters cascade with it
+		Dataset.objects.filter(name=dataset_name).delete()
+		make_gui(es, hostname, port, index_name, study, dataset_name,  gui_mapping, source_index=physical_index)
 
 		print("*"*80+"\n")
 		print("Successfully imported VCF file. You can now explore your data at %s:%s" % (hostname, webserver_port))
@@ -1722,8 +2228,15 @@ if __name__ == '__main__':
 		print("Success, vcf parsing: %s, indexing: %s, GUI creation: %s, VCF: %s\n" % (parsing_time/60, indexing_time/60, gui_time/60, vcf))
 
 	# annotate variants for Mendelian inheritance and insert results back to es index
-	if ped:
-		put_mendelian_to_es(es, index_name,  annot)
+	if inheritance_labelled:
+		label_spilled_compound_het(es, physical_index, spilled_compound_het, label_write)
+	elif ped:
+		put_mendelian_to_es(es, physical_index,  annot)
+
+	# switch searches to the new version in one atomic request, the old version stays for rollback
+	if physical_index != index_name:
+		swap_alias(es, index_name, physical_index)
+		prune_versions(es, index_name, keep_versions)
 
 
 	# clean up
@@ -913,13 +913,20 @@ def get_order_of_import(ele, vcf_gui_mapping_order):
     else:
         return len(vcf_gui_mapping_order)+1
 
-def make_gui(es, hostname, port, index_name, study, dataset,  vcf_gui_mapping):
+def make_gui(es, hostname, port, index_name, study, dataset,  vcf_gui_mapping, source_index=None):
+        # index_name is stored in the dataset and may be an alias, the mapping and filter values are read from source_index
+        if source_index is None:
+            source_index = index_name
 
         add_required_data_to_db()
 
         mapping = elasticsearch.client.IndicesClient.get_mapping(
-            es, index=index_name) #, doc_type=type_name)
-        mapping = mapping[index_name]['mappings']['properties']
+            es, index=source_index) #, doc_type=type_name)
+        # keyed by the physical index name, also when source_index is an alias
+        mapping = list(mapping.values())[0]['mappings']
+        # set by load_vcf.py --route_by_chrom, searches use it to query only the shards a chromosome filter can match
+        routing_field = mapping.get('_meta', {}).get('routing_field', '')
+        mapping = mapping['properties']
 
         nested_fields = []
         for var_name, var_info in mapping.items():
@@ -951,6 +958,7 @@ def make_gui(es, hostname, port, index_name, study, dataset,  vcf_gui_mapping):
                                                              es_index_name=index_name,
                                                              es_host=hostname,
                                                              es_port=port,
+                                                             es_routing_field=routing_field,
                                                              is_public=True)
 
         a = AnalysisType.objects.filter(name__in=['complex', 'autosomal_dominant', 'autosomal_recessive', 'compound_heterozygous', 'denovo', 'x_linked_denovo', 'x_linked_dominant', 'x_linked_recessive'])
@@ -1015,7 +1023,7 @@ def make_gui(es, hostname, port, index_name, study, dataset,  vcf_gui_mapping):
                 if isinstance(field_values, str):
                     match = re.search(r'python_eval(.+)', field_values)
                     if field_values == 'get_values_from_es()':
-                        field_values = get_values_from_es(index_name,
+                        field_values = get_values_from_es(source_index,
                                                    hostname,
                                                    port,
                                                    field_es_name,
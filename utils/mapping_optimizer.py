@@ -0,0 +1,165 @@
+"""Trim index features a dataset never uses from the mapping written by load_vcf.py.
+
+make_es_mapping emits every INFO/FORMAT/CSQ field indexed and with doc
+values. The GUI config made by make_gui_config tells which fields can be
+filtered on and which ones have their values aggregated by
+get_values_from_es, so the rest can go:
+
+- fields without a filter are only shown: not indexed and no doc values
+- filtered fields never aggregated: no doc values, filters use the index
+- allele frequency floats: scaled_float, stored as compressible integers
+- aggregated keyword fields: eager global ordinals, built at refresh
+  instead of by the first aggregation
+
+Fields queried by the mendelian annotation and search code are never touched.
+"""
+import copy
+import re
+
+
+# fields used by queries and aggregations outside the GUI filters, see add_mendelian_annotations.py and mendelian/utils.py
+PROTECTED_FIELDS = frozenset([
+    'CHROM', 'POS', 'REF', 'ALT', 'ID', 'Variant', 'VariantType',
+    'Func_refGene', 'Func_ensGene', 'ExonicFunc_refGene', 'ExonicFunc_ensGene',
+    'CSQ_nested.Consequence', 'CSQ_nested.SYMBOL', 'AAChange_refGene.Gene',
+    'sample.Sample_ID', 'sample.GT', 'sample.Sex', 'sample.Phenotype', 'sample.Family_ID',
+    'sample.Father_ID', 'sample.Mother_ID', 'sample.Father_Genotype', 'sample.Mother_Genotype',
+    'sample.Father_Phenotype', 'sample.Mother_Phenotype', 'sample.mendelian_diseases',
+])
+
+MAF_PANEL = 'Minor Allele Frequency (MAF)'
+AF_PATTERN = re.compile(r'(^|_)(AF|MAF)(_|$)')
+AF_SCALING_FACTOR = 1000000
+
+DOC_VALUES_TYPES = frozenset(['keyword', 'integer', 'long', 'short', 'byte', 'float', 'double', 'half_float', 'scaled_float', 'boolean', 'date', 'ip'])
+
+# rough bytes per value of a field, used to project savings: (inverted index or points, doc values)
+FEATURE_BYTES = {
+    'keyword': (3, 2), 'text': (4, 0), 'boolean': (1, 1), 'byte': (1, 1), 'short': (2, 2),
+    'half_float': (2, 2), 'integer': (4, 4), 'float': (4, 4), 'long': (8, 8), 'double': (8, 8),
+    'scaled_float': (3, 3), 'date': (8, 8), 'ip': (16, 16),
+}
+
+
+def gui_field_usage(gui_mapping):
+    """Full names of the filtered fields, the fields whose values are aggregated and the fields shown as allele frequencies"""
+    filtered = set()
+    aggregated = set()
+    maf = set()
+    for key, gui_info in gui_mapping.items():
+        for filter_field in gui_info.get('filters', []):
+            path = filter_field.get('path', '').strip()
+            name = path + '.' + key if path else key
+            filtered.add(name)
+            if filter_field.get('values') == 'get_values_from_es()':
+                aggregated.add(name)
+            if gui_info.get('panel') == MAF_PANEL:
+                maf.add(name)
+    return filtered, aggregated, maf
+
+
+def iter_leaf_fields(properties, prefix=''):
+    """(full name, field mapping) of every field that holds values, including those of nested objects"""
+    for key, spec in properties.items():
+        name = prefix + key
+        if 'properties' in spec:
+            yield from iter_leaf_fields(spec['properties'], name + '.')
+        else:
+            yield name, spec
+
+
+def trim_mapping(mapping, gui_mapping, protected=PROTECTED_FIELDS):
+    """Return the optimized copy of mapping and the changes made, as [(field, original type, [change, ...])]"""
+    mapping = copy.deepcopy(mapping)
+    filtered, aggregated, maf = gui_field_usage(gui_mapping)
+
+    changes = []
+    for name, spec in iter_leaf_fields(mapping['properties']):
+        field_type = spec.get('type')
+        if name in protected or field_type not in FEATURE_BYTES:
+            continue
+
+        field_changes = []
+        if field_type == 'float' and (name in maf or AF_PATTERN.search(name.split('.')[-1])):
+            spec['type'] = 'scaled_float'
+            spec['scaling_factor'] = AF_SCALING_FACTOR
+            field_changes.append('scaled_float')
+
+        if name not in filtered:
+            spec['index'] = False
+            field_changes.append('index off')
+            if spec['type'] in DOC_VALUES_TYPES:
+                spec['doc_values'] = False
+                field_changes.append('doc_values off')
+        elif name not in aggregated:
+            if spec['type'] in DOC_VALUES_TYPES:
+                spec['doc_values'] = False
+                field_changes.append('doc_values off')
+        elif spec['type'] == 'keyword':
+            spec['eager_global_ordinals'] = True
+            field_changes.append('eager_global_ordinals')
+
+        if field_changes:
+            changes.append((name, field_type, field_changes))
+
+    return mapping, changes
+
+
+def count_values(docs, name):
+    """Average number of values of a field per document, one if there is no sample to count in"""
+    if not docs:
+        return 1.0
+
+    total = 0
+    for doc in docs:
+        values = [doc]
+        for part in name.split('.'):
+            next_values = []
+            for value in values:
+                value = value.get(part) if isinstance(value, dict) else None
+                if isinstance(value, list):
+                    next_values.extend(value)
+                elif value is not None:
+                    next_values.append(value)
+            values = next_values
+        total += len(values)
+    return total / len(docs)
+
+
+def projected_savings(changes, docs):
+    """Rough bytes saved per million documents for each changed field, from the values per document in a sample of docs"""
+    savings = {}
+    for name, field_type, field_changes in changes:
+        index_bytes, doc_values_bytes = FEATURE_BYTES[field_type]
+        per_value = 0
+        if 'index off' in field_changes:
+            per_value += index_bytes
+        if 'doc_values off' in field_changes:
+            per_value += doc_values_bytes
+        if 'scaled_float' in field_changes:
+            # what is still stored, as integers that compress better than floats
+            scaled_index, scaled_doc_values = FEATURE_BYTES['scaled_float']
+            if 'index off' not in field_changes:
+                per_value += index_bytes - scaled_index
+            if 'doc_values off' not in field_changes:
+                per_value += doc_values_bytes - scaled_doc_values
+        savings[name] = per_value * count_values(docs, name) * 1000000
+    return savings
+
+
+def print_report(changes, savings, num_docs=None):
+    print("Mapping optimizer changed %d fields, projected savings per million documents%s:" % (
+        len(changes), " and for about %d documents" % num_docs if num_docs else ''))
+    total = 0
+    for name, field_type, field_changes in sorted(changes, key=lambda change: -savings.get(change[0], 0)):
+        saved = savings.get(name, 0)
+        total += saved
+        line = "  %-45s %-8s %-45s ~%8.1f MB" % (name, field_type, ', '.join(field_changes), saved / 1024 / 1024)
+        if num_docs:
+            line += " ~%9.1f MB" % (saved * num_docs / 1000000 / 1024 / 1024)
+        print(line)
+
+    line = "  %-100s ~%8.1f MB" % ('total', total / 1024 / 1024)
+    if num_docs:
+        line += " ~%9.1f MB" % (total * num_docs / 1000000 / 1024 / 1024)
+    print(line)
@@ -0,0 +1,478 @@
+"""Single pass mendelian annotation of all families and inheritance models.
+
+The annotate_* functions of add_mendelian_annotations.py scan the index
+once per family and model. annotate_mendelian scans it once for all of
+them: every document holding an affected child of a family is checked
+against the query conditions and predicate of each per-variant model, and
+all labels found for the document go out in one partial update.
+Compound heterozygosity spans several variants of a gene: annotate_compound_het
+collects the candidate variants of every child in the same scan style, groups
+them by gene in memory and labels the groups that hold a compound
+heterozygous pair, instead of one query per gene and family.
+
+Labels are written in one of three ways (write=):
+
+- 'script': a stored painless script adds the labels to the matching
+  Sample_ID entries, the request only carries the labels
+- 'doc': the whole labelled sample array is sent as a partial document
+- 'sidecar': one small document per label in <index>_annotations, joined
+  by the mendelian search at query time; the variant is not touched
+
+The actions go through an AnnotationWriter. Passes given the same writer
+are refreshed and reported on once, by writer.finish().
+
+load_vcf.py applies the same predicates while parsing, so a new import
+writes the labels with its documents. CompoundHetBuffer holds the
+compound heterozygous candidates of a parser until their genes are
+complete; genes cut by the edge of a parser task are finished after
+indexing by label_spilled_compound_het.
+"""
+from collections import defaultdict, OrderedDict
+
+from elasticsearch import helpers
+
+from annotation_writer import AnnotationWriter, put_label_script, script_label_action
+from index_versions import annotations_index
+from add_mendelian_annotations import (is_autosomal_dominant, is_x_linked_dominant, is_x_linked_recessive, is_x_linked_denovo,
+                                       are_variants_compound_heterozygous, range_rules, routing_meta)
+
+
+MODELS = ['autosomal_recessive', 'denovo', 'autosomal_dominant', 'x_linked_dominant', 'x_linked_recessive', 'x_linked_denovo']
+
+HET = ["0/1", "0|1", "1|0"]
+HOM_ALT = ["1/1", "1|1"]
+HOM_REF = ["0/0", "0|0"]
+
+# longer than any gene (DMD, about 2.2 Mb), all compound heterozygous candidates of a gene lie within this distance of the first one
+MAX_GENE_SPAN = 2500000
+
+# the consequence filters of the vep and annovar query templates
+DAMAGING_CONSEQUENCES = ["frameshift_variant", "splice_acceptor_variant", "splice_donor_variant", "start_lost", "start_retained_variant", "stop_gained", "stop_lost"]
+DAMAGING_EXONIC_FUNCTIONS = ["frameshift_deletion", "frameshift_insertion", "stopgain", "stoploss"]
+
+# pseudo-autosomal regions of X, left out of the x-linked models
+PAR_RANGES = range_rules['hg19/GRCh37']
+
+LABEL_WRITES = ['script', 'doc', 'sidecar']
+
+SIDECAR_MAPPING = {
+    "properties": {
+        "variant_id": {"type": "keyword"},
+        "Sample_ID": {"type": "keyword"},
+        "mendelian_disease": {"type": "keyword"}
+    }
+}
+
+SOURCE_FIELDS = ["sample", "CHROM", "POS", "CSQ_nested.Consequence", "ExonicFunc_ensGene", "ExonicFunc_refGene", "Func_ensGene", "Func_refGene"]
+COMPOUND_HET_SOURCE_FIELDS = SOURCE_FIELDS + ["CSQ_nested.SYMBOL", "AAChange_refGene.Gene"]
+
+
+def has_value(value, allowed):
+    """Like a term(s) query on a field that may hold a list of values"""
+    if isinstance(value, list):
+        return any(item in allowed for item in value)
+    return value in allowed
+
+
+def is_damaging(doc, annotation):
+    if annotation == 'vep':
+        return any(has_value(csq.get('Consequence'), DAMAGING_CONSEQUENCES) for csq in doc.get('CSQ_nested', []))
+    return (has_value(doc.get('ExonicFunc_ensGene'), DAMAGING_EXONIC_FUNCTIONS) or
+            has_value(doc.get('ExonicFunc_refGene'), DAMAGING_EXONIC_FUNCTIONS) or
+            has_value(doc.get('Func_ensGene'), ['splicing']) or
+            has_value(doc.get('Func_refGene'), ['splicing']))
+
+
+def in_par(pos):
+    return any(start < pos < end for start, end in PAR_RANGES)
+
+
+def inheritance_models(doc, sample, annotation):
+    """The models of MODELS whose query and predicate match the sample of an affected child in doc"""
+    if sample.get('Phenotype') != '2':
+        return []
+
+    models = []
+    parents_unaffected = sample.get('Mother_Phenotype') == '1' and sample.get('Father_Phenotype') == '1'
+    a_parent_affected = sample.get('Mother_Phenotype') == '2' or sample.get('Father_Phenotype') == '2'
+    gt = sample.get('GT')
+
+    if doc.get('CHROM') in ['X', 'Y']:
+        if doc['CHROM'] == 'X' and not in_par(doc.get('POS')):
+            if a_parent_affected and is_x_linked_dominant(sample):
+                models.append('x_linked_dominant')
+            if is_x_linked_recessive(sample) and is_damaging(doc, annotation):
+                models.append('x_linked_recessive')
+            if is_x_linked_denovo(sample):
+                models.append('x_linked_denovo')
+        return models
+
+    if (gt in HOM_ALT and parents_unaffected and sample.get('Mother_Genotype') in HET and
+            sample.get('Father_Genotype') in HET and is_damaging(doc, annotation)):
+        models.append('autosomal_recessive')
+    if (gt in HET and parents_unaffected and sample.get('Mother_Genotype') == '0/0' and
+            sample.get('Father_Genotype') == '0/0'):
+        models.append('denovo')
+    if gt in HET and a_parent_affected and is_autosomal_dominant(sample):
+        models.append('autosomal_dominant')
+    return models
+
+
+def ped_probands(ped_info, sample_ids):
+    """The child get_family_dict annotates in each family: the smallest Sample_ID of the family with both parents in the ped"""
+    probands = {}
+    for sample_id in sample_ids:
+        info = ped_info.get(sample_id)
+        if info is None or info.get('father') is None or info.get('mother') is None:
+            continue
+        family = info.get('family')
+        if family not in probands or sample_id < probands[family]:
+            probands[family] = sample_id
+    return frozenset(probands.values())
+
+
+def add_label(sample, model):
+    """Add model to the mendelian_diseases of sample, True if it was not there yet"""
+    mendelian_diseases = sample.setdefault('mendelian_diseases', [])
+    if model in mendelian_diseases:
+        return False
+    mendelian_diseases.append(model)
+    return True
+
+
+def prepare_label_write(es, index_name, write):
+    """Store the label script, or create the side-car index, before labels are written"""
+    if write == 'script':
+        put_label_script(es)
+    elif write == 'sidecar' and not es.indices.exists(index=annotations_index(index_name)):
+        es.indices.create(index=annotations_index(index_name), body={"mappings": SIDECAR_MAPPING})
+
+
+def labels_index(index_name, write):
+    """The index the labels end up in"""
+    return annotations_index(index_name) if write == 'sidecar' else index_name
+
+
+def iter_label_actions(index_name, es_id, routing, labels, sample_array=None, write='script'):
+    """Bulk actions adding labels, {Sample_ID: [model, ...]}, to a document. write='doc' sends sample_array, already labelled"""
+    if write == 'sidecar':
+        for child_id, models in labels.items():
+            for model in models:
+                yield {
+                    "_index": annotations_index(index_name),
+                    "_id": '%s|%s|%s' % (es_id, child_id, model),
+                    "_source": {"variant_id": es_id, "Sample_ID": child_id, "mendelian_disease": model}
+                }
+        return
+
+    if write == 'doc':
+        yield {
+            "_index": index_name,
+            '_op_type': 'update',
+            "_id": es_id,
+            **routing_meta(routing),
+            "doc": {
+                "sample": sample_array
+            }
+        }
+    else:
+        yield script_label_action(index_name, es_id, routing, labels)
+
+
+def iter_mendelian_updates(hits, child_ids, index_name, annotation, matched, write='script'):
+    """The label actions of each document that gets a new label, matched collects es_id + child_id per model"""
+    for hit in hits:
+        es_id = hit['_id']
+        sample_array = hit['_source']['sample']
+        labels = defaultdict(list)
+        for sample in sample_array:
+            child_id = sample.get('Sample_ID')
+            if child_id not in child_ids:
+                continue
+
+            for model in inheritance_models(hit['_source'], sample, annotation):
+                matched[model].add(es_id + child_id)
+                if add_label(sample, model):
+                    labels[child_id].append(model)
+
+        if labels:
+            yield from iter_label_actions(index_name, es_id, hit.get('_routing'), dict(labels), sample_array, write)
+
+
+def annotate_mendelian(es, index_name, family_dict, annotation, write='script', writer=None):
+    """Label the per-variant inheritance models of every family in one scan of the index, returns the matched samples per model"""
+    own_writer = writer is None
+    if own_writer:
+        writer = AnnotationWriter(es, labels_index(index_name, write))
+    child_ids = set(family['child_id'] for family in family_dict.values() if family.get('child_id'))
+    matched = {model: writer.matched_samples(model) for model in MODELS}
+    if not child_ids:
+        return matched
+    prepare_label_write(es, index_name, write)
+
+    query_body = {
+        "_source": SOURCE_FIELDS,
+        "query": {
+            "nested": {
+                "path": "sample",
+                "query": {
+                    "bool": {
+                        "filter": [
+                            {"terms": {"sample.Sample_ID": sorted(child_ids)}},
+                            {"term": {"sample.Phenotype": "2"}}
+                        ]
+                    }
+                },
+                "score_mode": "none"
+            }
+        }
+    }
+
+    hits = helpers.scan(es, query=query_body, scroll=u'5m', size=1000, preserve_order=False, index=index_name)
+    writer.add_many(iter_mendelian_updates(hits, child_ids, index_name, annotation, matched, write))
+    writer.flush()
+    if own_writer:
+        writer.finish()
+
+    return matched
+
+
+def variant_genes(doc, annotation):
+    """Genes the compound heterozygous search groups a variant by, the CSQ_nested.SYMBOL of damaging consequences or AAChange_refGene.Gene"""
+    if annotation == 'vep':
+        entries = [csq for csq in doc.get('CSQ_nested', []) if has_value(csq.get('Consequence'), DAMAGING_CONSEQUENCES)]
+        field = 'SYMBOL'
+    else:
+        entries, field = doc.get('AAChange_refGene', []), 'Gene'
+
+    genes = set()
+    for entry in entries:
+        value = entry.get(field)
+        if isinstance(value, list):
+            genes.update(item for item in value if item)
+        elif value:
+            genes.add(value)
+    return genes
+
+
+def is_compound_het_candidate(doc, sample, annotation):
+    """The compound heterozygous query conditions and the parent genotype rule of pop_sample_with_id_apply_compound_het_rules"""
+    if (doc.get('CHROM') in ['X', 'Y'] or sample.get('Phenotype') != '2' or sample.get('GT') not in HET or
+            sample.get('Mother_Phenotype') != '1' or sample.get('Father_Phenotype') != '1'):
+        return False
+    mother_gt = sample.get('Mother_Genotype')
+    father_gt = sample.get('Father_Genotype')
+    if not ((mother_gt in HET and father_gt in HOM_REF) or (mother_gt in HOM_REF and father_gt in HET)):
+        return False
+    return is_damaging(doc, annotation)
+
+
+def compound_het_variants(variants):
+    """All candidate variants of a gene and child if they hold a compound heterozygous pair, as labelled by annotate_compound_heterozygous"""
+    if len(variants) > 1 and are_variants_compound_heterozygous(variants):
+        return variants
+    return []
+
+
+def candidate_record(es_id, routing, sample):
+    """What the compound heterozygous rules need of a candidate, kept in memory instead of its document"""
+    return {'es_id': es_id, 'routing': routing, 'Father_Genotype': sample.get('Father_Genotype'),
+            'Mother_Genotype': sample.get('Mother_Genotype'), 'labelled': 'compound_heterozygous' in sample.get('mendelian_diseases', [])}
+
+
+def compound_het_targets(groups, matched):
+    """(_id, routing) -> children to label, from candidate records grouped by (..., child). matched collects es_id + child_id"""
+    to_label = defaultdict(set)
+    for key, variants in groups.items():
+        child_id = key[-1]
+        for variant in compound_het_variants(variants):
+            matched.add(variant['es_id'] + child_id)
+            if not variant['labelled']:
+                to_label[(variant['es_id'], variant['routing'])].add(child_id)
+    return to_label
+
+
+def iter_compound_het_updates(es, index_name, to_label, write='script', batch_size=500):
+    """The label actions of the documents of to_label. write='doc' reads their sample arrays back with one mget per batch"""
+    if write != 'doc':
+        for (es_id, routing), child_ids in to_label.items():
+            yield from iter_label_actions(index_name, es_id, routing, {child_id: ['compound_heterozygous'] for child_id in sorted(child_ids)}, write=write)
+        return
+
+    keys = list(to_label)
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        docs = [dict({'_id': es_id}, **({'routing': routing} if routing is not None else {})) for es_id, routing in batch]
+        response = es.mget(body={'docs': docs}, index=index_name, _source=['sample'])
+        for (es_id, routing), doc in zip(batch, response['docs']):
+            if not doc.get('found'):
+                continue
+            sample_array = doc['_source']['sample']
+            for sample in sample_array:
+                if sample.get('Sample_ID') in to_label[(es_id, routing)]:
+                    add_label(sample, 'compound_heterozygous')
+            yield from iter_label_actions(index_name, es_id, routing, None, sample_array, 'doc')
+
+
+def compound_het_query(child_ids, annotation):
+    """The conditions of the compound heterozygous query templates, for all children at once and without the gene"""
+    sample_filter = {
+        "nested": {
+            "path": "sample",
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"terms": {"sample.Sample_ID": sorted(child_ids)}},
+                        {"terms": {"sample.GT": HET}},
+                        {"term": {"sample.Phenotype": "2"}},
+                        {"term": {"sample.Mother_Phenotype": "1"}},
+                        {"term": {"sample.Father_Phenotype": "1"}}
+                    ]
+                }
+            },
+            "score_mode": "none"
+        }
+    }
+    query = {"bool": {"filter": [sample_filter], "must_not": [{"terms": {"CHROM": ["X", "Y"]}}]}}
+
+    if annotation == 'vep':
+        query["bool"]["filter"].append({
+            "nested": {
+                "path": "CSQ_nested",
+                "query": {"terms": {"CSQ_nested.Consequence": DAMAGING_CONSEQUENCES}},
+                "score_mode": "none"
+            }
+        })
+    else:
+        query["bool"]["should"] = [
+            {"terms": {"ExonicFunc_ensGene": DAMAGING_EXONIC_FUNCTIONS}},
+            {"terms": {"ExonicFunc_refGene": DAMAGING_EXONIC_FUNCTIONS}},
+            {"term": {"Func_ensGene": "splicing"}},
+            {"term": {"Func_refGene": "splicing"}}
+        ]
+        query["bool"]["minimum_should_match"] = 1
+
+    return {"_source": COMPOUND_HET_SOURCE_FIELDS, "query": query}
+
+
+def annotate_compound_het(es, index_name, family_dict, annotation, write='script', writer=None):
+    """Label compound heterozygous variants of every family from one scan of the index, returns the matched samples.
+
+    The candidates of each child are grouped by gene in memory, so the work
+    grows with the number of candidate variants rather than families x genes.
+    """
+    own_writer = writer is None
+    if own_writer:
+        writer = AnnotationWriter(es, labels_index(index_name, write))
+    child_ids = set(family['child_id'] for family in family_dict.values() if family.get('child_id'))
+    matched = writer.matched_samples('compound_heterozygous')
+    if not child_ids:
+        return matched
+    prepare_label_write(es, index_name, write)
+
+    groups = defaultdict(list) # (gene, child) -> candidate records
+    hits = helpers.scan(es, query=compound_het_query(child_ids, annotation), scroll=u'5m', size=1000, preserve_order=False, index=index_name)
+    for hit in hits:
+        doc = hit['_source']
+        candidates = [sample for sample in doc.get('sample', [])
+                      if sample.get('Sample_ID') in child_ids and is_compound_het_candidate(doc, sample, annotation)]
+        if not candidates:
+            continue
+        for gene in variant_genes(doc, annotation):
+            for sample in candidates:
+                groups[(gene, sample['Sample_ID'])].append(candidate_record(hit['_id'], hit.get('_routing'), sample))
+
+    to_label = compound_het_targets(groups, matched)
+    writer.add_many(iter_compound_het_updates(es, index_name, to_label, write))
+    writer.flush()
+    if own_writer:
+        writer.finish()
+
+    return matched
+
+
+class CompoundHetBuffer:
+    """Sink that labels compound heterozygous variants while parsing.
+
+    Documents without candidates go straight to sink. Documents with candidates
+    are held until every gene they are in is complete, i.e. the parser is on
+    another chromosome or more than MAX_GENE_SPAN past the first candidate of
+    the gene. The candidates of genes that may continue in another parser
+    task are kept in spilled, see label_spilled_compound_het.
+    """
+
+    def __init__(self, sink, annotation, doc_key, probands):
+        self.sink = sink
+        self.annotation = annotation
+        self.doc_key = doc_key # doc -> (_id, routing)
+        self.probands = probands # the Sample_IDs labelled, see ped_probands
+        self.genes = OrderedDict() # (CHROM, gene) -> {'start': POS, 'children': {Sample_ID: [(POS, sample, held doc)]}}
+        self.spilled = []
+        self.task_chrom = None
+        self.task_start = None
+
+    def put(self, doc):
+        chrom, pos = doc['CHROM'], doc['POS']
+        if self.task_start is None:
+            self.task_chrom, self.task_start = chrom, pos
+        self._close([key for key, gene in self.genes.items() if key[0] != chrom or pos > gene['start'] + MAX_GENE_SPAN])
+
+        candidates = [sample for sample in doc.get('sample', [])
+                      if sample.get('Sample_ID') in self.probands and is_compound_het_candidate(doc, sample, self.annotation)]
+        genes = variant_genes(doc, self.annotation) if candidates else ()
+        if not genes:
+            self.sink.put(doc)
+            return
+
+        held = [doc, len(genes)] # released when all its genes are closed
+        for gene in genes:
+            entry = self.genes.setdefault((chrom, gene), {'start': pos, 'children': defaultdict(list)})
+            for sample in candidates:
+                entry['children'][sample['Sample_ID']].append((pos, sample, held))
+
+    def finish_task(self):
+        """Called at the end of each parser task, the next task continues elsewhere in the vcf"""
+        self._close(list(self.genes), task_end=True)
+        self.task_chrom = None
+        self.task_start = None
+
+    def close(self):
+        self.finish_task()
+        self.sink.close()
+
+    def _close(self, keys, task_end=False):
+        for key in keys:
+            gene = self.genes.pop(key)
+            # a gene open at the end of the task, or starting near its beginning, may have candidates in another task
+            spill = task_end or (key[0] == self.task_chrom and gene['start'] < self.task_start + MAX_GENE_SPAN)
+
+            released = {}
+            for child_id, candidates in gene['children'].items():
+                for sample in compound_het_variants([sample for pos, sample, held in candidates]):
+                    add_label(sample, 'compound_heterozygous')
+
+                for pos, sample, held in candidates:
+                    released[id(held)] = held
+                    if spill:
+                        es_id, routing = self.doc_key(held[0])
+                        self.spilled.append(dict(candidate_record(es_id, routing, sample), chrom=key[0], gene=key[1], child=child_id, pos=pos))
+
+            for held in released.values():
+                held[1] -= 1
+                if held[1] == 0:
+                    self.sink.put(held[0])
+
+
+def label_spilled_compound_het(es, index_name, spilled, write='script'):
+    """Label the compound heterozygous pairs that span parser tasks, from the candidates spilled by CompoundHetBuffer"""
+    groups = defaultdict(dict)
+    for candidate in spilled:
+        groups[(candidate['chrom'], candidate['gene'], candidate['child'])][candidate['es_id']] = candidate
+    groups = {key: sorted(candidates.values(), key=lambda candidate: candidate['pos']) for key, candidates in groups.items()}
+
+    writer = AnnotationWriter(es, labels_index(index_name, write))
+    to_label = compound_het_targets(groups, writer.matched_samples('compound_heterozygous'))
+    prepare_label_write(es, index_name, write)
+    writer.add_many(iter_compound_het_updates(es, index_name, to_label, write))
+    print('Labelled {} compound_heterozygous variants whose genes span parser tasks'.format(len(to_label)))
+    writer.finish()
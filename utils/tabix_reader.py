@@ -0,0 +1,216 @@
+"""In-process region queries on tabix indexed vcf files, replacing the tabix binary.
+
+A .tbi index is a BGZF compressed binary file. For every sequence it holds a
+binning index (bin number -> chunks of virtual offsets holding the records
+that fall in the bin) and a linear index (smallest virtual offset of the
+records overlapping each 16kb window). See the SAM/tabix specification.
+"""
+import gzip
+import heapq
+import struct
+
+from bgzf_reader import BgzfReader
+
+
+LINEAR_SHIFT = 14 # 16kb linear index windows
+LINEAR_WINDOW = 1 << LINEAR_SHIFT
+
+# first bin number and bin size (as a shift) of each level of the binning scheme
+BIN_LEVELS = [(0, 29), (1, 26), (9, 23), (73, 20), (585, 17), (4681, 14)]
+META_BIN = 37450 # pseudo-bin holding per-sequence statistics, not records
+
+
+def reg2bins(beg, end):
+    """Bins that may hold records overlapping the 0-based, half-open interval [beg, end)"""
+    end -= 1
+    bins = []
+    for offset, shift in BIN_LEVELS:
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+def bin2range(bin_number):
+    """0-based, half-open genomic interval covered by a bin"""
+    for offset, shift in reversed(BIN_LEVELS):
+        if bin_number >= offset:
+            beg = (bin_number - offset) << shift
+            return beg, beg + (1 << shift)
+    raise ValueError("Invalid bin %d" % bin_number)
+
+
+class TabixIndex:
+    """Contents of a .tbi index"""
+
+    def __init__(self, names, bins, linear):
+        self.names = names # sequence names in file order
+        self.tid = {name: i for i, name in enumerate(names)}
+        self.bins = bins # per sequence: {bin: [(chunk_beg, chunk_end), ...]}
+        self.linear = linear # per sequence: [virtual offset of each 16kb window]
+
+    @classmethod
+    def load(cls, path):
+        """Load the .tbi index of the bgzipped file path"""
+        with gzip.open(path + '.tbi', 'rb') as fp:
+            data = fp.read()
+
+        if data[:4] != b'TBI\x01':
+            raise ValueError("Invalid tabix index: %s.tbi" % path)
+
+        n_ref, = struct.unpack_from('<i', data, 4)
+        l_nm, = struct.unpack_from('<i', data, 32)
+        names = [name.decode('latin1') for name in data[36:36 + l_nm].split(b'\x00') if name]
+        pos = 36 + l_nm
+
+        bins = []
+        linear = []
+        for i in range(n_ref):
+            n_bin, = struct.unpack_from('<i', data, pos)
+            pos += 4
+            ref_bins = {}
+            for j in range(n_bin):
+                bin_number, n_chunk = struct.unpack_from('<Ii', data, pos)
+                pos += 8
+                chunks = struct.unpack_from('<%dQ' % (2 * n_chunk), data, pos)
+                pos += 16 * n_chunk
+                if bin_number != META_BIN:
+                    ref_bins[bin_number] = list(zip(chunks[::2], chunks[1::2]))
+            n_intv, = struct.unpack_from('<i', data, pos)
+            pos += 4
+            linear.append(list(struct.unpack_from('<%dQ' % n_intv, data, pos)))
+            pos += 8 * n_intv
+            bins.append(ref_bins)
+
+        return cls(names, bins, linear)
+
+    def chunks(self, chrom, beg, end):
+        """Sorted, merged virtual offset chunks that hold all records overlapping [beg, end), 0-based"""
+        tid = self.tid.get(chrom)
+        if tid is None:
+            return []
+
+        linear = self.linear[tid]
+        window = beg >> LINEAR_SHIFT
+        min_offset = linear[window] if window < len(linear) else (linear[-1] if linear else 0)
+
+        ref_bins = self.bins[tid]
+        chunks = sorted(chunk for bin_number in reg2bins(beg, end) for chunk in ref_bins.get(bin_number, []) if chunk[1] > min_offset)
+
+        merged = []
+        for chunk_beg, chunk_end in chunks:
+            chunk_beg = max(chunk_beg, min_offset)
+            if merged and chunk_beg <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk_end)
+            else:
+                merged.append([chunk_beg, chunk_end])
+        return merged
+
+    def covered_windows(self, chrom):
+        """16kb windows of chrom that may hold the start of a record. Windows not in the set are certainly empty"""
+        tid = self.tid.get(chrom)
+        windows = set()
+        if tid is None:
+            return windows
+
+        for bin_number in self.bins[tid]:
+            beg, end = bin2range(bin_number)
+            windows.update(range(beg >> LINEAR_SHIFT, ((end - 1) >> LINEAR_SHIFT) + 1))
+        return windows
+
+    def window_bytes(self, chrom, window):
+        """Approximate compressed bytes of the records in a 16kb window, taken from the linear index"""
+        tid = self.tid.get(chrom)
+        if tid is None:
+            return 0
+
+        linear = self.linear[tid]
+        if window >= len(linear):
+            return 0
+        if window + 1 < len(linear):
+            next_offset = linear[window + 1]
+        else:
+            next_offset = max(chunk_end for chunks in self.bins[tid].values() for chunk_beg, chunk_end in chunks)
+        return max(0, (next_offset >> 16) - (linear[window] >> 16))
+
+
+class TabixReader:
+    """Fetch the vcf lines of a region, like `tabix file chr:start-end`, without a subprocess"""
+
+    def __init__(self, path):
+        self.index = TabixIndex.load(path)
+        self.reader = BgzfReader(path)
+
+    def fetch(self, chrom, start, end):
+        """Yield lines whose POS is in [start, end] (1-based, inclusive) as bytes, in file order.
+
+        Unlike tabix, a record is returned only by the region holding its
+        POS, so adjacent regions never return the same record twice.
+        """
+        chrom_bytes = chrom.encode('latin1')
+        for chunk_beg, chunk_end in self.index.chunks(chrom, start - 1, end):
+            self.reader.seek(chunk_beg)
+            while self.reader.tell() < chunk_end:
+                line = self.reader.readline()
+                if not line:
+                    break
+                if line.startswith(b'#'):
+                    continue
+
+                line_chrom, line_pos, rest = line.split(b'\t', 2)
+                if line_chrom != chrom_bytes:
+                    continue
+                pos = int(line_pos)
+                if pos > end:
+                    return
+                if pos >= start:
+                    yield line
+
+    def close(self):
+        self.reader.close()
+
+
+def _tag_lines(reader, group, chrom, start, end):
+    for line in reader.fetch(chrom, start, end):
+        yield int(line.split(b'\t', 2)[1]), group, line
+
+
+def fetch_merged(readers, chrom, start, end):
+    """One position sorted stream of (POS, group, line) over several tabix readers, given as {group: reader}"""
+    streams = [_tag_lines(reader, group, chrom, start, end) for group, reader in readers.items()]
+    return heapq.merge(*streams, key=lambda x: x[0])
+
+
+def plan_region_batches(indexes, chroms, target_bytes):
+    """Split chroms into (chrom, start, end) batches holding about target_bytes of compressed data summed over all indexes.
+
+    Windows that are empty in every index are skipped, so long gaps such as
+    centromeres produce no batches at all.
+    """
+    batches = []
+    for chrom in chroms:
+        windows = set()
+        for index in indexes:
+            windows.update(index.covered_windows(chrom))
+
+        batch_start = None
+        batch_bytes = 0
+        previous = None
+        for window in sorted(windows):
+            if batch_start is not None and window != previous + 1:
+                batches.append((chrom, batch_start * LINEAR_WINDOW + 1, (previous + 1) * LINEAR_WINDOW))
+                batch_start = None
+
+            if batch_start is None:
+                batch_start = window
+                batch_bytes = 0
+
+            batch_bytes += sum(index.window_bytes(chrom, window) for index in indexes)
+            previous = window
+
+            if batch_bytes >= target_bytes:
+                batches.append((chrom, batch_start * LINEAR_WINDOW + 1, (window + 1) * LINEAR_WINDOW))
+                batch_start = None
+
+        if batch_start is not None:
+            batches.append((chrom, batch_start * LINEAR_WINDOW + 1, (previous + 1) * LINEAR_WINDOW))
+
+    return batches
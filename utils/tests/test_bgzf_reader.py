@@ -0,0 +1,94 @@
+"""Line access of bgzf_reader.py against the bgzipped vcf files of test_data"""
+import gzip
+import os
+import shutil
+from unittest import mock
+
+import pytest
+
+import bgzf_reader
+from bgzf_reader import BgzfReader, GrabixIndex, grab_lines, is_bgzf
+
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'test_data')
+CASE_VCF = os.path.join(TEST_DATA, 'tabix_case.vcf.gz')
+
+
+def all_lines(path):
+    with gzip.open(path, 'rb') as fp:
+        return list(fp)
+
+
+def data_lines(path):
+    return [line for line in all_lines(path) if not line.startswith(b'#')]
+
+
+@pytest.fixture
+def vcf(tmp_path):
+    # the .gbi index is written next to the vcf
+    path = str(tmp_path / 'case.vcf.gz')
+    shutil.copy(CASE_VCF, path)
+    return path
+
+
+def test_is_bgzf(tmp_path):
+    plain_gzip = str(tmp_path / 'plain.vcf.gz')
+    with gzip.open(plain_gzip, 'wb') as fp:
+        fp.write(b'##fileformat=VCFv4.2\n')
+    text = str(tmp_path / 'plain.vcf')
+    with open(text, 'w') as fp:
+        fp.write('##fileformat=VCFv4.2\n')
+
+    assert is_bgzf(CASE_VCF)
+    assert not is_bgzf(plain_gzip)
+    assert not is_bgzf(text)
+    assert not is_bgzf(str(tmp_path / 'missing.vcf.gz'))
+
+
+def test_reader_lines_and_offsets():
+    with BgzfReader(CASE_VCF) as reader:
+        offsets = []
+        lines = []
+        while True:
+            offsets.append(reader.tell())
+            line = reader.readline()
+            if not line:
+                break
+            lines.append(line)
+        assert lines == all_lines(CASE_VCF)
+        # the lines span several blocks
+        assert len({offset >> 16 for offset in offsets}) > 1
+
+        # seeking back to a virtual offset reads the same line again
+        for i in [0, 1, len(lines) // 2, len(lines) - 1]:
+            reader.seek(offsets[i])
+            assert reader.readline() == lines[i]
+
+
+def test_grabix_index_is_created(vcf):
+    assert not os.path.exists(vcf + '.gbi')
+    index = GrabixIndex.load(vcf)
+    assert os.path.exists(vcf + '.gbi')
+
+    data = data_lines(vcf)
+    assert index.total_lines == len(data)
+    assert len(index.chunk_offsets) == (len(data) - 1) // bgzf_reader.GRABIX_CHUNK_SIZE + 2
+    with BgzfReader(vcf) as reader:
+        reader.seek(index.header_end)
+        assert reader.readline() == data[0]
+
+    # an existing index is read, not written again
+    mtime = os.path.getmtime(vcf + '.gbi')
+    assert GrabixIndex.load(vcf).chunk_offsets == index.chunk_offsets
+    assert os.path.getmtime(vcf + '.gbi') == mtime
+
+
+@pytest.mark.parametrize('start, end', [(1, 1), (1, 100), (100, 101), (101, 101), (250, 777), (999, 1101), (1095, 1200), (5, 4)])
+def test_grab_lines(vcf, start, end):
+    data = data_lines(vcf)
+    # small chunks, so ranges start in and cross several chunks
+    with mock.patch.object(bgzf_reader, 'GRABIX_CHUNK_SIZE', 100):
+        index = GrabixIndex.load(vcf)
+        assert len(index.chunk_offsets) == (len(data) - 1) // 100 + 2
+        assert list(grab_lines(vcf, start, end, index)) == data[start - 1:end]
+        assert list(grab_lines(vcf, start, end)) == data[start - 1:end]
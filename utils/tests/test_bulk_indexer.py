@@ -0,0 +1,221 @@
+"""Retry, split and dead-letter handling of bulk_indexer.BulkIndexer, against a fake Elasticsearch client"""
+import json
+from unittest import mock
+
+import pytest
+
+elasticsearch = pytest.importorskip('elasticsearch')
+
+from bulk_indexer import BulkIndexer
+
+
+def make_item(i, size=100):
+    action = json.dumps({"index": {"_index": "test", "_id": str(i)}})
+    doc = json.dumps({"n": i, "pad": 'x' * size})
+    return (action + '\n' + doc + '\n').encode()
+
+
+def item_ids(body):
+    lines = body.decode().splitlines()
+    return [json.loads(line)['index']['_id'] for line in lines[::2]]
+
+
+class FakeES:
+    """Records bulk requests. respond(ids, body) returns the response or raises, by default every item is indexed"""
+
+    def __init__(self, respond=None, took=10):
+        self.requests = []
+        self.indexed = []
+        self.took = took
+        self.respond = respond or (lambda ids, body: None)
+
+    def bulk(self, body):
+        ids = item_ids(body)
+        self.requests.append((ids, len(body)))
+        response = self.respond(ids, body)
+        if response is None:
+            response = ok_response(ids, self.took)
+        for i, result in zip(ids, response['items']):
+            if result['index']['status'] < 300:
+                self.indexed.append(i)
+        return response
+
+
+def ok_response(ids, took=10, status=None):
+    status = status or {}
+    items = [{"index": {"_id": i, "status": status.get(i, 201)}} for i in ids]
+    for item in items:
+        if item['index']['status'] >= 300:
+            item['index']['error'] = {"type": "test_error", "reason": "status %d" % item['index']['status']}
+    return {"took": took, "errors": any(item['index']['status'] >= 300 for item in items), "items": items}
+
+
+@pytest.fixture(autouse=True)
+def no_sleep():
+    with mock.patch('bulk_indexer.time.sleep') as sleep:
+        yield sleep
+
+
+def read_dead_letter(path):
+    with open(path, 'rb') as fp:
+        items = fp.read()
+    with open(path + '.errors') as fp:
+        errors = [json.loads(line) for line in fp]
+    return items, errors
+
+
+def test_413_splits_the_request(tmp_path):
+    limit = 2500
+    rejected = []
+
+    def respond(ids, body):
+        if len(body) > limit:
+            rejected.append(len(body))
+            raise elasticsearch.TransportError(413, 'request too large')
+
+    # requests take as long as targeted, so only the rejection changes the request size
+    es = FakeES(respond, took=2000)
+    items = [make_item(i) for i in range(100)]
+    indexer = BulkIndexer(es, str(tmp_path / 'dead.json'), max_bytes=40000, min_bytes=1000)
+    indexer.add_many(items)
+    indexer.close()
+
+    assert es.indexed == [str(i) for i in range(100)]
+    assert indexer.num_indexed == 100 and indexer.num_failed == 0
+    # every rejection halves the request size and the rejected request is split at it, never sent again as it was
+    assert indexer.num_rejected > 0
+    assert rejected[0] <= 10000 and max(rejected[1:]) <= 5000
+    assert indexer.batch_bytes <= limit
+    assert not (tmp_path / 'dead.json').exists()
+
+
+def test_request_429_shrinks_then_adapts(tmp_path):
+    rejections = []
+
+    def respond(ids, body):
+        if not rejections:
+            rejections.append(ids)
+            raise elasticsearch.TransportError(429, 'es_rejected_execution_exception')
+
+    es = FakeES(respond, took=10)
+    indexer = BulkIndexer(es, str(tmp_path / 'dead.json'), max_bytes=16000, min_bytes=1000, target_took=2000)
+    assert indexer.batch_bytes == 4000
+
+    items = [make_item(i) for i in range(200)]
+    indexer.add_many(items[:30])
+    # the rejected request is shrunk and split
+    assert len(rejections[0]) > 1
+    assert indexer.num_rejected == len(rejections[0])
+    assert es.indexed[:len(rejections[0])] == rejections[0]
+
+    # fast requests grow the request size back, up to max_bytes
+    indexer.add_many(items[30:])
+    indexer.close()
+    assert indexer.batch_bytes == 16000
+    assert es.indexed == [str(i) for i in range(200)]
+    assert indexer.num_failed == 0
+
+
+def test_slow_requests_shrink():
+    es = FakeES(took=8000)
+    indexer = BulkIndexer(es, 'unused', max_bytes=16000, min_bytes=1000, target_took=2000)
+    indexer.add_many([make_item(i) for i in range(100)])
+    indexer.close()
+    assert indexer.batch_bytes == 1000
+    assert indexer.num_indexed == 100
+
+
+def test_item_429_is_retried_at_the_shrunk_size(tmp_path):
+    rejected = set()
+
+    def respond(ids, body):
+        # the first time it is sent, every other item is rejected
+        status = {i: 429 for i in ids if int(i) % 2 and i not in rejected}
+        rejected.update(status)
+        # as long as targeted, so only the rejection changes the request size
+        return ok_response(ids, took=2000, status=status)
+
+    es = FakeES(respond)
+    indexer = BulkIndexer(es, str(tmp_path / 'dead.json'), max_bytes=16000, min_bytes=1000)
+    indexer.add_many([make_item(i) for i in range(20)])
+    indexer.close()
+
+    assert sorted(es.indexed, key=int) == [str(i) for i in range(20)]
+    assert indexer.num_rejected == 10 and indexer.num_retried == 10
+    assert indexer.batch_bytes < 4000
+    assert indexer.num_failed == 0
+
+
+def test_item_failures_go_to_the_dead_letter_file(tmp_path):
+    dead_letter = str(tmp_path / 'dead.json')
+    items = [make_item(i) for i in range(10)]
+    es = FakeES(lambda ids, body: ok_response(ids, status={'3': 400, '7': 409}))
+    indexer = BulkIndexer(es, dead_letter)
+    indexer.add_many(items)
+    indexer.close()
+
+    assert indexer.num_indexed == 8 and indexer.num_failed == 2
+    failed, errors = read_dead_letter(dead_letter)
+    assert failed == items[3] + items[7]
+    assert [(error['_id'], error['status']) for error in errors] == [('3', 400), ('7', 409)]
+    assert errors[0]['error']['type'] == 'test_error'
+    assert dead_letter in indexer.report()
+
+
+def test_request_failures_go_to_the_dead_letter_file(tmp_path):
+    dead_letter = str(tmp_path / 'dead.json')
+    items = [make_item(i) for i in range(5)]
+
+    def respond(ids, body):
+        raise elasticsearch.TransportError(400, 'mapper_parsing_exception')
+
+    indexer = BulkIndexer(FakeES(respond), dead_letter)
+    indexer.add_many(items)
+    indexer.close()
+
+    failed, errors = read_dead_letter(dead_letter)
+    assert failed == b''.join(items)
+    assert [error['status'] for error in errors] == [400] * 5
+    assert indexer.num_retried == 0
+
+
+def test_retries_run_out(tmp_path, no_sleep):
+    dead_letter = str(tmp_path / 'dead.json')
+
+    def respond(ids, body):
+        raise elasticsearch.ConnectionError('N/A', 'connection refused', None)
+
+    es = FakeES(respond)
+    indexer = BulkIndexer(es, dead_letter, max_retries=3)
+    indexer.add_many([make_item(i) for i in range(5)])
+    indexer.close()
+
+    assert len(es.requests) == 4
+    assert no_sleep.call_count == 3
+    failed, errors = read_dead_letter(dead_letter)
+    assert [error['status'] for error in errors] == [None] * 5
+
+
+def test_resumed_run_appends_to_the_dead_letter_file(tmp_path):
+    dead_letter = str(tmp_path / 'dead.json')
+    with open(dead_letter, 'wb') as fp:
+        fp.write(b'earlier\n')
+    with open(dead_letter + '.errors', 'wb') as fp:
+        fp.write(b'{"_id": "earlier"}\n')
+
+    indexer = BulkIndexer(FakeES(lambda ids, body: ok_response(ids, status={'1': 400})), dead_letter, append=True)
+    indexer.add_many([make_item(i) for i in range(3)])
+    indexer.close()
+
+    failed, errors = read_dead_letter(dead_letter)
+    assert failed == b'earlier\n' + make_item(1)
+    assert [error['_id'] for error in errors] == ['earlier', '1']
+
+
+def test_on_flush_follows_acknowledged_items(tmp_path):
+    es = FakeES()
+    acknowledged = []
+    indexer = BulkIndexer(es, str(tmp_path / 'dead.json'), on_flush=lambda: acknowledged.append(len(es.indexed)))
+    indexer.add_many([make_item(i) for i in range(3)])
+    indexer.close()
+    assert acknowledged == [3]
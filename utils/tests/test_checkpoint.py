@@ -0,0 +1,66 @@
+"""Checkpoint manifest written while loading and read back by load_vcf.py --resume"""
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from checkpoint import Checkpoint
+
+
+@pytest.fixture
+def chunk_files(tmp_path):
+    files = []
+    for i in range(2):
+        path = str(tmp_path / ('test.vcf.gz.chunk_%d.json' % i))
+        with open(path, 'w') as fp:
+            fp.write('{}\n')
+        files.append(path)
+    return files
+
+
+def test_reload_for_resume(tmp_path, chunk_files):
+    path = str(tmp_path / 'checkpoint.json')
+    checkpoint = Checkpoint(path)
+    checkpoint.start('test.vcf.gz', 'test_index', chunk_files, 'test_index_v20200101000000', [['1', 'GENE', 'S1']])
+    checkpoint.update(chunk_files[0], 4096, 10)
+    checkpoint.update(chunk_files[1], 8192, 20, done=True)
+
+    resumed = Checkpoint(path)
+    assert resumed.matches('test.vcf.gz', 'test_index')
+    assert not resumed.matches('test.vcf.gz', 'other_index')
+    assert not resumed.matches('other.vcf.gz', 'test_index')
+    assert resumed.physical_index() == 'test_index_v20200101000000'
+    assert resumed.compound_het_spilled() == [['1', 'GENE', 'S1']]
+    assert resumed.output_files() == chunk_files
+    assert resumed.position(chunk_files[0]) == (4096, 10, False)
+    assert resumed.position(chunk_files[1]) == (8192, 20, True)
+    assert resumed.position('unknown.json') == (0, 0, False)
+
+
+def test_no_match_without_the_chunk_files(tmp_path, chunk_files):
+    path = str(tmp_path / 'checkpoint.json')
+    Checkpoint(path).start('test.vcf.gz', 'test_index', chunk_files, 'test_index_v20200101000000')
+    assert Checkpoint(path).compound_het_spilled() is None
+
+    os.remove(chunk_files[1])
+    assert not Checkpoint(path).matches('test.vcf.gz', 'test_index')
+    assert not Checkpoint(str(tmp_path / 'missing.json')).matches('test.vcf.gz', 'test_index')
+
+
+def test_interrupted_save_keeps_the_last_manifest(tmp_path, chunk_files):
+    path = str(tmp_path / 'checkpoint.json')
+    checkpoint = Checkpoint(path)
+    checkpoint.start('test.vcf.gz', 'test_index', chunk_files, 'test_index_v20200101000000')
+    checkpoint.update(chunk_files[0], 4096, 10)
+
+    def dump_and_die(manifest, fp, **kwargs):
+        fp.write(json.dumps(manifest)[:20])
+        raise KeyboardInterrupt
+
+    with mock.patch('checkpoint.json.dump', side_effect=dump_and_die):
+        with pytest.raises(KeyboardInterrupt):
+            checkpoint.update(chunk_files[0], 65536, 200)
+
+    # the manifest on disk is whole and still holds the last saved position
+    assert Checkpoint(path).position(chunk_files[0]) == (4096, 10, False)
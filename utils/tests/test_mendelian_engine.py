@@ -0,0 +1,327 @@
+"""Parse-time inheritance labelling of mendelian_engine.py against the query templates of add_mendelian_annotations.py.
+
+Each case is a variant and the sample entry of an affected child. The models
+expected for it are derived from the templates themselves: the template
+query is evaluated against the document and the predicate the annotate_*
+function applies to the hits is run on the child, as the index annotation
+does. inheritance_models has to find exactly those models.
+"""
+import json
+from collections import defaultdict
+from unittest import mock
+
+import pytest
+
+pytest.importorskip('elasticsearch')
+pytest.importorskip('natsort')
+
+import add_mendelian_annotations as templates
+from mendelian_engine import (MAX_GENE_SPAN, CompoundHetBuffer, compound_het_targets, inheritance_models,
+                              is_compound_het_candidate, label_spilled_compound_het, ped_probands)
+
+
+CHILD_ID = 'C1'
+
+# model -> (template per annotation, predicate run on the hits)
+MODEL_TEMPLATES = {
+    'autosomal_recessive': ({'vep': templates.autosomal_recessive_vep_query_body_template,
+                             'annovar': templates.autosomal_recessive_annovar_query_body_template}, None),
+    'denovo': ({'vep': templates.denovo_query_body_template, 'annovar': templates.denovo_query_body_template}, None),
+    'autosomal_dominant': ({'vep': templates.autosomal_dominant_query_body_template,
+                            'annovar': templates.autosomal_dominant_query_body_template}, templates.is_autosomal_dominant),
+    'x_linked_dominant': ({'vep': templates.x_linked_dominant_query_body_template,
+                           'annovar': templates.x_linked_dominant_query_body_template}, templates.is_x_linked_dominant),
+    'x_linked_recessive': ({'vep': templates.x_linked_recessive_vep_query_body_template,
+                            'annovar': templates.x_linked_recessive_annovar_query_body_template}, templates.is_x_linked_recessive),
+    'x_linked_denovo': ({'vep': templates.x_linked_de_novo_query_body_template,
+                         'annovar': templates.x_linked_de_novo_query_body_template}, templates.is_x_linked_denovo),
+}
+
+
+def field_value(field, doc, nested):
+    if nested is not None and field.startswith(nested[0] + '.'):
+        return nested[1].get(field[len(nested[0]) + 1:])
+    return doc.get(field)
+
+
+def values_of(value):
+    return value if isinstance(value, list) else [value]
+
+
+def query_matches(clause, doc, nested=None):
+    """Evaluate the subset of the query DSL used by the templates against a document"""
+    (kind, body), = clause.items()
+    if kind == 'bool':
+        required = body.get('filter', []) + body.get('must', [])
+        should = body.get('should', [])
+        minimum_should_match = body.get('minimum_should_match', 0 if required else 1)
+        return (all(query_matches(sub, doc, nested) for sub in required) and
+                not any(query_matches(sub, doc, nested) for sub in body.get('must_not', [])) and
+                (not should or sum(query_matches(sub, doc, nested) for sub in should) >= minimum_should_match))
+    if kind == 'nested':
+        return any(query_matches(body['query'], doc, (body['path'], obj)) for obj in doc.get(body['path'], []))
+
+    (field, condition), = body.items()
+    value = values_of(field_value(field, doc, nested))
+    if kind == 'term':
+        return condition in value
+    if kind == 'terms':
+        return any(item in condition for item in value)
+    if kind == 'range':
+        checks = {'gt': lambda a, b: a > b, 'gte': lambda a, b: a >= b, 'lt': lambda a, b: a < b, 'lte': lambda a, b: a <= b}
+        return any(item is not None and all(checks[op](item, bound) for op, bound in condition.items()) for item in value)
+    raise ValueError(kind)
+
+
+def template_models(doc, sample, annotation):
+    """The models whose template finds doc for the child and whose predicate accepts the child's sample"""
+    models = set()
+    for model, (model_templates, predicate) in MODEL_TEMPLATES.items():
+        template = model_templates[annotation]
+        if model.startswith('x_linked'):
+            query = templates.x_linked_query(template, CHILD_ID)
+        else:
+            query = template % CHILD_ID
+        if query_matches(json.loads(query)['query'], doc) and (predicate is None or predicate(sample)):
+            models.add(model)
+    return models
+
+
+def make_sample(gt, mother_gt, father_gt, mother_phenotype='1', father_phenotype='1', sex='1', phenotype='2', sample_id=CHILD_ID):
+    return {'Sample_ID': sample_id, 'Phenotype': phenotype, 'Sex': sex, 'GT': gt,
+            'Mother_Genotype': mother_gt, 'Father_Genotype': father_gt,
+            'Mother_Phenotype': mother_phenotype, 'Father_Phenotype': father_phenotype}
+
+
+def make_doc(chrom, pos, sample, damaging=True, gene='GENE1', doc_id=None):
+    doc = {'CHROM': chrom, 'POS': pos, 'sample': [sample, make_sample('0/0', '0/0', '0/0', phenotype='1', sample_id='OTHER')],
+           'CSQ_nested': [{'Consequence': 'stop_gained' if damaging else 'missense_variant', 'SYMBOL': gene}],
+           'ExonicFunc_refGene': 'stopgain' if damaging else 'nonsynonymous_SNV',
+           'AAChange_refGene': [{'Gene': gene}]}
+    if doc_id is not None:
+        doc['id'] = doc_id
+    return doc
+
+
+PAR1, PAR2 = templates.range_rules['hg19/GRCh37']
+
+CASES = [
+    # autosomal
+    ('denovo', make_doc('1', 1000, make_sample('0/1', '0/0', '0/0')), {'denovo'}),
+    ('denovo, phased child', make_doc('1', 1000, make_sample('1|0', '0/0', '0/0')), {'denovo'}),
+    ('denovo needs exactly 0/0 mother', make_doc('1', 1000, make_sample('0/1', '0|0', '0/0')), set()),
+    ('denovo needs exactly 0/0 father', make_doc('1', 1000, make_sample('0/1', '0/0', '0|0')), set()),
+    ('denovo needs both parents hom ref', make_doc('1', 1000, make_sample('0/1', '0/1', '0/0')), set()),
+    ('denovo needs unaffected parents', make_doc('1', 1000, make_sample('0/1', '0/0', '0/0', father_phenotype='2')), set()),
+    ('denovo needs a het child', make_doc('1', 1000, make_sample('1/1', '0/0', '0/0')), set()),
+    ('unaffected child', make_doc('1', 1000, make_sample('0/1', '0/0', '0/0', phenotype='1')), set()),
+    ('autosomal recessive', make_doc('1', 1000, make_sample('1/1', '0/1', '1|0')), {'autosomal_recessive'}),
+    ('autosomal recessive needs a damaging variant', make_doc('1', 1000, make_sample('1/1', '0/1', '0/1'), damaging=False), set()),
+    ('autosomal recessive needs het parents', make_doc('1', 1000, make_sample('1/1', '1/1', '0/1')), set()),
+    ('autosomal dominant, mother', make_doc('1', 1000, make_sample('0/1', '0/1', '0/0', mother_phenotype='2')), {'autosomal_dominant'}),
+    ('autosomal dominant, father', make_doc('1', 1000, make_sample('0|1', '0|0', '0/1', father_phenotype='2')), {'autosomal_dominant'}),
+    ('autosomal dominant, both parents affected', make_doc('1', 1000, make_sample('0/1', '0/1', '0/0', '2', '2')), set()),
+    ('autosomal dominant, allele from the unaffected parent', make_doc('1', 1000, make_sample('0/1', '0/0', '0/1', mother_phenotype='2')), set()),
+    ('no autosomal model on Y', make_doc('Y', 1000, make_sample('0/1', '0/0', '0/0')), set()),
+    ('no autosomal model on X', make_doc('X', 3000000, make_sample('0/1', '0/0', '0/0', sex='2')), {'x_linked_denovo'}),
+    # x-linked, outside the pseudo-autosomal regions
+    ('x-linked recessive, son', make_doc('X', 3000000, make_sample('1', '0/1', '0')), {'x_linked_recessive'}),
+    ('x-linked recessive needs a damaging variant', make_doc('X', 3000000, make_sample('1', '0/1', '0'), damaging=False), set()),
+    ('x-linked recessive, daughter', make_doc('X', 3000000, make_sample('1/1', '0/1', '1', father_phenotype='2', sex='2')), {'x_linked_recessive'}),
+    ('x-linked dominant, son', make_doc('X', 3000000, make_sample('1', '0/1', '0', mother_phenotype='2')), {'x_linked_dominant'}),
+    ('x-linked dominant, daughter', make_doc('X', 3000000, make_sample('0/1', '0/0', '1', father_phenotype='2', sex='2')), {'x_linked_dominant'}),
+    ('x-linked dominant needs an affected parent', make_doc('X', 3000000, make_sample('0/1', '0/1', '0/0', sex='2')), set()),
+    ('x-linked denovo, son', make_doc('X', 3000000, make_sample('1', '0/0', '0')), {'x_linked_denovo'}),
+    ('x-linked denovo, phased parents', make_doc('X', 3000000, make_sample('0|1', '0|0', '0|0', sex='2')), {'x_linked_denovo'}),
+    ('x-linked model on Y', make_doc('Y', 3000000, make_sample('1', '0/0', '0')), set()),
+    # the pseudo-autosomal regions are left out, their bounds are not
+    ('PAR1', make_doc('X', 100000, make_sample('1', '0/1', '0')), set()),
+    ('PAR2', make_doc('X', 155000000, make_sample('1', '0/0', '0')), set()),
+    ('PAR1 start', make_doc('X', PAR1[0], make_sample('1', '0/1', '0')), {'x_linked_recessive'}),
+    ('just inside PAR1', make_doc('X', PAR1[0] + 1, make_sample('1', '0/1', '0')), set()),
+    ('just inside PAR2', make_doc('X', PAR2[1] - 1, make_sample('1', '0/0', '0')), set()),
+    ('PAR2 end', make_doc('X', PAR2[1], make_sample('1', '0/0', '0')), {'x_linked_denovo'}),
+]
+
+
+@pytest.mark.parametrize('annotation', ['vep', 'annovar'])
+@pytest.mark.parametrize('name, doc, expected', CASES, ids=[case[0] for case in CASES])
+def test_inheritance_models_match_the_templates(name, doc, expected, annotation):
+    sample = doc['sample'][0]
+    assert template_models(doc, sample, annotation) == expected
+    assert set(inheritance_models(doc, sample, annotation)) == expected
+
+
+def compound_het_template_matches(doc, annotation, gene='GENE1'):
+    if annotation == 'vep':
+        template = templates.compound_heterozygous_vep_query_body_template
+    else:
+        template = templates.compound_heterozygous_annovar_query_body_template
+    query = json.loads(template % (CHILD_ID, gene))['query']
+    sample = dict(doc['sample'][0])
+    return query_matches(query, doc) and templates.pop_sample_with_id_apply_compound_het_rules([sample], CHILD_ID) is not None
+
+
+COMPOUND_HET_CASES = [
+    ('from the father', make_doc('1', 1000, make_sample('0/1', '0/0', '0/1')), True),
+    ('from the mother', make_doc('1', 1000, make_sample('0|1', '0/1', '0|0')), True),
+    ('from both parents', make_doc('1', 1000, make_sample('0/1', '0/1', '0/1')), False),
+    ('from neither parent', make_doc('1', 1000, make_sample('0/1', '0/0', '0/0')), False),
+    ('hom alt child', make_doc('1', 1000, make_sample('1/1', '0/0', '0/1')), False),
+    ('affected parent', make_doc('1', 1000, make_sample('0/1', '0/0', '0/1', father_phenotype='2')), False),
+    ('not damaging', make_doc('1', 1000, make_sample('0/1', '0/0', '0/1'), damaging=False), False),
+    ('on X', make_doc('X', 3000000, make_sample('0/1', '0/0', '0/1', sex='2')), False),
+]
+
+
+@pytest.mark.parametrize('annotation', ['vep', 'annovar'])
+@pytest.mark.parametrize('name, doc, expected', COMPOUND_HET_CASES, ids=[case[0] for case in COMPOUND_HET_CASES])
+def test_compound_het_candidates_match_the_templates(name, doc, expected, annotation):
+    assert compound_het_template_matches(doc, annotation) == expected
+    assert is_compound_het_candidate(doc, doc['sample'][0], annotation) == expected
+
+
+def test_ped_probands():
+    ped_info = {
+        'C2': {'family': 'F1', 'father': 'P1', 'mother': 'P2'},
+        'C1': {'family': 'F1', 'father': 'P1', 'mother': 'P2'},
+        'P1': {'family': 'F1', 'father': None, 'mother': None},
+        'D1': {'family': 'F2', 'father': None, 'mother': 'P4'},
+        'E2': {'family': 'F3', 'father': 'P5', 'mother': 'P6'},
+        'E1': {'family': 'F3', 'father': 'P5', 'mother': 'P6'},
+    }
+    # E1 is not in the vcf, the smallest Sample_ID with both parents among those that are is labelled
+    assert ped_probands(ped_info, ['C2', 'C1', 'P1', 'D1', 'E2', 'X1']) == {'C1', 'E2'}
+
+
+class ListSink:
+
+    def __init__(self):
+        self.docs = []
+
+    def put(self, doc):
+        self.docs.append(doc)
+
+    def close(self):
+        pass
+
+
+def doc_key(doc):
+    return doc['id'], None
+
+
+def het_from(parent, pos, gene='GENE1', sample_id=CHILD_ID, chrom='1'):
+    if parent == 'father':
+        sample = make_sample('0/1', '0/0', '0/1', sample_id=sample_id)
+    else:
+        sample = make_sample('0/1', '0/1', '0/0', sample_id=sample_id)
+    return make_doc(chrom, pos, sample, gene=gene, doc_id='%s_%d_%s' % (chrom, pos, sample_id))
+
+
+def labelled(doc, sample_id=CHILD_ID):
+    sample = [sample for sample in doc['sample'] if sample['Sample_ID'] == sample_id][0]
+    return 'compound_heterozygous' in sample.get('mendelian_diseases', [])
+
+
+def make_buffer(annotation='vep', probands=frozenset([CHILD_ID])):
+    sink = ListSink()
+    return CompoundHetBuffer(sink, annotation, doc_key, probands), sink
+
+
+@pytest.mark.parametrize('annotation', ['vep', 'annovar'])
+def test_compound_het_needs_an_allele_from_each_parent_in_the_same_gene(annotation):
+    buffer, sink = make_buffer(annotation)
+    docs = [
+        het_from('father', 1000, 'GENE1'), het_from('mother', 2000, 'GENE1'), # a pair
+        het_from('father', 3000, 'GENE2'), het_from('father', 4000, 'GENE2'), # both from the father
+        het_from('father', 5000, 'GENE3'), het_from('mother', 6000, 'GENE4'), # different genes
+    ]
+    for doc in docs:
+        buffer.put(doc)
+    buffer.close()
+
+    assert sorted(doc['POS'] for doc in sink.docs) == [doc['POS'] for doc in docs]
+    assert [labelled(doc) for doc in docs] == [True, True, False, False, False, False]
+
+
+def test_compound_het_only_labels_probands():
+    buffer, sink = make_buffer(probands=frozenset(['C2']))
+    docs = [het_from('father', 1000), het_from('mother', 2000)]
+    for doc in docs:
+        buffer.put(doc)
+    buffer.close()
+    assert not any(labelled(doc) for doc in docs)
+
+
+def test_compound_het_gene_closes_after_max_gene_span():
+    buffer, sink = make_buffer()
+    start = 10 * MAX_GENE_SPAN
+    buffer.put(het_from('father', start - 2 * MAX_GENE_SPAN, 'GENE0')) # moves the task start away from the genes below
+
+    first = het_from('father', start)
+    buffer.put(first)
+    assert first not in sink.docs # held until its gene is complete
+
+    # a variant of the same gene name beyond MAX_GENE_SPAN closes the gene first, so they do not pair
+    beyond = het_from('mother', start + MAX_GENE_SPAN + 1)
+    buffer.put(beyond)
+    assert first in sink.docs and beyond not in sink.docs
+    assert not labelled(first)
+
+    within = het_from('father', start + 2 * MAX_GENE_SPAN)
+    buffer.put(within)
+    buffer.close()
+    assert labelled(beyond) and labelled(within)
+    # closed in the middle of the task, far enough from its start, nothing was spilled for the first gene
+    assert not [candidate for candidate in buffer.spilled if candidate['pos'] == start]
+
+
+def test_compound_het_candidates_spill_at_the_task_edge():
+    # one gene cut by the edge between two parser tasks
+    spilled = []
+    for task in [[het_from('father', 1000), het_from('father', 5000, 'GENE2')], [het_from('mother', 2000), het_from('father', 20000000, 'GENE3')]]:
+        buffer, sink = make_buffer()
+        for doc in task:
+            buffer.put(doc)
+        buffer.finish_task()
+        # nothing is held past the end of the task, and on its own no task has a pair
+        assert sink.docs == task
+        assert not any(labelled(doc) for doc in task)
+        spilled.extend(buffer.spilled)
+
+    # the genes started near the task start or open at its end are spilled
+    assert sorted((candidate['gene'], candidate['pos']) for candidate in spilled) == [
+        ('GENE1', 1000), ('GENE1', 2000), ('GENE2', 5000), ('GENE3', 20000000)]
+
+    groups = defaultdict(list)
+    for candidate in sorted(spilled, key=lambda candidate: candidate['pos']):
+        groups[(candidate['chrom'], candidate['gene'], candidate['child'])].append(candidate)
+    matched = set()
+    assert compound_het_targets(groups, matched) == {('1_1000_C1', None): {CHILD_ID}, ('1_2000_C1', None): {CHILD_ID}}
+    assert matched == {'1_1000_C1' + CHILD_ID, '1_2000_C1' + CHILD_ID}
+
+
+def test_gene_closed_by_another_chromosome_near_the_task_start_is_spilled():
+    buffer, sink = make_buffer()
+    buffer.put(het_from('father', 1000))
+    buffer.put(het_from('father', 1000, 'GENE2', chrom='2'))
+    assert [candidate['pos'] for candidate in buffer.spilled] == [1000]
+
+
+def test_label_spilled_compound_het():
+    spilled = []
+    for task in [[het_from('father', 1000)], [het_from('mother', 2000)], [het_from('mother', 3000, 'GENE2')]]:
+        buffer, sink = make_buffer()
+        for doc in task:
+            buffer.put(doc)
+        buffer.finish_task()
+        spilled.extend(buffer.spilled)
+
+    sent = []
+    es = mock.Mock()
+    with mock.patch('annotation_writer.helpers.bulk', side_effect=lambda es, actions, **kwargs: sent.extend(actions)):
+        label_spilled_compound_het(es, 'test_index_v20200101000000', spilled, 'sidecar')
+
+    assert sorted((action['_source']['variant_id'], action['_source']['Sample_ID'], action['_source']['mendelian_disease']) for action in sent) == [
+        ('1_1000_C1', CHILD_ID, 'compound_heterozygous'), ('1_2000_C1', CHILD_ID, 'compound_heterozygous')]
+    assert {action['_index'] for action in sent} == {'test_index_v20200101000000_annotations'}
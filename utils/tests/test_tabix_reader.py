@@ -0,0 +1,135 @@
+"""Region queries of tabix_reader.py against the tabix indexed vcf files of test_data.
+
+tabix_case.vcf.gz has a record every 40bp of 1:100-40000 and 1:200000-201000,
+with a 30bp deletion at 1:16380 crossing the edge of the first 16kb window,
+and records on 2. tabix_control.vcf.gz has a record every 80bp from 1:120 and
+one at 1:16380 too.
+"""
+import gzip
+import os
+
+import pytest
+
+from tabix_reader import (LINEAR_WINDOW, TabixIndex, TabixReader, bin2range, fetch_merged, plan_region_batches,
+                          reg2bins)
+
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'test_data')
+CASE_VCF = os.path.join(TEST_DATA, 'tabix_case.vcf.gz')
+CONTROL_VCF = os.path.join(TEST_DATA, 'tabix_control.vcf.gz')
+
+
+def data_lines(path):
+    with gzip.open(path, 'rb') as fp:
+        return [line for line in fp if not line.startswith(b'#')]
+
+
+def expected(path, chrom, start, end):
+    return [line for line in data_lines(path)
+            if line.split(b'\t')[0] == chrom.encode() and start <= int(line.split(b'\t')[1]) <= end]
+
+
+def positions(lines):
+    return [int(line.split(b'\t')[1]) for line in lines]
+
+
+@pytest.fixture
+def case_reader():
+    reader = TabixReader(CASE_VCF)
+    yield reader
+    reader.close()
+
+
+def overlapping_bins(beg, end):
+    # every bin of the binning scheme overlapping [beg, end), by brute force over the first levels
+    return {bin_number for bin_number in range(4681 + (1 << 15)) if bin2range(bin_number)[0] < end and beg < bin2range(bin_number)[1]}
+
+
+def test_bin2range():
+    assert bin2range(0) == (0, 1 << 29)
+    assert bin2range(1) == (0, 1 << 26)
+    assert bin2range(2) == (1 << 26, 2 << 26)
+    assert bin2range(4681) == (0, LINEAR_WINDOW)
+    assert bin2range(4682) == (LINEAR_WINDOW, 2 * LINEAR_WINDOW)
+    with pytest.raises(ValueError):
+        bin2range(-1)
+
+
+@pytest.mark.parametrize('beg, end', [(0, 1), (0, LINEAR_WINDOW), (LINEAR_WINDOW - 1, LINEAR_WINDOW + 1),
+                                      (100000, 300000), ((1 << 26) - 5, (1 << 26) + 5)])
+def test_reg2bins_are_the_overlapping_bins(beg, end):
+    bins = reg2bins(beg, end)
+    assert len(bins) == len(set(bins))
+    assert set(bins) == overlapping_bins(beg, end)
+
+
+def test_reg2bins_window_edge():
+    assert reg2bins(0, LINEAR_WINDOW) == [0, 1, 9, 73, 585, 4681]
+    assert reg2bins(LINEAR_WINDOW - 1, LINEAR_WINDOW + 1)[-2:] == [4681, 4682]
+
+
+@pytest.mark.parametrize('chrom, start, end', [
+    ('1', 1, 100), ('1', 100, 100), ('1', 101, 139), ('1', 1, LINEAR_WINDOW), ('1', LINEAR_WINDOW + 1, 2 * LINEAR_WINDOW),
+    ('1', 16370, 16390), ('1', 16380, 16380), ('1', 16381, 16500), ('1', 39000, 210000), ('1', 40001, 199999),
+    ('2', 1, 1000000), ('X', 1, 1000000), ('3', 1, 1000000)])
+def test_fetch_region_bounds(case_reader, chrom, start, end):
+    assert list(case_reader.fetch(chrom, start, end)) == expected(CASE_VCF, chrom, start, end)
+
+
+def test_fetch_record_spanning_window_edge(case_reader):
+    # the deletion at 16380 reaches into the second window but is only returned by the region holding its POS
+    assert 16380 in positions(case_reader.fetch('1', 1, LINEAR_WINDOW))
+    assert 16380 not in positions(case_reader.fetch('1', LINEAR_WINDOW + 1, 2 * LINEAR_WINDOW))
+    assert 16380 not in positions(case_reader.fetch('1', 16381, 16409))
+
+
+def test_adjacent_regions_return_every_record_once(case_reader):
+    lines = []
+    for window in range(0, 13):
+        lines.extend(case_reader.fetch('1', window * LINEAR_WINDOW + 1, (window + 1) * LINEAR_WINDOW))
+    assert lines == expected(CASE_VCF, '1', 1, 13 * LINEAR_WINDOW)
+
+
+def test_fetch_merged_ordering():
+    readers = {'case': TabixReader(CASE_VCF), 'control': TabixReader(CONTROL_VCF)}
+    try:
+        merged = list(fetch_merged(readers, '1', 1, 50000))
+    finally:
+        for reader in readers.values():
+            reader.close()
+
+    merged_positions = [pos for pos, group, line in merged]
+    assert merged_positions == sorted(merged_positions)
+    for group, path in [('case', CASE_VCF), ('control', CONTROL_VCF)]:
+        assert [line for pos, g, line in merged if g == group] == expected(path, '1', 1, 50000)
+    # both files hold 16380, the case record comes first
+    assert [group for pos, group, line in merged if pos == 16380] == ['case', 'control']
+
+
+@pytest.mark.parametrize('target_bytes', [1, 4096, 1 << 30])
+def test_plan_region_batches(target_bytes):
+    indexes = [TabixIndex.load(CASE_VCF), TabixIndex.load(CONTROL_VCF)]
+    batches = plan_region_batches(indexes, ['1', '2', 'X'], target_bytes)
+
+    for chrom in ['1', '2']:
+        chrom_batches = [(start, end) for c, start, end in batches if c == chrom]
+        assert chrom_batches == sorted(chrom_batches)
+        for (start, end), (next_start, next_end) in zip(chrom_batches, chrom_batches[1:]):
+            assert end < next_start
+        for start, end in chrom_batches:
+            assert start % LINEAR_WINDOW == 1 and end % LINEAR_WINDOW == 0
+
+        # every record is in exactly one batch
+        for path in [CASE_VCF, CONTROL_VCF]:
+            in_batches = [line for start, end in chrom_batches for line in expected(path, chrom, start, end)]
+            assert in_batches == expected(path, chrom, 1, 1 << 29)
+
+    assert not [batch for batch in batches if batch[0] == 'X']
+
+
+def test_plan_region_batches_skips_empty_windows():
+    indexes = [TabixIndex.load(CASE_VCF), TabixIndex.load(CONTROL_VCF)]
+    batches = plan_region_batches(indexes, ['1'], 1 << 30)
+    # nothing is indexed in the windows between the two runs of 1
+    assert not [batch for batch in batches if batch[1] < 12 * LINEAR_WINDOW and batch[2] > 8 * LINEAR_WINDOW]
+    assert len(batches) == 2